@@ -0,0 +1,352 @@
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from time import perf_counter
+from datetime import datetime, timezone
+
+from utils import get_logger, iter_response_blocks, build_copy_buffer, build_values
+from parsers import get_parser
+from sinks import Sink, SqliteSink
+from instrumentation import recording
+from constants import (
+    BENCHMARK_DIR,
+    STREAM_CHUNK_SIZE_BYTES,
+    SQL_FOLDER_PATH,
+    BULK_LOAD_METHOD,
+    MergeCounts,
+)
+
+logger = get_logger()
+
+CORPUS_SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+# Table each synthetic source format is loaded to
+CORPUS_TABLES = {"hosts": "ads_and_trackers", "adblock": "malware"}
+BENCHMARK_SEED = 20231212
+DUPLICATE_RATIO = 0.1
+COMMENT_RATIO = 0.05
+# Pool of recently generated domains the duplicates are drawn from
+RECENT_DOMAINS = 4096
+
+WORDS = ("ads", "track", "pixel", "metrics", "cdn", "stats", "banner", "click", "beacon", "promo", "tag", "media")
+TLDS = ("com", "net", "org", "io", "ru", "de", "info", "xyz")
+
+
+def iter_corpus_lines(source_format: str,
+                      lines: int,
+                      seed: int = BENCHMARK_SEED,
+                      duplicate_ratio: float = DUPLICATE_RATIO,
+                      comment_ratio: float = COMMENT_RATIO):
+    # Same (source_format, lines, seed) always gives the same lines
+    rng = random.Random(f"{source_format}:{seed}")
+    recent = []
+    if source_format == "adblock":
+        yield "[Adblock Plus 2.0]"
+        lines -= 1
+
+    for i in range(lines):
+        draw = rng.random()
+        if draw < comment_ratio:
+            if rng.random() < 0.2:
+                yield ""
+            else:
+                yield f"{'!' if source_format == 'adblock' else '#'} list entry {i}"
+            continue
+
+        if draw < comment_ratio + duplicate_ratio and recent:
+            domain = rng.choice(recent)
+        else:
+            domain = f"{rng.choice(WORDS)}{rng.randrange(10 ** 6)}.{rng.choice(WORDS)}.{rng.choice(TLDS)}"
+            if len(recent) < RECENT_DOMAINS:
+                recent.append(domain)
+            else:
+                recent[i % RECENT_DOMAINS] = domain
+
+        variant = rng.random()
+        if source_format == "hosts":
+            ip = "127.0.0.1" if variant < 0.1 else "0.0.0.0"
+            yield f"{ip} {domain} # tracker" if variant > 0.95 else f"{ip} {domain}"
+        elif variant < 0.05:
+            # Cosmetic filter, not a domain rule
+            yield f"{domain}##.ad-banner"
+        else:
+            yield f"||{domain}^$third-party" if variant > 0.9 else f"||{domain}^"
+
+
+def write_corpus(source_format: str, size: str, seed: int = BENCHMARK_SEED, corpus_dir: str = None) -> str:
+    # Corpora are generated once per (format, size, seed) and reused by later runs
+    corpus_dir = corpus_dir or os.path.join(BENCHMARK_DIR, "corpus")
+    os.makedirs(corpus_dir, exist_ok=True)
+    path = os.path.join(corpus_dir, f"{source_format}_{size}_{seed}.txt")
+    if not os.path.exists(path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as corpus:
+            for line in iter_corpus_lines(source_format, CORPUS_SIZES[size], seed=seed):
+                corpus.write(line + "\n")
+        os.replace(tmp_path, path)
+    return path
+
+
+class CorpusResponse:
+    # Local corpus file in place of a streamed requests.Response, exposes only what the load path reads
+    status_code = 200
+    encoding = "utf-8"
+
+    def __init__(self, path: str):
+        self.url = path
+        self.path = path
+
+    def iter_content(self, chunk_size: int = STREAM_CHUNK_SIZE_BYTES):
+        with open(self.path, "rb") as corpus:
+            while chunk := corpus.read(chunk_size):
+                yield chunk
+
+
+class PayloadSink(Sink):
+    """
+    Sink of the in-process benchmarks: builds the payload ConnectorDB sends for every chunk (COPY buffer,
+    or VALUES literals with BULK_LOAD_METHOD=values) and drops it, so the load phase is measured without a DB.
+    """
+    def run_sql(self,
+                sql_file_name: str,
+                sql_params: dict = None,
+                sql_folder_path: str = SQL_FOLDER_PATH,
+                return_row: bool = False,
+                checkpoint: dict = None):
+        return None
+
+    def load_rows(self,
+                  sql_file_name: str,
+                  values: set,
+                  sql_params: dict,
+                  fields: list,
+                  checkpoint: dict = None) -> MergeCounts:
+        self.append_rows(values=values, sql_params=sql_params, fields=fields, checkpoint=checkpoint)
+        return MergeCounts(len(values), 0, 0, len(values))
+
+    def append_rows(self, values: set, sql_params: dict, fields: list, checkpoint: dict = None):
+        if BULK_LOAD_METHOD == 'copy':
+            build_copy_buffer(values)
+        else:
+            build_values(values)
+
+    def iter_rows(self, sql_file_name: str, sql_params: dict, sql_folder_path: str = SQL_FOLDER_PATH):
+        yield from ()
+
+
+def run_pipeline(path: str, source_format: str, chunk_size: int = 1000, memory: dict = None,
+                 sink: str = "payload") -> dict:
+    """
+    Runs the datalake load path of RunETl (iter_datalake_batches and load_datalake_batch: download, parse,
+    validate, dedup, hash keys, load) over a corpus, loaded by PayloadSink or by the embedded SQLite sink.
+    With memory, memory['peak'] is the peak of memory allocated by the run (tracemalloc has to be started).
+    Returns {phase: {calls, wall_time_sec, cpu_time_sec, p50_time_ms, p95_time_ms, rows, rows_per_sec}}.
+    """
+    from etl_flow import RunETl
+
+    table_name = CORPUS_TABLES[source_format]
+    parser = get_parser(source_format=source_format)
+    load_counts = {"inserting_row_count": 0, "res_row_count": 0, "duplicate_row_count": 0, "removed_row_count": 0,
+                   "inserted_row_count": 0, "updated_row_count": 0, "unchanged_row_count": 0}
+    # Connections of the Postgres sink are opened lazily, it is replaced before the first one.
+    # Every run loads into an empty SQLite DB, so runs over the same corpus are comparable
+    sqlite_dir = tempfile.TemporaryDirectory(prefix="benchmark_sqlite_")
+    etl = RunETl(sink="postgres")
+    etl.db_conn.close()
+    etl.db_conn = SqliteSink(sqlite_dir=sqlite_dir.name, logger=logger) if sink == "sqlite" else PayloadSink()
+    etl.etl_chunk = chunk_size
+
+    if memory is not None:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    try:
+        etl.etl_1_build_schema()
+        with recording(enabled=True) as phases:
+            blocks = iter_response_blocks(CorpusResponse(path))
+            for batch_data, rejected_rows in etl.iter_datalake_batches(blocks, parser, table_name):
+                etl.load_datalake_batch(table_name=table_name,
+                                        batch_data=batch_data,
+                                        load_counts=load_counts,
+                                        rejected_rows=rejected_rows)
+            phase_rows = phases.phase_rows()
+    finally:
+        for deduplicator in etl.deduplicators.values():
+            deduplicator.close()
+        if etl.parse_pool:
+            etl.parse_pool.close()
+        etl.db_conn.close()
+        sqlite_dir.cleanup()
+    if memory is not None:
+        memory["peak"] = tracemalloc.get_traced_memory()[1] - baseline
+
+    # Rows going into every phase
+    loaded_rows = load_counts["inserting_row_count"]
+    rows_in = {
+        "download": parser.lines_read,
+        "parse": parser.lines_read,
+        "validate": parser.rows_parsed,
+        "dedup": loaded_rows + load_counts["duplicate_row_count"],
+        "hash_keys": loaded_rows,
+        "load": loaded_rows,
+    }
+    results = {}
+    for phase, calls, wall_time_sec, cpu_time_sec, p50_time_ms, p95_time_ms, *_ in phase_rows:
+        if phase not in rows_in:
+            continue
+        results[phase] = {
+            "calls": calls,
+            "wall_time_sec": wall_time_sec,
+            "cpu_time_sec": cpu_time_sec,
+            "p50_time_ms": p50_time_ms,
+            "p95_time_ms": p95_time_ms,
+            "rows": rows_in[phase],
+            "rows_per_sec": round(rows_in[phase] / wall_time_sec, 1) if wall_time_sec else None,
+        }
+    return results
+
+
+def run_postgres(path: str, source_format: str) -> dict:
+    # End-to-end load of a corpus into the DB configured by .env, followed by the DWH build
+    from etl_flow import RunETl
+
+    table_name = CORPUS_TABLES[source_format]
+    etl = RunETl()
+    try:
+        etl.etl_1_build_schema()
+        etl.create_datalake_partition(table_name=table_name)
+
+        start_time = perf_counter()
+        result = etl.populate_datalake(response=CorpusResponse(path),
+                                       table_name=table_name,
+                                       source=f"benchmark://{os.path.basename(path)}",
+                                       source_format=source_format)
+        datalake_time_sec = perf_counter() - start_time
+
+        start_time = perf_counter()
+        etl.etl_3_build_dwh()
+        dwh_time_sec = perf_counter() - start_time
+    finally:
+        etl.db_conn.close()
+
+    return {
+        "populate_datalake": {
+            "wall_time_sec": round(datalake_time_sec, 6),
+            "rows": result.inserting_row_count,
+            "rows_per_sec": round(result.inserting_row_count / datalake_time_sec, 1) if datalake_time_sec else None,
+            "inserted_row_count": result.inserted_row_count,
+            "unchanged_row_count": result.unchanged_row_count,
+        },
+        "etl_3_build_dwh": {
+            "wall_time_sec": round(dwh_time_sec, 6),
+        },
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return os.getenv("BENCHMARK_COMMIT")
+
+
+def run_benchmarks(formats: list,
+                   sizes: list,
+                   seed: int = BENCHMARK_SEED,
+                   chunk_size: int = 1000,
+                   trace_memory: bool = True,
+                   postgres: bool = False,
+                   sink: str = "payload") -> dict:
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "chunk_size": chunk_size,
+        "sink": sink,
+        "results": [],
+    }
+    for source_format in formats:
+        for size in sizes:
+            path = write_corpus(source_format, size, seed=seed)
+            logger.info(f"Benchmark of '{source_format}' corpus of {size} lines...")
+            result = {
+                "format": source_format,
+                "size": size,
+                "lines": CORPUS_SIZES[size],
+                "bytes": os.path.getsize(path),
+                "stages": run_pipeline(path, source_format, chunk_size=chunk_size, sink=sink),
+            }
+            if trace_memory:
+                # Separate pass, tracemalloc slows down the traced code
+                memory = {}
+                tracemalloc.start()
+                try:
+                    run_pipeline(path, source_format, chunk_size=chunk_size, memory=memory, sink=sink)
+                finally:
+                    tracemalloc.stop()
+                result["peak_memory_bytes"] = memory["peak"]
+            if postgres:
+                result["postgres"] = run_postgres(path, source_format)
+            report["results"].append(result)
+    return report
+
+
+def compare(report: dict, baseline: dict) -> list:
+    # Ratio of rows_per_sec of every stage to the baseline report (> 1 is faster)
+    baseline_stages = {(r["format"], r["size"]): r["stages"] for r in baseline["results"]}
+    lines = []
+    for result in report["results"]:
+        for name, stats in result["stages"].items():
+            previous = baseline_stages.get((result["format"], result["size"]), {}).get(name)
+            if previous and previous.get("rows_per_sec") and stats.get("rows_per_sec"):
+                lines.append(f"{result['format']:8} {result['size']:4} {name:12} "
+                             f"{stats['rows_per_sec'] / previous['rows_per_sec']:.2f}x")
+    return lines
+
+
+def main(argv: list = None):
+    arg_parser = argparse.ArgumentParser(description="Benchmarks of the datalake load path over synthetic sources")
+    arg_parser.add_argument("--formats", default="hosts,adblock", help="comma separated: hosts, adblock")
+    arg_parser.add_argument("--sizes", default="10k,1m", help=f"comma separated: {', '.join(CORPUS_SIZES)}")
+    arg_parser.add_argument("--seed", type=int, default=BENCHMARK_SEED)
+    arg_parser.add_argument("--chunk-size", type=int, default=1000)
+    arg_parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    arg_parser.add_argument("--sink", choices=("payload", "sqlite"), default="payload",
+                            help="sink of the in-process load path: payloads built without a DB, or embedded SQLite")
+    arg_parser.add_argument("--postgres", action="store_true",
+                            help="also load the corpora end-to-end into the DB configured by .env")
+    arg_parser.add_argument("--output", help="result JSON file (default: <BENCHMARK_DIR>/<commit>_<timestamp>.json)")
+    arg_parser.add_argument("--compare", help="result JSON file of a previous run to compare throughput with")
+    args = arg_parser.parse_args(argv)
+
+    report = run_benchmarks(formats=args.formats.split(","),
+                            sizes=args.sizes.split(","),
+                            seed=args.seed,
+                            chunk_size=args.chunk_size,
+                            trace_memory=not args.no_memory,
+                            postgres=args.postgres,
+                            sink=args.sink)
+
+    output = args.output or os.path.join(
+        BENCHMARK_DIR, f"{report['commit'] or 'local'}_{datetime.now(timezone.utc):%Y%m%dT%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    logger.info(f"Benchmark results are written to '{output}'")
+
+    if args.compare:
+        with open(args.compare) as file:
+            for line in compare(report, json.load(file)):
+                logger.info(line)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,60 @@
+import threading
+
+from constants import (
+    DATALAKE_CHUNK_SIZE,
+    DATALAKE_CHUNK_ADAPTIVE,
+    DATALAKE_CHUNK_MIN_ROWS,
+    DATALAKE_CHUNK_MAX_ROWS,
+    DATALAKE_CHUNK_TARGET_SEC,
+    DATALAKE_CHUNK_MAX_BYTES,
+)
+
+
+def payload_bytes(rows: list) -> int:
+    # Approximate size of the loaded values of a chunk (text fields of its rows)
+    return sum(len(value) for row in rows for value in row if isinstance(value, str))
+
+
+class AdaptiveChunkSize:
+    """
+    Number of parsed rows of the next datalake chunk of a table. After every loaded chunk the size is tuned by
+    the measured latency and payload of the chunk: it becomes the size loading in about target_sec at the observed
+    rows/sec, limited by max_bytes of payload at the observed bytes/row and by min_rows/max_rows.
+    Measurements are smoothed and the size changes at most by the growth factor per chunk, so a single slow or fast
+    chunk doesn't swing it. Sources of a table share its size, it is observed by their writer threads.
+    """
+    def __init__(self,
+                 initial: int = DATALAKE_CHUNK_SIZE,
+                 adaptive: bool = DATALAKE_CHUNK_ADAPTIVE,
+                 min_rows: int = DATALAKE_CHUNK_MIN_ROWS,
+                 max_rows: int = DATALAKE_CHUNK_MAX_ROWS,
+                 target_sec: float = DATALAKE_CHUNK_TARGET_SEC,
+                 max_bytes: int = DATALAKE_CHUNK_MAX_BYTES,
+                 smoothing: float = 0.5,
+                 growth: float = 2.0):
+        self.size = initial
+        self.adaptive = adaptive
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.target_sec = target_sec
+        self.max_bytes = max_bytes
+        self.smoothing = smoothing
+        self.growth = growth
+        self.rows_per_sec = None
+        self.bytes_per_row = None
+        self._lock = threading.Lock()
+
+    def _smooth(self, average: float | None, value: float) -> float:
+        return value if average is None else average + self.smoothing * (value - average)
+
+    def observe(self, rows: int, seconds: float, payload: int) -> int:
+        # rows is the number of parsed rows of the loaded chunk, returns the size of the next chunk
+        if not self.adaptive or rows <= 0:
+            return self.size
+        with self._lock:
+            self.rows_per_sec = self._smooth(self.rows_per_sec, rows / max(seconds, 1e-6))
+            self.bytes_per_row = self._smooth(self.bytes_per_row, payload / rows)
+            size = min(self.target_sec * self.rows_per_sec, self.max_bytes / max(self.bytes_per_row, 1.0))
+            size = min(max(size, self.size / self.growth), self.size * self.growth)
+            self.size = int(min(max(size, self.min_rows), self.max_rows))
+            return self.size
@@ -1,20 +1,95 @@
 import os
+from collections import namedtuple
 from datetime import datetime, timezone
 
 from dotenv import load_dotenv
 
 from models import AdsAndTrackers, Malware
 
-DATALAKE_SQL_FILENAME = "populate_datalake"
+# Upsert (INSERT ... ON CONFLICT) of a staging table into its target table on the natural key of the target
+MERGE_SQL_FILENAME = "merge"
+DATALAKE_SQL_FILENAME = MERGE_SQL_FILENAME
 DATALAKE_SCHEMA = "datalake"
 
 DWH_SCHEMA = "dwh"
 
-ETL_TIMESTAMP = datetime.now(timezone.utc)
+# Id of a run (its timestamp in whole seconds) in files and tables kept per run (landing, profiles, checkpoints)
+RUN_ID_FORMAT = "%Y%m%dT%H%M%S"
+# A resumed run ('etl_flow.py --resume') continues the interrupted run with this id instead of starting a new one
+ETL_RESUME_RUN = os.getenv('ETL_RESUME_RUN')
+ETL_TIMESTAMP = (
+    datetime.strptime(ETL_RESUME_RUN, RUN_ID_FORMAT).replace(tzinfo=timezone.utc) if ETL_RESUME_RUN
+    else datetime.now(timezone.utc).replace(microsecond=0)
+)
+ETL_RUN_ID = ETL_TIMESTAMP.strftime(RUN_ID_FORMAT)
 
 if not os.getenv('DB_HOST'):
     load_dotenv(dotenv_path=f'./.env')
 
+# Size of the network chunk read from a source response while streaming it line by line
+STREAM_CHUNK_SIZE_BYTES = int(os.getenv('STREAM_CHUNK_SIZE_BYTES', 64 * 1024))
+
+# Concurrency of the datalake fetch stage: global number of sources in flight and connections per host
+FETCH_MAX_WORKERS = int(os.getenv('FETCH_MAX_WORKERS', 4))
+FETCH_MAX_PER_HOST = int(os.getenv('FETCH_MAX_PER_HOST', 2))
+# Local directory for state kept between runs (mounted as a volume in docker-compose)
+ETL_STATE_DIR = os.getenv('ETL_STATE_DIR', './state')
+
+# On-disk cache of validators (ETag/Last-Modified) and content hashes of fetched sources
+FETCH_CACHE_ENABLED = os.getenv('FETCH_CACHE_ENABLED', '1') == '1'
+FETCH_CACHE_DIR = os.path.join(ETL_STATE_DIR, 'fetch_cache')
+# Spooled bodies are downloaded and hashed before parsing: a source served without ETag/Last-Modified is still
+# skipped when its body is identical to the last loaded one, but its download and parse no longer overlap.
+# By default the body is hashed while it streams through the parser and only a 304 response skips a source
+FETCH_CACHE_SPOOL = os.getenv('FETCH_CACHE_SPOOL', '0') == '1'
+# Fetched bodies up to this size are spooled in memory before hashing, larger ones go to a temporary file
+FETCH_SPOOL_MAX_MEMORY_BYTES = int(os.getenv('FETCH_SPOOL_MAX_MEMORY_BYTES', 8 * 1024 * 1024))
+
+# Parallel parse mode: bodies larger than one segment are split on line boundaries into segments of about this
+# size (of decoded text), parsed and validated by a pool of worker processes. 0 workers parse in the fetch thread
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 0))
+PARSE_SEGMENT_SIZE_BYTES = int(os.getenv('PARSE_SEGMENT_SIZE_MB', 4)) * 1024 * 1024
+# Stages of a source (download, parse/validate, DB write) run in their own threads connected by bounded queues
+# of this many blocks/chunks, a slow DB blocks the parser and then the download instead of growing memory
+DATALAKE_PIPELINE_ENABLED = os.getenv('DATALAKE_PIPELINE_ENABLED', '1') == '1'
+DATALAKE_PIPELINE_QUEUE_SIZE = int(os.getenv('DATALAKE_PIPELINE_QUEUE_SIZE', 4))
+
+# Raw landing zone: fetched bodies are stored gzip compressed by content hash with a manifest per run,
+# a run is replayed from it with 'etl_flow.py --replay <run id>' (manifest name) without network
+LANDING_ENABLED = os.getenv('LANDING_ENABLED', '1') == '1'
+LANDING_DIR = os.getenv('LANDING_DIR', os.path.join(ETL_STATE_DIR, 'landing'))
+LANDING_COMPRESS_LEVEL = int(os.getenv('LANDING_COMPRESS_LEVEL', 6))
+
+# Synthetic corpora and JSON results of benchmark.py
+BENCHMARK_DIR = os.path.join(ETL_STATE_DIR, 'benchmarks')
+
+# Size of the DB connection pool shared by the fetch workers (one leased connection per unit of work)
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', FETCH_MAX_WORKERS))
+
+# Run-wide deduplication of datalake rows: memory budget of the digests kept in memory per table,
+# above it digests are spilled to sorted runs on disk (merged into one when there are more than max runs)
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', '1') == '1'
+DEDUP_MEMORY_BUDGET_BYTES = int(os.getenv('DEDUP_MEMORY_BUDGET_MB', 256)) * 1024 * 1024
+DEDUP_MAX_SPILLED_RUNS = int(os.getenv('DEDUP_MAX_SPILLED_RUNS', 8))
+
+# Datalake load mode: "full" loads every row of every source, "diff" loads only rows added to or removed from
+# the union of the sources of a table since the previous run (removed rows are loaded with is_removed = TRUE)
+DATALAKE_LOAD_MODE = os.getenv('DATALAKE_LOAD_MODE', 'full')
+SNAPSHOT_DIR = os.path.join(ETL_STATE_DIR, 'snapshots')
+# Rows of a source sorted in memory before they are spilled to a temporary run while writing its snapshot
+DIFF_SORT_BUFFER_ROWS = int(os.getenv('DIFF_SORT_BUFFER_ROWS', 500_000))
+REMOVED_MARKER_FIELD = "is_removed"
+# DWH hash keys (MD5 of the value as UUID) are computed while loading the datalake,
+# keys of the most recent distinct values are cached since the same URLs come from several sources
+HASH_KEY_CACHE_SIZE = int(os.getenv('HASH_KEY_CACHE_SIZE', 256 * 1024))
+DELTA_SOURCE = "delta"
+
+# Timeouts applied to every source request: (connect, read between bytes)
+FETCH_TIMEOUT_SEC = (
+    float(os.getenv('FETCH_CONNECT_TIMEOUT_SEC', 10)),
+    float(os.getenv('FETCH_READ_TIMEOUT_SEC', 60)),
+)
+
 # The location of the mount point within the container (docker-compose configs: statement in etl service)
 ETL_CONF = "./etl_conf/etl_conf.json"
 
@@ -27,13 +102,49 @@ SCHEMA_MAPPING = {
 }
 
 SQL_FOLDER_PATH = "./sql/{file_name}.sql"
+
+# Bulk load method of datalake chunks and statistics rows: "copy" (COPY ... FROM STDIN) or "values" (fallback,
+# rows are rendered as VALUES literals into the SQL template)
+BULK_LOAD_METHOD = os.getenv('BULK_LOAD_METHOD', 'copy')
+STAGING_SQL_FILENAME = "create_staging_table"
+# Datalake staging mode: "source" appends all chunks of a source to one staging table of the run and merges it
+# into the target once when the source is read, "chunk" stages and merges every chunk in its own transaction
+DATALAKE_STAGING_MODE = os.getenv('DATALAKE_STAGING_MODE', 'source')
+SOURCE_STAGING_SQL_FILENAME = "create_source_staging_table"
+APPEND_STAGING_SQL_FILENAME = "append_staging"
+DROP_STAGING_SQL_FILENAME = "drop_staging_table"
+# Staging tables left behind by failed runs which are not resumable (any run but the partial ones)
+STALE_STAGING_SQL_FILENAME = "stale_staging_tables"
+# Parsed rows per datalake chunk: the initial size, tuned per table after every chunk by its load latency
+# (to load in about the target time) and payload (to stay below max bytes) within min/max rows
+DATALAKE_CHUNK_SIZE = int(os.getenv('DATALAKE_CHUNK_SIZE', 1000))
+DATALAKE_CHUNK_ADAPTIVE = os.getenv('DATALAKE_CHUNK_ADAPTIVE', '1') == '1'
+DATALAKE_CHUNK_MIN_ROWS = int(os.getenv('DATALAKE_CHUNK_MIN_ROWS', 500))
+DATALAKE_CHUNK_MAX_ROWS = int(os.getenv('DATALAKE_CHUNK_MAX_ROWS', 200_000))
+DATALAKE_CHUNK_TARGET_SEC = float(os.getenv('DATALAKE_CHUNK_TARGET_SEC', 0.5))
+DATALAKE_CHUNK_MAX_BYTES = int(os.getenv('DATALAKE_CHUNK_MAX_MB', 16)) * 1024 * 1024
+
+# Datalake tables are range partitioned by etl_timestamp, the partition of a run is created before loading it.
+# Fixed length interval ('1 day', '6 hours', ...), changing it keeps the already created partitions
+DATALAKE_PARTITION_INTERVAL = os.getenv('DATALAKE_PARTITION_INTERVAL', '1 day')
+PARTITION_SQL_FILENAME = "create_partition"
+# Every run keeps a full copy of its sources in its partition, partitions older than the last this many completed
+# runs are dropped when a run completes (0 keeps all of them)
+DATALAKE_PARTITION_RETENTION_RUNS = int(os.getenv('DATALAKE_PARTITION_RETENTION_RUNS', 7))
+DROP_PARTITIONS_SQL_FILENAME = "drop_partitions"
+PARTITION_KEY_FIELD = "etl_timestamp"
 DWH_SQL_FOLDER_PATH = "./sql/dwh/{file_name}.sql"
 
 DB_SCHEMA_SQL_FILENAME = "db_schema"
 
-STATISTICS_SQL = "build_statistics"
+STATISTICS_SQL = MERGE_SQL_FILENAME
 BUILD_DATALAKE_STATISTICS_TABLE = "build_datalake_statistics"
 BUILD_DWH_STATISTICS_TABLE = "build_dwh_statistics"
+# Status of a source in datalake statistics
+SOURCE_STATUS_LOADED = "loaded"
+SOURCE_STATUS_UNCHANGED = "unchanged"
+SOURCE_STATUS_FAILED = "failed"
+
 DATALAKE_FIELD_STATISTICS = [
     "etl_timestamp",
     "stage",
@@ -42,15 +153,38 @@ DATALAKE_FIELD_STATISTICS = [
     "source",
     "inserting_row_count",
     "res_row_count",
+    "status",
+    "parse_lines_per_sec",
+    "duplicate_row_count",
+    "removed_row_count",
+    "inserted_row_count",
+    "updated_row_count",
+    "unchanged_row_count",
     "execution_time_min",
     "load_timestamp"
 ]
+# Statistics values returned by populate_datalake, build_statistics adds etl_timestamp, stage, schema
+# before them and execution_time_min, load_timestamp after them
+DatalakeStatisticsRow = namedtuple("DatalakeStatisticsRow", DATALAKE_FIELD_STATISTICS[3:-2])
+# Result row of a merge: rows inserted, updated (changed non-key fields) and unchanged, estimated rows of the target
+# after it and rows deleted by it (DWH tables in diff load mode)
+MergeCounts = namedtuple("MergeCounts", ["inserted_row_count", "updated_row_count", "unchanged_row_count",
+                                         "res_row_count", "deleted_row_count"], defaults=[0])
+# Rows of a table after a merge (res_row_count) are estimated from pg_class.reltuples, an exact COUNT(*) of the table
+# (a full scan) replaces the estimate for this share of the loaded sources and DWH tables (0 - never, 1 - always)
+ROW_COUNT_EXACT_SAMPLE_RATE = float(os.getenv('ROW_COUNT_EXACT_SAMPLE_RATE', 0))
+ROW_COUNT_SQL_FILENAME = "row_count"
+
 DWH_FIELD_STATISTICS = [
     "etl_timestamp",
     "stage",
     "schema",
     "table_name",
     "res_row_count",
+    "inserted_row_count",
+    "updated_row_count",
+    "unchanged_row_count",
+    "deleted_row_count",
     "execution_time_min",
     "load_timestamp"
 ]
@@ -58,22 +192,113 @@ FIELD_STATISTICS_MAPPING = {
     DATALAKE_SCHEMA: DATALAKE_FIELD_STATISTICS,
     DWH_SCHEMA: DWH_FIELD_STATISTICS
 }
-WHERE_DELETE_DATALAKE_FIELDS = [
+# Natural keys of the statistics tables (their primary keys)
+MERGE_KEY_DATALAKE_FIELDS = [
     "etl_timestamp",
     "stage",
     "schema",
     "table_name",
     "source",
 ]
-WHERE_DELETE_DWH_FIELDS = [
+MERGE_KEY_DWH_FIELDS = [
     "etl_timestamp",
     "stage",
     "schema",
     "table_name",
 ]
-WHERE_DELETE_MAPPING = {
-    DATALAKE_SCHEMA: WHERE_DELETE_DATALAKE_FIELDS,
-    DWH_SCHEMA: WHERE_DELETE_DWH_FIELDS
+MERGE_KEY_MAPPING = {
+    DATALAKE_SCHEMA: MERGE_KEY_DATALAKE_FIELDS,
+    DWH_SCHEMA: MERGE_KEY_DWH_FIELDS
 }
 
-CLEAR_DWH_SQL_FILE = "clear_before_update_fk"
+# Per-phase timings (download/parse/validate/dedup/load spans) and counters of a populate_* call,
+# a row per phase next to the row of the statistics table
+INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION_ENABLED', '1') == '1'
+PHASE_STATISTICS_TABLE_MAPPING = {
+    DATALAKE_SCHEMA: "build_datalake_phase_statistics",
+    DWH_SCHEMA: "build_dwh_phase_statistics"
+}
+PHASE_STATISTICS_FIELDS = [
+    "phase",
+    "calls",
+    "wall_time_sec",
+    "cpu_time_sec",
+    "p50_time_ms",
+    "p95_time_ms",
+    "max_queue_depth",
+    "bytes_downloaded",
+    "lines_read",
+    "rows_rejected",
+    "chunk_count",
+    "load_timestamp"
+]
+FIELD_PHASE_STATISTICS_MAPPING = {
+    schema: merge_key + PHASE_STATISTICS_FIELDS for schema, merge_key in MERGE_KEY_MAPPING.items()
+}
+MERGE_KEY_PHASE_STATISTICS_MAPPING = {
+    schema: merge_key + ["phase"] for schema, merge_key in MERGE_KEY_MAPPING.items()
+}
+
+# Opt-in profiling of every unit of work (schema build, datalake source, DWH table) with cProfile and tracemalloc
+# (also enabled by 'etl_flow.py --profile'). Reports go to the mounted state directory, a summary row of each unit
+# is stored in the phase statistics tables as the 'profile' phase
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '0') == '1'
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(ETL_STATE_DIR, 'profiles'))
+# Functions and allocation lines written to the text report of a unit
+PROFILE_TOP_ENTRIES = int(os.getenv('PROFILE_TOP_ENTRIES', 30))
+# Frames kept by tracemalloc per allocation, more frames cost more memory and time
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv('PROFILE_TRACEMALLOC_FRAMES', 1))
+PHASE_PROFILE = "profile"
+PROFILE_STATISTICS_FIELDS = [
+    "allocated_bytes",
+    "top_function",
+    "report_path",
+]
+FIELD_PROFILE_STATISTICS_MAPPING = {
+    schema: fields + PROFILE_STATISTICS_FIELDS for schema, fields in FIELD_PHASE_STATISTICS_MAPPING.items()
+}
+
+# Chunk checkpoints of datalake sources (full load mode), written in the transaction of every loaded chunk,
+# so a resumed run skips the chunks already committed by the interrupted one
+CHECKPOINT_ENABLED = os.getenv('CHECKPOINT_ENABLED', '1') == '1'
+UPSERT_SQL_FILENAME = "upsert"
+CHECKPOINT_TABLE = "load_checkpoints"
+CHECKPOINT_FIELDS = [
+    "etl_timestamp",
+    "table_name",
+    "source",
+    "chunk_number",
+    "row_offset",
+    "content_hash",
+    "status",
+    "updated_at",
+]
+MERGE_KEY_CHECKPOINT_FIELDS = ["etl_timestamp", "table_name", "source"]
+LOAD_CHECKPOINTS_SQL_FILENAME = "load_checkpoints"
+# Status of a whole run, a run which didn't finish stays partial until it is resumed to the end
+RUN_STATUS_TABLE = "etl_runs"
+RUN_STATUS_FIELDS = ["etl_timestamp", "run_id", "status", "updated_at"]
+LAST_PARTIAL_RUN_SQL_FILENAME = "last_partial_run"
+RUN_STATUS_PARTIAL = "partial"
+RUN_STATUS_COMPLETED = "completed"
+
+# Latest datalake rows since the DWH watermark, built once per run and shared by all DWH scripts
+DWH_DELTA_SQL_FILE = "build_delta"
+
+# Number of DWH tables built concurrently (each on its own pooled connection), order is given by dwh_conf.json
+DWH_MAX_WORKERS = int(os.getenv('DWH_MAX_WORKERS', 2))
+
+# Sink of the loads: "postgres" (the dwh service, default) or "sqlite" (embedded, the whole flow runs on one machine
+# without docker-compose). SQLite databases of the schemas are kept in SQLITE_DIR, its scripts are in sql/sqlite/
+ETL_SINK = os.getenv('ETL_SINK', 'postgres')
+ETL_SINKS = ("postgres", "sqlite")
+SQLITE_DIR = os.getenv('SQLITE_DIR', os.path.join(ETL_STATE_DIR, 'sqlite'))
+SQLITE_SQL_FOLDER_PATHS = {
+    SQL_FOLDER_PATH: "./sql/sqlite/{file_name}.sql",
+    DWH_SQL_FOLDER_PATH: "./sql/sqlite/dwh/{file_name}.sql",
+}
+# Rows of every run of the datalake, DWH and statistics tables are also exported as CSV files partitioned
+# by run to EXPORT_DIR (off when empty)
+EXPORT_DIR = os.getenv('EXPORT_DIR', '')
+EXPORT_ROWS_SQL_FILENAME = "export_rows"
+EXPORT_BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', 10_000))
@@ -1,17 +1,125 @@
 import os
 import time
 import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
 
 import psycopg2
 import psycopg2.extras
 
-from utils import get_logger, render_sql_from_file
-from constants import SQL_FOLDER_PATH
+from utils import get_logger, render_sql_from_file, build_values, build_copy_buffer
+from sinks import Sink
+from constants import (
+    SQL_FOLDER_PATH,
+    BULK_LOAD_METHOD,
+    STAGING_SQL_FILENAME,
+    APPEND_STAGING_SQL_FILENAME,
+    DB_POOL_MAX_SIZE,
+    EXPORT_BATCH_ROWS,
+    MergeCounts,
+)
 
 
-class ConnectorDB:
+class ConnectionPool:
+    """
+    Thread-safe pool of DB connections, which are opened lazily and kept open between units of work.
+    Broken connections are closed and replaced on the next lease.
+    """
+    def __init__(self, connect, max_size: int = DB_POOL_MAX_SIZE, logger: logging.Logger = get_logger()):
+        self._connect = connect
+        self.logger = logger
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+        self.max_size = max_size
+        self.in_use = 0
+        self.created = 0
+        self.reconnects = 0
+        self.leases = 0
+        self.wait_time_sec = 0.0
+        self.max_wait_time_sec = 0.0
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+                with self._lock:
+                    self.created += 1
+                return conn
+            if not conn.closed:
+                return conn
+            self._discard(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._lock:
+            self.reconnects += 1
+        self.logger.info("Broken DB connection is discarded from the pool...")
+
+    @contextmanager
+    def connection(self):
+        start_time = time.perf_counter()
+        self._slots.acquire()
+        wait_time = time.perf_counter() - start_time
+        try:
+            conn = self._checkout()
+            with self._lock:
+                self.in_use += 1
+                self.leases += 1
+                self.wait_time_sec += wait_time
+                self.max_wait_time_sec = max(self.max_wait_time_sec, wait_time)
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                with self._lock:
+                    self.in_use -= 1
+                self._discard(conn)
+                raise
+            except BaseException:
+                # Also covers GeneratorExit of a lease held by an abandoned iter_rows generator
+                conn.rollback()
+                self._release(conn)
+                raise
+            else:
+                self._release(conn)
+        finally:
+            self._slots.release()
+
+    def _release(self, conn):
+        with self._lock:
+            self.in_use -= 1
+            self._idle.append(conn)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "in_use": self.in_use,
+                "idle": len(self._idle),
+                "created": self.created,
+                "reconnects": self.reconnects,
+                "leases": self.leases,
+                "wait_time_sec": round(self.wait_time_sec, 3),
+                "max_wait_time_sec": round(self.max_wait_time_sec, 3),
+            }
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+
+class ConnectorDB(Sink):
     def __init__(self, logger: logging.Logger = get_logger()):
         self.logger = logger
+        self.pool = ConnectionPool(connect=self.create_db_connection, logger=logger)
 
     def create_db_connection(self) -> psycopg2.connect:
         try:
@@ -26,40 +134,31 @@ class ConnectorDB:
             self.logger.error(f"Database connection failed: {e}")
             raise e
 
-    def run_sql(self, sql_file_name: str, sql_params: dict = None, sql_folder_path: str = SQL_FOLDER_PATH) -> int:
+    def _run_with_retries(self, sql_file_name: str, execute) -> tuple | None:
+        # Returns the result row of the last statement of the script (None when it returns nothing)
         max_retries = 5
         retry_count = 1
 
-        res_row_count = None
+        res_row = None
 
         self.logger.info(f"DB_HOST: {os.getenv('DB_HOST')}")
 
         while retry_count < max_retries:
             try:
-                with self.create_db_connection() as conn:
+                with self.pool.connection() as conn:
                     with conn.cursor() as cur:
-                        # Execute SQL query
-                        sql = render_sql_from_file(
-                            file_name=sql_file_name, params_dict=sql_params, sql_folder_path=sql_folder_path
-                        )
-                        cur.execute(sql)
+                        execute(cur)
 
                         try:
-                            res_row_count = cur.fetchone()[0]
+                            res_row = cur.fetchone()
 
-                            self.logger.info(f"Result Row Count of '{sql_file_name}' script: {res_row_count}")
+                            self.logger.info(f"Result Row Count of '{sql_file_name}' script: {res_row}")
                         except psycopg2.ProgrammingError as e:
                             if e.args[0] == 'no results to fetch' in str(e):
                                 self.logger.info(f"Expected error: {e}...continue")
                             else:
                                 raise e
 
-                        # columns = ', '.join(batch_data[0].keys())
-                        # values = [tuple(data.values()) for data in batch_data]
-                        # query = f"TRUNCATE TABLE customer_visits; " \
-                        #             f"INSERT INTO customer_visits ({columns}) VALUES %s"
-                        # psycopg2.extras.execute_values(cur, query, values)
-
                         conn.commit()
                         break
             except psycopg2.OperationalError as e:
@@ -77,4 +176,114 @@ class ConnectorDB:
         if retry_count >= max_retries:
             raise psycopg2.OperationalError("Failed to connect to PostgreSQL after several retries.")
 
-        return res_row_count
+        return res_row
+
+    def run_sql(self,
+                sql_file_name: str,
+                sql_params: dict = None,
+                sql_folder_path: str = SQL_FOLDER_PATH,
+                return_row: bool = False,
+                checkpoint: dict = None):
+        # Returns the first value of the result row, or the whole row with return_row
+        def execute(cur):
+            self.execute_checkpoint(cur, checkpoint)
+            # Execute SQL query
+            sql = render_sql_from_file(
+                file_name=sql_file_name, params_dict=sql_params, sql_folder_path=sql_folder_path
+            )
+            cur.execute(sql)
+
+        res_row = self._run_with_retries(sql_file_name, execute)
+        if return_row or res_row is None:
+            return res_row
+        return res_row[0]
+
+    def run_copy_sql(self,
+                     sql_file_name: str,
+                     values: set,
+                     sql_params: dict,
+                     fields: list,
+                     sql_folder_path: str = SQL_FOLDER_PATH,
+                     checkpoint: dict = None) -> tuple | None:
+        """
+        Streams values into the staging table (temp '{schema}_{table_name}_temp' by default) with COPY ... FROM STDIN
+        and then runs sql_file_name (rendered without values) to merge the staging table into the target one.
+        Returns the result row of the merge.
+        """
+        copy_sql = self.copy_sql(sql_params, fields)
+        buffer = build_copy_buffer(values)
+
+        def execute(cur):
+            self.execute_checkpoint(cur, checkpoint)
+            cur.execute(render_sql_from_file(file_name=STAGING_SQL_FILENAME, params_dict=sql_params))
+            buffer.seek(0)
+            cur.copy_expert(copy_sql, buffer)
+            cur.execute(
+                render_sql_from_file(file_name=sql_file_name, params_dict=sql_params, sql_folder_path=sql_folder_path)
+            )
+
+        return self._run_with_retries(sql_file_name, execute)
+
+    @staticmethod
+    def copy_sql(sql_params: dict, fields: list) -> str:
+        staging_table = sql_params.get("staging_table") or f"{sql_params['schema']}_{sql_params['table_name']}_temp"
+        return f"COPY {staging_table} ({', '.join(fields)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+    def append_rows(self, values: set, sql_params: dict, fields: list, checkpoint: dict = None):
+        # Appends values to the staging table of a source (sql_params['staging_table']) which is merged later,
+        # checkpoint is committed in the same transaction as the rows
+        if BULK_LOAD_METHOD != 'copy':
+            self.run_sql(sql_file_name=APPEND_STAGING_SQL_FILENAME,
+                         sql_params={**sql_params, "values": build_values(values)},
+                         checkpoint=checkpoint)
+            return
+
+        copy_sql = self.copy_sql(sql_params, fields)
+        buffer = build_copy_buffer(values)
+
+        def execute(cur):
+            self.execute_checkpoint(cur, checkpoint)
+            buffer.seek(0)
+            cur.copy_expert(copy_sql, buffer)
+
+        self._run_with_retries(APPEND_STAGING_SQL_FILENAME, execute)
+
+    def iter_rows(self, sql_file_name: str, sql_params: dict, sql_folder_path: str = SQL_FOLDER_PATH):
+        # Yields the column names and then the rows of the query, fetched in batches by a server-side cursor
+        sql = render_sql_from_file(file_name=sql_file_name, params_dict=sql_params, sql_folder_path=sql_folder_path)
+        with self.pool.connection() as conn:
+            with conn.cursor(name=f"etl_{sql_file_name}_{threading.get_ident()}") as cur:
+                cur.execute(sql)
+                rows = cur.fetchmany(EXPORT_BATCH_ROWS)
+                yield tuple(column.name for column in cur.description)
+                while rows:
+                    yield from rows
+                    rows = cur.fetchmany(EXPORT_BATCH_ROWS)
+            conn.commit()
+
+    def pool_metrics(self) -> dict:
+        return self.pool.metrics()
+
+    def close(self):
+        self.pool.close()
+
+    def load_rows(self,
+                  sql_file_name: str,
+                  values: set,
+                  sql_params: dict,
+                  fields: list,
+                  checkpoint: dict = None) -> MergeCounts:
+        # sql_params are built without values: they are either streamed by COPY or rendered as a VALUES fallback.
+        # checkpoint is committed in the same transaction as the rows
+        if BULK_LOAD_METHOD == 'copy':
+            res_row = self.run_copy_sql(sql_file_name=sql_file_name,
+                                        values=values,
+                                        sql_params=sql_params,
+                                        fields=fields,
+                                        checkpoint=checkpoint)
+        else:
+            res_row = self.run_sql(sql_file_name=sql_file_name,
+                                   sql_params={**sql_params, "values": build_values(values)},
+                                   return_row=True,
+                                   checkpoint=checkpoint)
+        return MergeCounts(*res_row)
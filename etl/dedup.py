@@ -0,0 +1,126 @@
+import os
+import heapq
+import mmap
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+from utils import get_logger
+from constants import DEDUP_MEMORY_BUDGET_BYTES, DEDUP_MAX_SPILLED_RUNS
+
+DIGEST_SIZE = 16
+# Rough memory cost of one digest kept in a set (bytes object + set slot)
+DIGEST_MEMORY_COST = 100
+
+
+def row_digest(row: tuple) -> bytes:
+    return hashlib.blake2b(
+        "\x1f".join("\x00" if val is None else str(val) for val in row).encode(), digest_size=DIGEST_SIZE
+    ).digest()
+
+
+class SortedDigestRun:
+    """
+    Sorted digests spilled to a file, membership is checked by binary search over the memory-mapped file.
+    """
+    def __init__(self, path: str, digests):
+        self.path = path
+        with open(path, 'wb') as file:
+            for digest in digests:
+                file.write(digest)
+        self.size = os.path.getsize(path) // DIGEST_SIZE
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def __contains__(self, digest: bytes) -> bool:
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            value = self._mmap[middle * DIGEST_SIZE:(middle + 1) * DIGEST_SIZE]
+            if value < digest:
+                low = middle + 1
+            elif value > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self._mmap[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+        os.remove(self.path)
+
+
+class RowDeduplicator:
+    """
+    Run-wide deduplication of the rows of one table, across chunks and sources.
+    Digests of seen rows are kept in a set; above the memory budget they are spilled to sorted runs on disk.
+    """
+    def __init__(self,
+                 name: str,
+                 memory_budget_bytes: int = DEDUP_MEMORY_BUDGET_BYTES,
+                 max_spilled_runs: int = DEDUP_MAX_SPILLED_RUNS,
+                 logger: logging.Logger = get_logger()):
+        self.name = name
+        self.max_digests = max(memory_budget_bytes // DIGEST_MEMORY_COST, 1)
+        self.max_spilled_runs = max_spilled_runs
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._digests = set()
+        self._runs = []
+        self._spill_dir = None
+        self._spilled_runs_count = 0
+
+    def filter(self, rows) -> tuple:
+        """
+        Returns rows which were not seen before in the run (in their original order) and the number of duplicates.
+        """
+        unique_rows = []
+        with self._lock:
+            for row in rows:
+                digest = row_digest(row)
+                if digest in self._digests or any(digest in run for run in self._runs):
+                    continue
+                self._digests.add(digest)
+                unique_rows.append(row)
+
+            if len(self._digests) >= self.max_digests:
+                self._spill()
+
+        return unique_rows, len(rows) - len(unique_rows)
+
+    def _spill(self):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix=f"etl_dedup_{self.name}_")
+        self._spilled_runs_count += 1
+        path = os.path.join(self._spill_dir, f"run_{self._spilled_runs_count}.bin")
+
+        if len(self._runs) + 1 > self.max_spilled_runs:
+            # Streaming merge of all runs with the in-memory digests, so lookups check a bounded number of files
+            run = SortedDigestRun(path, heapq.merge(sorted(self._digests), *self._runs))
+            for merged_run in self._runs:
+                merged_run.close()
+            self._runs = [run]
+        else:
+            self._runs.append(SortedDigestRun(path, sorted(self._digests)))
+
+        self._digests = set()
+        self.logger.info(f"Dedup of '{self.name}' spilled digests to disk: {len(self._runs)} runs, "
+                         f"{sum(run.size for run in self._runs)} digests")
+
+    def close(self):
+        with self._lock:
+            for run in self._runs:
+                run.close()
+            self._runs = []
+            self._digests = set()
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
@@ -1,9 +1,44 @@
-import re
+import os
+import sys
+import json
+import random
+import hashlib
+import argparse
+import threading
+from time import perf_counter
+from datetime import datetime, timezone
+from contextlib import contextmanager, nullcontext, closing
+from http import HTTPStatus
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 
-from utils import parse_etl_configs, build_params, build_statistics, matcher, get_logger
+from utils import (
+    parse_etl_configs,
+    build_params,
+    add_hash_keys,
+    build_statistics,
+    get_logger,
+    iter_response_blocks,
+    build_http_session,
+    parse_source_conf,
+    parse_dwh_table_conf,
+    SQL_TEMPLATES,
+)
 from db_connector import ConnectorDB
+from sinks import SqliteSink, CsvExportSink
+from fetch_cache import FetchCache, HashingResponse
+from landing import LandingZone
+from parsers import get_parser
+from parse_pool import ParsePool, iter_validated_chunks, row_padding
+from pipeline import iter_in_thread, QueueWorker
+from chunking import AdaptiveChunkSize, payload_bytes
+from dedup import RowDeduplicator
+from snapshot import SnapshotStore
+from scheduler import run_dag
+from instrumentation import recorder, recording
+from profiling import StageProfiler
 from constants import (
     ETL_TIMESTAMP,
     ETL_CONF,
@@ -14,128 +49,788 @@ from constants import (
     DB_SCHEMA_SQL_FILENAME,
     DWH_SCHEMA,
     DWH_SQL_FOLDER_PATH,
+    BUILD_DATALAKE_STATISTICS_TABLE,
     BUILD_DWH_STATISTICS_TABLE,
-    CLEAR_DWH_SQL_FILE,
+    DWH_DELTA_SQL_FILE,
+    FETCH_MAX_WORKERS,
+    FETCH_MAX_PER_HOST,
+    FETCH_TIMEOUT_SEC,
+    FETCH_CACHE_ENABLED,
+    FETCH_CACHE_SPOOL,
+    DEDUP_ENABLED,
+    DATALAKE_LOAD_MODE,
+    REMOVED_MARKER_FIELD,
+    DELTA_SOURCE,
+    DWH_MAX_WORKERS,
+    PARSE_WORKERS,
+    DATALAKE_PIPELINE_ENABLED,
+    DATALAKE_STAGING_MODE,
+    SOURCE_STAGING_SQL_FILENAME,
+    DROP_STAGING_SQL_FILENAME,
+    STALE_STAGING_SQL_FILENAME,
+    DATALAKE_CHUNK_SIZE,
+    DATALAKE_CHUNK_ADAPTIVE,
+    LANDING_ENABLED,
+    ETL_RUN_ID,
+    ETL_RESUME_RUN,
+    CHECKPOINT_ENABLED,
+    UPSERT_SQL_FILENAME,
+    CHECKPOINT_TABLE,
+    CHECKPOINT_FIELDS,
+    MERGE_KEY_CHECKPOINT_FIELDS,
+    LOAD_CHECKPOINTS_SQL_FILENAME,
+    RUN_STATUS_TABLE,
+    RUN_STATUS_FIELDS,
+    LAST_PARTIAL_RUN_SQL_FILENAME,
+    RUN_STATUS_PARTIAL,
+    RUN_STATUS_COMPLETED,
+    DATALAKE_PARTITION_INTERVAL,
+    PARTITION_SQL_FILENAME,
+    DATALAKE_PARTITION_RETENTION_RUNS,
+    DROP_PARTITIONS_SQL_FILENAME,
+    SOURCE_STATUS_LOADED,
+    SOURCE_STATUS_UNCHANGED,
+    SOURCE_STATUS_FAILED,
+    DatalakeStatisticsRow,
+    MergeCounts,
+    ROW_COUNT_EXACT_SAMPLE_RATE,
+    ROW_COUNT_SQL_FILENAME,
+    PARTITION_KEY_FIELD,
+    STATISTICS_SQL,
+    PROFILING_ENABLED,
+    PHASE_PROFILE,
+    PHASE_STATISTICS_TABLE_MAPPING,
+    FIELD_PROFILE_STATISTICS_MAPPING,
+    MERGE_KEY_PHASE_STATISTICS_MAPPING,
+    ETL_SINK,
+    ETL_SINKS,
+    EXPORT_DIR,
 )
 
 logger = get_logger()
 
 
+def add_merge_counts(load_counts: dict, merge_counts: MergeCounts):
+    # Merge counts of the chunks of a source are summed, res_row_count is the row count after the last chunk
+    load_counts["inserted_row_count"] += merge_counts.inserted_row_count
+    load_counts["updated_row_count"] += merge_counts.updated_row_count
+    load_counts["unchanged_row_count"] += merge_counts.unchanged_row_count
+    load_counts["res_row_count"] = merge_counts.res_row_count
+
+
 class RunETl:
-    def __init__(self):
+    def __init__(self, profile: bool = PROFILING_ENABLED, replay_run: str = None, sink: str = ETL_SINK):
         self.datalake_configs = parse_etl_configs(ETL_CONF)
         self.dwh_configs = parse_etl_configs(DWH_CONF, stage='dwh')
-        self.etl_chunk = 1000
-        self.db_conn = ConnectorDB(logger=logger)
+        # Initial parsed rows per datalake chunk, the size of every table is then tuned by AdaptiveChunkSize
+        self.etl_chunk = DATALAKE_CHUNK_SIZE
+        self.chunk_sizes = {}
+        self.db_conn = self.build_sink(sink)
+        # All SQL templates are compiled once, before the first statement is rendered
+        SQL_TEMPLATES.preload()
+        self.http_session = build_http_session()
+        self.fetch_cache = FetchCache(logger=logger) if FETCH_CACHE_ENABLED else None
+        # A replayed run reads every source from the landing zone and doesn't land them again
+        self.replay_run = replay_run
+        self.replay_sources = {}
+        self.landing = LandingZone(logger=logger) if LANDING_ENABLED or replay_run else None
+        # In diff load mode rows are written to per-source snapshots instead of the DB, the snapshots are deduplicated
+        # by themselves and the delta of each table is loaded at the end of the datalake stage
+        self.snapshots = SnapshotStore() if DATALAKE_LOAD_MODE == 'diff' else None
+        self.deduplicators = (
+            {table_name: RowDeduplicator(name=table_name, logger=logger) for table_name in SCHEMA_MAPPING}
+            if DEDUP_ENABLED and not self.snapshots else {}
+        )
+        # Chunks of sources are checkpointed in full load mode (in diff mode they are loaded by the delta),
+        # a resumed run skips the rows committed by the interrupted one
+        self.checkpointing = CHECKPOINT_ENABLED and not self.snapshots
+        self.checkpoints = {}
+        # Chunks of a source are appended to its own staging table, merged into the datalake table once per source
+        self.source_staging = DATALAKE_STAGING_MODE == 'source' and not self.snapshots
+        self.profiler = StageProfiler(logger=logger) if profile else None
+        self.parse_pool = ParsePool() if PARSE_WORKERS > 0 else None
+
+    @staticmethod
+    def build_sink(sink: str = ETL_SINK):
+        # Postgres is the default sink, the embedded SQLite one runs the whole flow without the dwh service.
+        # With EXPORT_DIR the rows of the run are also exported as CSV files at the end of the flow
+        if sink not in ETL_SINKS:
+            raise ValueError(f"Unknown sink '{sink}', supported sinks: {', '.join(ETL_SINKS)}")
+        db_conn = SqliteSink(logger=logger) if sink == 'sqlite' else ConnectorDB(logger=logger)
+        return CsvExportSink(db_conn, export_dir=EXPORT_DIR, logger=logger) if EXPORT_DIR else db_conn
+
+    @contextmanager
+    def profiled(self, stage: str, schema: str, key: tuple):
+        """
+        Profiles a unit of work of a stage when profiling is enabled and stores its summary as the 'profile' phase
+        row of the phase statistics, key is the table_name (and source for datalake) of the unit.
+        """
+        if self.profiler is None:
+            yield
+            return
+
+        with self.profiler.profile(stage, "__".join(key)) as summary:
+            yield
+        self.db_conn.load_rows(
+            sql_file_name=STATISTICS_SQL,
+            values={(ETL_TIMESTAMP, stage, schema, *key,
+                     PHASE_PROFILE, summary["calls"], summary["wall_time_sec"], summary["cpu_time_sec"],
+                     None, None, None, None, None, None, None,
+                     datetime.now(timezone.utc),
+                     summary["allocated_bytes"], summary["top_function"], summary["report_path"])},
+            sql_params=build_params(table_name=PHASE_STATISTICS_TABLE_MAPPING[schema],
+                                    schema=schema,
+                                    fields=FIELD_PROFILE_STATISTICS_MAPPING[schema],
+                                    key_fields=MERGE_KEY_PHASE_STATISTICS_MAPPING[schema]),
+            fields=FIELD_PROFILE_STATISTICS_MAPPING[schema]
+        )
 
     def etl_1_build_schema(self):
         logger.info(f"Run ETL 1:'{self.etl_1_build_schema.__name__}'")
-        self.db_conn.run_sql(sql_file_name=DB_SCHEMA_SQL_FILENAME)
+        with self.profiled(self.etl_1_build_schema.__name__, DATALAKE_SCHEMA, (DB_SCHEMA_SQL_FILENAME, '')):
+            self.db_conn.run_sql(sql_file_name=DB_SCHEMA_SQL_FILENAME)
         logger.info(f"Finish ETL 1:'{self.etl_1_build_schema.__name__}'")
 
-    @build_statistics(schema=DATALAKE_SCHEMA, etl_timestamp=ETL_TIMESTAMP)
-    def populate_datalake(self, response: requests.Response, table_name: str, source: str):
-        res_row_count = 0
-        inserting_row_count = 0
+    def load_datalake_batch(self,
+                            table_name: str,
+                            batch_data: list,
+                            load_counts: dict,
+                            snapshot_writer=None,
+                            rejected_rows: list = None,
+                            checkpoint: dict = None,
+                            staging_table: str = None):
+        # With rejected_rows the chunk is already validated (by a parse worker), batch_data are its valid rows.
+        # checkpoint of the source is committed with the rows of the chunk. With staging_table the rows are only
+        # appended to the staging table of the source, it is merged by merge_datalake_staging
+        start_time = perf_counter()
+        parsed_rows = len(batch_data) + len(rejected_rows or ())
+        model = SCHEMA_MAPPING[table_name]
+        phases = recorder()
+        phases.count("chunk_count")
+        if rejected_rows is None:
+            # Whole chunk is validated in one call, bad rows are reported instead of failing the source
+            with phases.span("validate"):
+                valid_rows, rejected_rows = model.validate_rows(batch_data)
+        else:
+            valid_rows = batch_data
+        if rejected_rows:
+            phases.count("rows_rejected", len(rejected_rows))
+            logger.warning(f"Rejected {len(rejected_rows)} rows of '{table_name}', first one: {rejected_rows[0]}")
+        if snapshot_writer is not None:
+            with phases.span("snapshot"):
+                snapshot_writer.add(valid_rows)
+            return
+
+        # Rows already loaded in this run (by previous chunks or other sources) don't reach the DB
+        if table_name in self.deduplicators:
+            with phases.span("dedup"):
+                valid_rows, duplicate_row_count = self.deduplicators[table_name].filter(valid_rows)
+            load_counts["duplicate_row_count"] += duplicate_row_count
+        if not valid_rows:
+            if checkpoint:
+                # Nothing to load, the chunk still moves the checkpoint of the source
+                self.db_conn.run_sql(sql_file_name=UPSERT_SQL_FILENAME, sql_params=checkpoint)
+            return
+
+        # DWH hash keys are loaded with the rows, the merge matches rows by their own fields in the run partition
+        with phases.span("hash_keys"):
+            rows = add_hash_keys(valid_rows, key_indexes=[i for i, _ in model.get_hash_key_fields()])
+        sql_params = self.datalake_merge_params(table_name, staging_table)
+        load_fields = self.datalake_load_fields(table_name)
+        with phases.span("load"):
+            if staging_table:
+                self.db_conn.append_rows(values=set(rows),
+                                         sql_params=sql_params,
+                                         fields=load_fields,
+                                         checkpoint=checkpoint)
+            else:
+                add_merge_counts(load_counts, self.db_conn.load_rows(sql_file_name=DATALAKE_SQL_FILENAME,
+                                                                     values=set(rows),
+                                                                     sql_params=sql_params,
+                                                                     fields=load_fields,
+                                                                     checkpoint=checkpoint))
+        load_counts["inserting_row_count"] += len(valid_rows)
+        self.chunk_size(table_name).observe(parsed_rows, perf_counter() - start_time, payload_bytes(rows))
+
+    @staticmethod
+    def datalake_load_fields(table_name: str) -> list:
+        model = SCHEMA_MAPPING[table_name]
+        return model.get_renamed_field() + [column for _, column in model.get_hash_key_fields()]
+
+    def datalake_merge_params(self, table_name: str, staging_table: str = None) -> dict:
+        return build_params(table_name=table_name,
+                            fields=self.datalake_load_fields(table_name),
+                            key_fields=SCHEMA_MAPPING[table_name].get_merge_key() + [PARTITION_KEY_FIELD],
+                            etl_timestamp=ETL_TIMESTAMP,
+                            load_etl_timestamp=True,
+                            staging_table=staging_table)
+
+    @staticmethod
+    def staging_table(table_name: str, source: str) -> str:
+        # Staging table of a source in "source" staging mode, a resumed run appends to the one of the interrupted run
+        source_key = hashlib.md5(source.encode()).hexdigest()[:8]
+        return f"{DATALAKE_SCHEMA}.{table_name}_staging_{ETL_RUN_ID.lower()}_{source_key}"
+
+    def merge_datalake_staging(self, table_name: str, staging_table: str, load_counts: dict, checkpoint: dict = None):
+        # Single set-based merge of all chunks of a source, committed together with the completed checkpoint
+        sql_params = self.datalake_merge_params(table_name, staging_table)
+        with recorder().span("merge"):
+            add_merge_counts(load_counts, MergeCounts(*self.db_conn.run_sql(sql_file_name=DATALAKE_SQL_FILENAME,
+                                                                            sql_params=sql_params,
+                                                                            return_row=True,
+                                                                            checkpoint=checkpoint)))
+        self.db_conn.run_sql(sql_file_name=DROP_STAGING_SQL_FILENAME, sql_params=sql_params)
+
+    def drop_stale_staging_tables(self):
+        # Checkpointed staging tables are logged and outlive a failed run, they are kept only for partial runs
+        staging_tables = list(self.db_conn.iter_rows(sql_file_name=STALE_STAGING_SQL_FILENAME,
+                                                     sql_params={"schema": DATALAKE_SCHEMA,
+                                                                 "status": RUN_STATUS_PARTIAL}))[1:]
+        for staging_table, in staging_tables:
+            self.db_conn.run_sql(sql_file_name=DROP_STAGING_SQL_FILENAME,
+                                 sql_params={"staging_table": f"{DATALAKE_SCHEMA}.{staging_table}"})
+        logger.info(f"Dropped {len(staging_tables)} staging tables of runs which are not partial")
+
+    def chunk_size(self, table_name: str) -> AdaptiveChunkSize:
+        # Created on first use, so it starts from etl_chunk at the time the table is loaded
+        return self.chunk_sizes.setdefault(table_name,
+                                           AdaptiveChunkSize(initial=self.etl_chunk, adaptive=DATALAKE_CHUNK_ADAPTIVE))
+
+    def checkpoint_params(self,
+                          table_name: str,
+                          source: str,
+                          chunk_number: int,
+                          row_offset: int,
+                          content_hash: str,
+                          status: str) -> dict | None:
+        # Params of upsert.sql writing the checkpoint of a source, None when checkpointing is off
+        if not self.checkpointing:
+            return None
+        return build_params(table_name=CHECKPOINT_TABLE,
+                            values={(ETL_TIMESTAMP, table_name, source, chunk_number, row_offset, content_hash, status,
+                                     datetime.now(timezone.utc))},
+                            fields=CHECKPOINT_FIELDS,
+                            key_fields=MERGE_KEY_CHECKPOINT_FIELDS)
+
+    def committed_rows(self, table_name: str, source: str, checkpoint_key: str = None) -> int:
+        # Parsed rows of a source committed by the interrupted run, they are skipped when the run is resumed.
+        # checkpoint_key is the content hash of the body or, when it is hashed only while loading, its version key
+        checkpoint = self.checkpoints.get((table_name, source))
+        if not checkpoint:
+            return 0
+        # Committed rows are skipped only when the body is known to be the same, otherwise the resumed run would
+        # load a mix of two versions of the source
+        if not checkpoint["content_hash"] or not checkpoint_key:
+            logger.warning(f"Version of '{source}' is unknown, it is loaded from the start")
+            return 0
+        if checkpoint["content_hash"] != checkpoint_key:
+            logger.warning(f"Source '{source}' has changed since the interrupted run, it is loaded from the start")
+            return 0
+        logger.info(f"Resuming '{source}' after chunk {checkpoint['chunk_number']} ({checkpoint['row_offset']} rows)")
+        return checkpoint["row_offset"]
+
+    def load_checkpoints(self):
+        checkpoints = self.db_conn.run_sql(sql_file_name=LOAD_CHECKPOINTS_SQL_FILENAME,
+                                           sql_params=build_params(table_name=CHECKPOINT_TABLE,
+                                                                   etl_timestamp=ETL_TIMESTAMP))
+        # SQLite sink returns the JSON array as text
+        if isinstance(checkpoints, str):
+            checkpoints = json.loads(checkpoints)
+        self.checkpoints = {(checkpoint["table_name"], checkpoint["source"]): checkpoint
+                            for checkpoint in checkpoints or []}
+        logger.info(f"Resuming run '{ETL_RUN_ID}': {len(self.checkpoints)} checkpointed sources")
+
+    def set_run_status(self, status: str):
+        self.db_conn.run_sql(sql_file_name=UPSERT_SQL_FILENAME,
+                             sql_params=build_params(table_name=RUN_STATUS_TABLE,
+                                                     values={(ETL_TIMESTAMP, ETL_RUN_ID, status,
+                                                              datetime.now(timezone.utc))},
+                                                     fields=RUN_STATUS_FIELDS,
+                                                     key_fields=RUN_STATUS_FIELDS[:1]))
+        logger.info(f"Run '{ETL_RUN_ID}' is {status}")
+
+    def iter_datalake_batches(self, blocks, parser, table_name: str):
+        """
+        Parses blocks of lines of a source into chunks of parsed rows, the size of every chunk is the current
+        adaptive chunk size of the table.
+        Yields (rows, None) of every chunk, or (valid rows, rejected rows) of the chunks already validated
+        by the parse pool.
+        """
+        if self.parse_pool is not None:
+            # Segments of the body are parsed and validated by the worker processes,
+            # they are regrouped into the same chunks as in the serial mode below
+            segments = self.parse_pool.iter_parsed(blocks, parser, table_name)
+            yield from iter_validated_chunks(segments, lambda: self.chunk_size(table_name).size)
+            return
+
+        # handling where ads_and_trackers sources return different result size.
+        padding = row_padding(table_name, parser.arity)
+        # TODO: In future can be handled additional comments like in row:
+        #  "0.0.0.0 36c4.net # redirect to go.trafficrouter.io"
+        phases = recorder()
+        chunk_size = self.chunk_size(table_name)
         batch_data = []
+        # Blocks of lines are read lazily from the streamed body, peak memory is bounded by the network chunk
+        for block in blocks:
+            with phases.span("parse"):
+                rows = parser.parse(block)
+                if padding:
+                    rows = [padding + row for row in rows]
+            batch_data.extend(rows)
+
+            while len(batch_data) >= (size := chunk_size.size):
+                # validation rows by schema in models package is done per chunk
+                yield batch_data[:size], None
+                batch_data = batch_data[size:]
+
+        if batch_data:
+            yield batch_data, None
+
+    @build_statistics(schema=DATALAKE_SCHEMA, etl_timestamp=ETL_TIMESTAMP)
+    def populate_datalake(self,
+                          response: requests.Response,
+                          table_name: str,
+                          source: str,
+                          unchanged: bool = False,
+                          source_format: str = None,
+                          content_hash: str = None,
+                          version_key: str = None):
+        load_counts = {"inserting_row_count": 0, "res_row_count": 0, "duplicate_row_count": 0, "removed_row_count": 0,
+                       "inserted_row_count": 0, "updated_row_count": 0, "unchanged_row_count": 0}
+        status = SOURCE_STATUS_LOADED
+        parser = get_parser(source_format=source_format, url=source)
+
+        if unchanged:
+            # Source is the same as in the last loaded run, so parsing and loading are skipped entirely
+            logger.info(f"Source '{source}' is unchanged since the last run...skip")
+            status = SOURCE_STATUS_UNCHANGED
+        elif response.status_code == 200:
+            snapshot_writer = self.snapshots.writer(table_name, source) if self.snapshots else None
+            blocks = iter_response_blocks(response)
+            writer = None
+            if DATALAKE_PIPELINE_ENABLED:
+                # The download runs ahead of parsing in its own thread and chunks are written by another one,
+                # the bounded queues between them block a stage whose consumer falls behind (e.g. a slow DB)
+                blocks = iter_in_thread(blocks, name="blocks")
+                writer = QueueWorker(lambda batch: self.load_datalake_batch(**batch), name="chunks")
+            # Checkpoints keep the content hash of the body, or its version key when the body is hashed while loading
+            checkpoint_key = content_hash or version_key
+            committed_rows = self.committed_rows(table_name, source, checkpoint_key)
+            staging_table = self.staging_table(table_name, source) if self.source_staging else None
+            if staging_table:
+                # Rows staged by the interrupted run are kept only when the source is resumed
+                self.db_conn.run_sql(sql_file_name=SOURCE_STAGING_SQL_FILENAME,
+                                     sql_params={**build_params(table_name=table_name, staging_table=staging_table),
+                                                 "resumed": committed_rows > 0,
+                                                 "unlogged": not self.checkpointing})
+            chunk_number = row_offset = 0
+            try:
+                # Closing the blocks stops the download thread when a later stage fails
+                with closing(blocks), writer or nullcontext():
+                    for batch_data, rejected_rows in self.iter_datalake_batches(blocks, parser, table_name):
+                        chunk_number += 1
+                        row_offset += len(batch_data) + len(rejected_rows or ())
+                        if row_offset <= committed_rows:
+                            # Chunk was committed by the interrupted run which is resumed
+                            continue
+                        batch = dict(table_name=table_name,
+                                     batch_data=batch_data,
+                                     load_counts=load_counts,
+                                     snapshot_writer=snapshot_writer,
+                                     rejected_rows=rejected_rows,
+                                     checkpoint=self.checkpoint_params(table_name, source, chunk_number, row_offset,
+                                                                       checkpoint_key, RUN_STATUS_PARTIAL),
+                                     staging_table=staging_table)
+                        if writer is None:
+                            self.load_datalake_batch(**batch)
+                        else:
+                            writer.put(batch)
+                completed = self.checkpoint_params(table_name, source, chunk_number, row_offset, checkpoint_key,
+                                                   RUN_STATUS_COMPLETED)
+                if staging_table:
+                    self.merge_datalake_staging(table_name, staging_table, load_counts, checkpoint=completed)
+                elif completed:
+                    self.db_conn.run_sql(sql_file_name=UPSERT_SQL_FILENAME, sql_params=completed)
+            except Exception:
+                if snapshot_writer is not None:
+                    snapshot_writer.discard()
+                if staging_table and not self.checkpointing:
+                    # Without checkpoints the staged rows can't be resumed
+                    self.db_conn.run_sql(sql_file_name=DROP_STAGING_SQL_FILENAME,
+                                         sql_params=build_params(table_name=table_name, staging_table=staging_table))
+                raise
 
-        if response.status_code == 200:
-            lines = response.text.split("\n")
-            pattern = matcher(url=source)
-            fields = SCHEMA_MAPPING[table_name].get_field()
-            for line in lines:
-                parts = None
-                if pattern and re.search(pattern, line):
-                    parts = re.search(pattern, line).groups()
-                elif not pattern and line.strip() and not line.strip().startswith("#"):  # Skip comments and empty lines
-                    parts = tuple(line.split()[:2])
-
-                if parts:
-                    # handling where ads_and_trackers sources return different result size.
-                    if len(parts) != len(fields):
-                        parts = ('',) + parts
-                    # TODO: In future can be handled additional comments like in row:
-                    #  "0.0.0.0 36c4.net # redirect to go.trafficrouter.io"
-
-                    # validation row by schema in models package
-                    parts = tuple(
-                        i for i in (
-                            SCHEMA_MAPPING[table_name].validate_row(
-                                dict(zip(fields, parts))
-                            )
-                        ).values()
-                    )
-                    # parts.append(url_source)
-                    batch_data.append(parts)
-                    len_batch_data = len(batch_data)
-                    if len_batch_data >= self.etl_chunk:
-                        inserting_row_count += len_batch_data
-                        res_row_count = (
-                            self.db_conn.run_sql(sql_file_name=DATALAKE_SQL_FILENAME,
-                                                 sql_params=build_params(table_name=table_name,
-                                                                         values=set(batch_data),
-                                                                         fields=fields,
-                                                                         etl_timestamp=ETL_TIMESTAMP))
-                        )
-                        batch_data = []
-
-            if batch_data:
-                inserting_row_count += len(batch_data)
-                res_row_count = (
-                    self.db_conn.run_sql(sql_file_name=DATALAKE_SQL_FILENAME,
-                                         sql_params=build_params(table_name=table_name,
-                                                                 values=set(batch_data),
-                                                                 fields=fields,
-                                                                 etl_timestamp=ETL_TIMESTAMP))
-                )
+            if snapshot_writer is not None:
+                snapshot_writer.finish()
+                self.snapshots.mark_written(table_name, source)
+                load_counts["duplicate_row_count"] = snapshot_writer.duplicate_row_count
+            elif load_counts["inserting_row_count"]:
+                load_counts["res_row_count"] = self.checked_row_count(DATALAKE_SCHEMA, table_name,
+                                                                      load_counts["res_row_count"])
+            recorder().count("lines_read", parser.lines_read)
+            logger.info(f"Parsed '{source}' as '{parser.format}': {parser.lines_read} lines, "
+                        f"{parser.rows_parsed} rows, {parser.lines_per_sec} lines/sec, "
+                        f"{load_counts['duplicate_row_count']} duplicates, "
+                        f"chunk size {self.chunk_size(table_name).size} rows")
         else:
             logger.error(f"Failed to retrieve data: {response}")
+            status = SOURCE_STATUS_FAILED
 
-        return table_name, source, inserting_row_count, res_row_count
+        return DatalakeStatisticsRow(table_name=table_name,
+                                     source=source,
+                                     status=status,
+                                     parse_lines_per_sec=parser.lines_per_sec,
+                                     **load_counts)
+
+    @build_statistics(schema=DATALAKE_SCHEMA, etl_timestamp=ETL_TIMESTAMP)
+    def populate_datalake_delta(self, table_name: str, sources: list):
+        # Loads rows added to or removed from the union of the table sources since the previous run (diff load mode)
+        load_counts = {"inserting_row_count": 0, "res_row_count": 0, "removed_row_count": 0,
+                       "inserted_row_count": 0, "updated_row_count": 0, "unchanged_row_count": 0}
+        model = SCHEMA_MAPPING[table_name]
+        hash_key_fields = model.get_hash_key_fields()
+        key_indexes = [i for i, _ in hash_key_fields]
+        fields = model.get_renamed_field() + [REMOVED_MARKER_FIELD] + [column for _, column in hash_key_fields]
+        sql_params = build_params(table_name=table_name,
+                                  fields=fields,
+                                  key_fields=model.get_merge_key() + [PARTITION_KEY_FIELD],
+                                  etl_timestamp=ETL_TIMESTAMP,
+                                  load_etl_timestamp=True)
+
+        phases = recorder()
+        chunk_size = self.chunk_size(table_name)
+
+        def load(batch: list):
+            phases.count("chunk_count")
+            start_time = perf_counter()
+            rows = add_hash_keys(batch, key_indexes)
+            with phases.span("load"):
+                add_merge_counts(load_counts, self.db_conn.load_rows(sql_file_name=DATALAKE_SQL_FILENAME,
+                                                                     values=rows,
+                                                                     sql_params=sql_params,
+                                                                     fields=fields))
+            chunk_size.observe(len(batch), perf_counter() - start_time, payload_bytes(rows))
+
+        batch_data = []
+        for row, is_removed in self.snapshots.diff(table_name, sources):
+            batch_data.append(row + (is_removed,))
+            load_counts["removed_row_count" if is_removed else "inserting_row_count"] += 1
+            if len(batch_data) >= chunk_size.size:
+                load(batch_data)
+                batch_data = []
+        if batch_data:
+            load(batch_data)
+
+        if load_counts["inserting_row_count"] or load_counts["removed_row_count"]:
+            load_counts["res_row_count"] = self.checked_row_count(DATALAKE_SCHEMA, table_name,
+                                                                  load_counts["res_row_count"])
+        # Snapshots become the previous ones only when the delta is loaded
+        self.snapshots.commit(table_name, sources)
+        logger.info(f"Delta of '{table_name}': {load_counts['inserting_row_count']} added, "
+                    f"{load_counts['removed_row_count']} removed rows")
+
+        return DatalakeStatisticsRow(table_name=table_name,
+                                     source=DELTA_SOURCE,
+                                     status=SOURCE_STATUS_LOADED,
+                                     parse_lines_per_sec=0.0,
+                                     duplicate_row_count=0,
+                                     **load_counts)
 
     @build_statistics(schema=DWH_SCHEMA, etl_timestamp=ETL_TIMESTAMP, statistics_sql=BUILD_DWH_STATISTICS_TABLE)
     def populate_dwh(self, table: str, schema: str = DWH_SCHEMA):
-        res_row_count = (
-            self.db_conn.run_sql(sql_file_name=table,
-                                 sql_folder_path=DWH_SQL_FOLDER_PATH,
-                                 sql_params=build_params(table_name=table,
-                                                         schema=schema,
-                                                         etl_timestamp=ETL_TIMESTAMP))
-        )
-        return table, res_row_count
+        with recorder().span("load"):
+            merge_counts = MergeCounts(
+                *self.db_conn.run_sql(sql_file_name=table,
+                                      sql_folder_path=DWH_SQL_FOLDER_PATH,
+                                      sql_params=build_params(table_name=table,
+                                                              schema=schema,
+                                                              etl_timestamp=ETL_TIMESTAMP),
+                                      return_row=True)
+            )
+        return (table,
+                self.checked_row_count(schema, table, merge_counts.res_row_count),
+                merge_counts.inserted_row_count,
+                merge_counts.updated_row_count,
+                merge_counts.unchanged_row_count,
+                merge_counts.deleted_row_count)
+
+    def checked_row_count(self, schema: str, table_name: str, estimated_row_count: int) -> int:
+        # Sampled exact check of the estimated rows of a table after its merges, the exact count replaces the estimate
+        if random.random() >= ROW_COUNT_EXACT_SAMPLE_RATE:
+            return estimated_row_count
+        with recorder().span("row_count"):
+            row_count = self.db_conn.run_sql(sql_file_name=ROW_COUNT_SQL_FILENAME,
+                                             sql_params=build_params(table_name=table_name, schema=schema))
+        logger.info(f"Rows of '{schema}.{table_name}': {row_count}, "
+                    f"estimated {estimated_row_count} ({estimated_row_count - row_count:+d})")
+        return row_count
+
+    def populate_and_land(self,
+                          response,
+                          table_name: str,
+                          url: str,
+                          unchanged: bool = False,
+                          source_format: str = None,
+                          content_hash: str = None,
+                          version_key: str = None):
+        """
+        Populates the datalake from a fetched response and stores its body in the landing zone while it is read.
+        The body of an unchanged source was landed by an earlier run and is referenced by its content hash.
+        A body read to the end is landed even when loading it fails, so the failure can be replayed.
+        """
+        landed = None
+        if self.landing is not None and response.status_code == 200 and not unchanged:
+            landed = self.landing.tee(response)
+        try:
+            return self.populate_datalake(response=landed or response,
+                                          table_name=table_name,
+                                          source=url,
+                                          unchanged=unchanged,
+                                          source_format=source_format,
+                                          content_hash=content_hash,
+                                          version_key=version_key)
+        finally:
+            if landed is not None and landed.complete:
+                self.landing.add_source(table_name, url, source_format, landed.commit(), encoding=landed.encoding)
+            elif landed is not None:
+                landed.discard()
+            elif self.landing is not None and unchanged:
+                if content_hash is None and self.fetch_cache:
+                    content_hash = self.fetch_cache.get(url).get("content_hash")
+                self.landing.add_source(table_name, url, source_format, content_hash, encoding=response.encoding)
+
+    def replay_and_populate_datalake(self, table_name: str, url: str):
+        # Populates the datalake from the landed body of a source of the replayed run, without network
+        source = self.replay_sources[(table_name, url)]
+        with recording(), self.landing.open(source) as response:
+            return self.populate_datalake(response=response,
+                                          table_name=table_name,
+                                          source=url,
+                                          source_format=source["source_format"],
+                                          content_hash=source["content_hash"])
+
+    def fetch_and_populate_datalake(self,
+                                    table_name: str,
+                                    url: str,
+                                    host_limit: threading.Semaphore,
+                                    source_format: str = None):
+        # In diff load mode a source can be skipped only when its previous snapshot exists
+        cacheable = bool(self.fetch_cache) and (not self.snapshots or self.snapshots.has_snapshot(table_name, url))
+        headers = self.fetch_cache.conditional_headers(url) if cacheable else None
+        # Per-host limit is held for the whole streamed read, as the body is consumed while populating.
+        # Recording starts here, so the download of a spooled body is a phase of the source.
+        with host_limit, recording():
+            with self.http_session.get(url, stream=True, timeout=FETCH_TIMEOUT_SEC, headers=headers) as response:
+                # Known before the body is read, so a source can be resumed when its body is not hashed up front
+                version_key = FetchCache.version_key(response) if response.status_code == 200 else None
+                if not self.fetch_cache or response.status_code != 200:
+                    return self.populate_and_land(response=response,
+                                                  table_name=table_name,
+                                                  url=url,
+                                                  unchanged=response.status_code == HTTPStatus.NOT_MODIFIED,
+                                                  source_format=source_format,
+                                                  version_key=version_key)
+
+                if FETCH_CACHE_SPOOL:
+                    # Body is hashed before parsing, so a source with identical content is not parsed or loaded again
+                    spooled_response, content_hash = FetchCache.spool(response)
+                    unchanged = cacheable and self.fetch_cache.is_unchanged(url, content_hash)
+                    with spooled_response:
+                        result = self.populate_and_land(response=spooled_response,
+                                                        table_name=table_name,
+                                                        url=url,
+                                                        unchanged=unchanged,
+                                                        source_format=source_format,
+                                                        content_hash=content_hash)
+                else:
+                    # Body is hashed while it streams through the parser, its hash is known only after the load
+                    hashing_response = HashingResponse(response)
+                    result = self.populate_and_land(response=hashing_response,
+                                                    table_name=table_name,
+                                                    url=url,
+                                                    source_format=source_format,
+                                                    version_key=version_key)
+                    content_hash = hashing_response.content_hash
+                if result.status != SOURCE_STATUS_FAILED and content_hash:
+                    self.fetch_cache.update(url, response, content_hash)
+                return result
+
+    def build_datalake_source(self,
+                              table_name: str,
+                              url: str,
+                              host_limit: threading.Semaphore,
+                              source_format: str = None):
+        checkpoint = self.checkpoints.get((table_name, url))
+        if checkpoint and checkpoint["status"] == RUN_STATUS_COMPLETED:
+            logger.info(f"Source '{url}' was loaded by the interrupted run...skip")
+            return None
+        with self.profiled(self.etl_2_build_datalake.__name__, DATALAKE_SCHEMA, (table_name, url)):
+            if self.replay_run:
+                return self.replay_and_populate_datalake(table_name=table_name, url=url)
+            return self.fetch_and_populate_datalake(table_name=table_name,
+                                                    url=url,
+                                                    host_limit=host_limit,
+                                                    source_format=source_format)
+
+    def create_datalake_partition(self, table_name: str):
+        # Partition of the run is created up front, so the concurrent loaders of the table only insert into it
+        self.db_conn.run_sql(sql_file_name=PARTITION_SQL_FILENAME,
+                             sql_params={**build_params(table_name=table_name, etl_timestamp=ETL_TIMESTAMP),
+                                         "partition_interval": DATALAKE_PARTITION_INTERVAL})
+
+    def drop_datalake_partitions(self):
+        # Partitions older than the last DATALAKE_PARTITION_RETENTION_RUNS completed runs, the DWH is built from them.
+        # In diff load mode a partition holds only the churn of its run, the rows loaded first are never loaded again
+        if DATALAKE_PARTITION_RETENTION_RUNS <= 0 or self.snapshots:
+            return
+        for table_name in SCHEMA_MAPPING:
+            dropped = self.db_conn.run_sql(sql_file_name=DROP_PARTITIONS_SQL_FILENAME,
+                                           sql_params={**build_params(table_name=table_name),
+                                                       "retention_runs": DATALAKE_PARTITION_RETENTION_RUNS,
+                                                       "status": RUN_STATUS_COMPLETED,
+                                                       "loaded_status": SOURCE_STATUS_LOADED})
+            logger.info(f"Dropped {dropped} old partitions of '{DATALAKE_SCHEMA}.{table_name}'")
 
     def etl_2_build_datalake(self):
         logger.info(f"Run ETL 2:'{self.etl_2_build_datalake.__name__}'")
-        for url_source, url in self.datalake_configs:
-            response = requests.get(url)
-            self.populate_datalake(response=response, table_name=url_source, source=url)
+        if self.replay_run:
+            # Sources of a replayed run and their bodies are read from its landing manifest instead of etl_conf.json
+            self.replay_sources = {(source["table_name"], source["url"]): source
+                                   for source in self.landing.read_manifest(self.replay_run)}
+            sources = [(table_name, url, source["source_format"])
+                       for (table_name, url), source in self.replay_sources.items()]
+            logger.info(f"Replaying {len(sources)} sources of run '{self.replay_run}' from the landing zone")
+        else:
+            sources = [(url_source, *parse_source_conf(source_conf))
+                       for url_source, source_conf in self.datalake_configs]
+        for table_name in dict.fromkeys(url_source for url_source, _, _ in sources):
+            self.create_datalake_partition(table_name=table_name)
+        if ETL_RESUME_RUN and self.checkpointing:
+            self.load_checkpoints()
+        host_limits = {
+            urlparse(url).netloc: threading.BoundedSemaphore(FETCH_MAX_PER_HOST) for _, url, _ in sources
+        }
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS, thread_name_prefix="fetch") as executor:
+            futures = {
+                executor.submit(self.build_datalake_source,
+                                table_name=url_source,
+                                url=url,
+                                host_limit=host_limits[urlparse(url).netloc],
+                                source_format=source_format): url
+                for url_source, url, source_format in sources
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Failed to populate datalake from '{futures[future]}': {e}")
+                    errors.append(e)
+
+        # Spilled digests are only needed while the stage runs
+        for deduplicator in self.deduplicators.values():
+            deduplicator.close()
+
+        if self.snapshots:
+            for table_name in dict.fromkeys(url_source for url_source, _, _ in sources):
+                self.populate_datalake_delta(table_name=table_name,
+                                             sources=[url for url_source, url, _ in sources if url_source == table_name])
+
+        if self.landing is not None and not self.replay_run:
+            self.landing.write_manifest()
+
+        if errors:
+            raise errors[0]
         logger.info(f"Finish ETL 2:'{self.etl_2_build_datalake.__name__}'")
 
-    def clear_dwh(self):
-        logger.info("Clearing DWH table to avoid violates foreign key constraint...")
-        self.db_conn.run_sql(sql_file_name=CLEAR_DWH_SQL_FILE,
+    def build_dwh_delta(self):
+        logger.info("Building DWH delta from datalake...")
+        self.db_conn.run_sql(sql_file_name=DWH_DELTA_SQL_FILE,
                              sql_folder_path=DWH_SQL_FOLDER_PATH)
-        logger.info("DWH is cleared...")
+        logger.info("DWH delta is built...")
+
+    def build_dwh_table(self, table: str, schema: str = DWH_SCHEMA):
+        with self.profiled(self.etl_3_build_dwh.__name__, DWH_SCHEMA, (table,)):
+            return self.populate_dwh(table=table, schema=schema)
 
     def etl_3_build_dwh(self):
         logger.info(f"Run ETL 3:'{self.etl_3_build_dwh.__name__}'")
-        self.clear_dwh()
-        for schema, table in self.dwh_configs:
-            self.populate_dwh(table=table, schema=schema)
+        self.build_dwh_delta()
+
+        schemas = {}
+        dependencies = {}
+        for schema, table_conf in self.dwh_configs:
+            table, depends_on = parse_dwh_table_conf(table_conf, previous_tables=list(dependencies))
+            schemas[table] = schema
+            dependencies[table] = depends_on
+
+        # Independent tables (e.g. both mapping tables) are built concurrently, dependents start when all
+        # their dependencies are built and are skipped when any of them fails
+        run_dag(dependencies=dependencies,
+                run=lambda table: self.build_dwh_table(table=table, schema=schemas[table]),
+                max_workers=DWH_MAX_WORKERS,
+                logger=logger)
         logger.info(f"Finish ETL 3:'{self.etl_3_build_dwh.__name__}'")
 
+    def export_tables(self) -> list:
+        # (schema, table) of every table with rows of the run: datalake, DWH and the statistics of both stages
+        dwh_tables = []
+        for schema, table_conf in parse_etl_configs(DWH_CONF, stage='dwh'):
+            table, _ = parse_dwh_table_conf(table_conf, previous_tables=[table for _, table in dwh_tables])
+            dwh_tables.append((schema, table))
+        return [
+            *((DATALAKE_SCHEMA, table_name) for table_name in SCHEMA_MAPPING),
+            (DATALAKE_SCHEMA, BUILD_DATALAKE_STATISTICS_TABLE),
+            (DATALAKE_SCHEMA, PHASE_STATISTICS_TABLE_MAPPING[DATALAKE_SCHEMA]),
+            *dwh_tables,
+            (DWH_SCHEMA, BUILD_DWH_STATISTICS_TABLE),
+            (DWH_SCHEMA, PHASE_STATISTICS_TABLE_MAPPING[DWH_SCHEMA]),
+        ]
+
     def data_flow(self):
         logger.info("...Run ETL flow...")
         # Handling DB schema. Updates can be added in the file: .etl/sql/db_schema.sql.
         # Can be replaced with e.g. Alembic
         self.etl_1_build_schema()
+        # Run stays partial when it fails, until it is resumed ('--resume') to the end
+        self.set_run_status(RUN_STATUS_PARTIAL)
+        self.drop_stale_staging_tables()
 
         self.etl_2_build_datalake()
 
         self.etl_3_build_dwh()
+        self.set_run_status(RUN_STATUS_COMPLETED)
+        self.drop_datalake_partitions()
+        self.db_conn.export_run(self.export_tables())
 
+        logger.info(f"DB connection pool metrics: {self.db_conn.pool_metrics()}")
+        self.db_conn.close()
+        if self.parse_pool:
+            self.parse_pool.close()
+        if self.profiler:
+            self.profiler.close()
         logger.info("...Finish ETL flow...")
 
 
 if __name__ == "__main__":
-    RunETl().data_flow()
+    parser = argparse.ArgumentParser(description="Runs the ETL flow: DB schema, datalake and DWH")
+    parser.add_argument("--profile", action="store_true", default=PROFILING_ENABLED,
+                        help="profile every stage with cProfile and tracemalloc (also PROFILING_ENABLED=1)")
+    parser.add_argument("--replay", metavar="RUN_ID",
+                        help="load the datalake from the landing zone of a previous run instead of the sources")
+    parser.add_argument("--resume", metavar="RUN_ID", nargs="?", const="last",
+                        help="continue an interrupted run from its last committed chunks (the latest partial one "
+                             "without RUN_ID)")
+    parser.add_argument("--sink", choices=ETL_SINKS, default=ETL_SINK,
+                        help="target of the loads: the Postgres service or an embedded SQLite DB (also ETL_SINK)")
+    args = parser.parse_args()
+    if args.resume and not ETL_RESUME_RUN:
+        resume_run = args.resume if args.resume != "last" else RunETl.build_sink(args.sink).run_sql(
+            sql_file_name=LAST_PARTIAL_RUN_SQL_FILENAME, sql_params={"status": RUN_STATUS_PARTIAL}
+        )
+        if not resume_run:
+            parser.error("There is no partial run to resume")
+        # Run timestamp is fixed when constants are imported, so the flow is started again with the resumed one
+        os.execve(sys.executable, [sys.executable, *sys.argv], {**os.environ, "ETL_RESUME_RUN": resume_run})
+    RunETl(profile=args.profile, replay_run=args.replay, sink=args.sink).data_flow()
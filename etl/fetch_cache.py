@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import tempfile
+import logging
+
+import requests
+
+from utils import get_logger
+from instrumentation import recorder
+from constants import FETCH_CACHE_DIR, FETCH_SPOOL_MAX_MEMORY_BYTES, STREAM_CHUNK_SIZE_BYTES
+
+
+class SpooledResponse:
+    """
+    Minimal stand-in for requests.Response which replays a body already spooled by FetchCache.
+    Exposes only what populate_datalake reads from a response.
+    """
+    def __init__(self, response: requests.Response, spool):
+        self.status_code = response.status_code
+        self.encoding = response.encoding
+        self.url = response.url
+        self._spool = spool
+
+    def iter_content(self, chunk_size: int = STREAM_CHUNK_SIZE_BYTES):
+        self._spool.seek(0)
+        while chunk := self._spool.read(chunk_size):
+            yield chunk
+
+    def close(self):
+        self._spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HashingResponse:
+    """
+    Wrapper of a fetched response which hashes its body while populate_datalake streams it.
+    content_hash is set when the body is read to the end.
+    """
+    def __init__(self, response: requests.Response):
+        self.status_code = response.status_code
+        self.encoding = response.encoding
+        self.url = response.url
+        self._response = response
+        self._digest = hashlib.sha256()
+        self.content_hash = None
+
+    def iter_content(self, chunk_size: int = STREAM_CHUNK_SIZE_BYTES):
+        for chunk in self._response.iter_content(chunk_size=chunk_size):
+            self._digest.update(chunk)
+            yield chunk
+        self.content_hash = self._digest.hexdigest()
+
+
+class FetchCache:
+    """
+    On-disk cache of fetched sources keyed by URL.
+    Every entry keeps ETag/Last-Modified of the last loaded response and SHA-256 of its body.
+    """
+    def __init__(self, cache_dir: str = FETCH_CACHE_DIR, logger: logging.Logger = get_logger()):
+        self.cache_dir = cache_dir
+        self.logger = logger
+
+    def _entry_path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, f"{hashlib.sha256(url.encode()).hexdigest()}.json")
+
+    def get(self, url: str) -> dict:
+        try:
+            with open(self._entry_path(url), 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def conditional_headers(self, url: str) -> dict:
+        entry = self.get(url)
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def is_unchanged(self, url: str, content_hash: str) -> bool:
+        return self.get(url).get("content_hash") == content_hash
+
+    def update(self, url: str, response: requests.Response, content_hash: str):
+        entry = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_hash": content_hash,
+        }
+        # Write to a temp file and rename, so an interrupted run never leaves a broken entry behind
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._entry_path(url)
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, delete=False, suffix=".tmp") as file:
+            json.dump(entry, file)
+        os.replace(file.name, path)
+        self.logger.info(f"Fetch cache updated for '{url}'")
+
+    @staticmethod
+    def version_key(response: requests.Response) -> str | None:
+        # Key of the body version from the validators of a response, known before its body is read.
+        # A weak ETag doesn't promise the same bytes and Content-Length alone can't tell two bodies apart,
+        # so a response without a strong ETag or Last-Modified has no version key
+        etag = response.headers.get("ETag")
+        if etag and etag.startswith("W/"):
+            etag = None
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return None
+        validators = json.dumps([etag, last_modified, response.headers.get("Content-Length")])
+        return f"version:{hashlib.sha256(validators.encode()).hexdigest()}"
+
+    @staticmethod
+    def spool(response: requests.Response, max_memory: int = FETCH_SPOOL_MAX_MEMORY_BYTES):
+        # Read the streamed body once, hashing it on the way, without holding more than max_memory in RAM
+        spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        digest = hashlib.sha256()
+        # Bytes are counted when the spooled body is read by populate_datalake
+        with recorder().span("download"):
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE_BYTES):
+                digest.update(chunk)
+                spool.write(chunk)
+        return SpooledResponse(response, spool), digest.hexdigest()
@@ -0,0 +1,143 @@
+import math
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+from constants import INSTRUMENTATION_ENABLED
+
+PHASE_TOTAL = "total"
+# Counters recorded per unit of work (a datalake source or a DWH table), stored in the 'total' phase row
+COUNTERS = ("bytes_downloaded", "lines_read", "rows_rejected", "chunk_count")
+
+_local = threading.local()
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    # Nearest-rank percentile of already sorted values
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+class Recorder:
+    """
+    Wall time, CPU time (of the recording thread) and durations of every call of the phases of one unit of work,
+    plus its counters. Phases are recorded with span(), which can be entered many times (e.g. once per chunk).
+    Helper threads of the unit (e.g. stages of the datalake pipeline) record into it with attached().
+    """
+    enabled = True
+
+    def __init__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        self.durations = {}
+        self.cpu_times = Counter()
+        self.counters = Counter()
+        self.max_depths = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase: str):
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_wall
+            cpu_time = time.thread_time() - start_cpu
+            with self._lock:
+                self.durations.setdefault(phase, []).append(duration)
+                self.cpu_times[phase] += cpu_time
+
+    def count(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def depth(self, phase: str, value: int):
+        # Queue depth seen by a phase, its maximum is stored in the row of the phase
+        with self._lock:
+            self.max_depths[phase] = max(self.max_depths.get(phase, 0), value)
+
+    def phase_rows(self) -> list:
+        """
+        Returns (phase, calls, wall_time_sec, cpu_time_sec, p50_time_ms, p95_time_ms, max_queue_depth, *COUNTERS)
+        rows: one per recorded phase and the 'total' row of the whole unit with the counters.
+        """
+        rows = []
+        with self._lock:
+            phase_durations = list(self.durations.items())
+        for phase, durations in phase_durations:
+            durations = sorted(durations)
+            rows.append((phase,
+                         len(durations),
+                         round(sum(durations), 6),
+                         round(self.cpu_times[phase], 6),
+                         round(percentile(durations, 0.50) * 1000, 3),
+                         round(percentile(durations, 0.95) * 1000, 3),
+                         self.max_depths.get(phase),
+                         *(None for _ in COUNTERS)))
+        rows.append((PHASE_TOTAL,
+                     1,
+                     round(time.perf_counter() - self.start_wall, 6),
+                     round(time.thread_time() - self.start_cpu, 6),
+                     None,
+                     None,
+                     None,
+                     *(self.counters[counter] for counter in COUNTERS)))
+        return rows
+
+
+class NullRecorder:
+    # Recorder used when instrumentation is disabled: spans and counters are no-ops
+    enabled = False
+    _span = nullcontext()
+
+    def span(self, phase: str):
+        return self._span
+
+    def count(self, counter: str, value: int = 1):
+        pass
+
+    def depth(self, phase: str, value: int):
+        pass
+
+    def phase_rows(self) -> list:
+        return []
+
+
+NULL_RECORDER = NullRecorder()
+
+
+def recorder():
+    # Recorder of the unit of work running in the current thread
+    return getattr(_local, "recorder", NULL_RECORDER)
+
+
+@contextmanager
+def recording(enabled: bool = INSTRUMENTATION_ENABLED):
+    """
+    Starts recording a unit of work in the current thread. A nested recording (e.g. build_statistics of
+    populate_datalake inside fetch_and_populate_datalake) joins the outer one, so phases recorded before
+    the decorated call are kept.
+    """
+    current = getattr(_local, "recorder", None)
+    if current is not None or not enabled:
+        yield current or NULL_RECORDER
+        return
+
+    _local.recorder = Recorder()
+    try:
+        yield _local.recorder
+    finally:
+        del _local.recorder
+
+
+@contextmanager
+def attached(unit_recorder):
+    # Records phases of the current (helper) thread into the recorder of a unit of work started in another thread
+    _local.recorder = unit_recorder
+    try:
+        yield unit_recorder
+    finally:
+        del _local.recorder
@@ -0,0 +1,148 @@
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+import logging
+import threading
+
+import requests
+
+from utils import get_logger
+from constants import (
+    ETL_TIMESTAMP,
+    ETL_RUN_ID,
+    LANDING_DIR,
+    LANDING_COMPRESS_LEVEL,
+    STREAM_CHUNK_SIZE_BYTES,
+)
+
+
+class LandingResponse:
+    """
+    Wrapper of a fetched response which stores its body in the landing zone while populate_datalake reads it.
+    The body is gzip compressed into a temporary file and hashed on the way, commit() moves it to its
+    content-addressed path.
+    """
+    def __init__(self, response: requests.Response, landing: "LandingZone"):
+        self.status_code = response.status_code
+        self.encoding = response.encoding
+        self.url = response.url
+        self._response = response
+        self._landing = landing
+        self._digest = hashlib.sha256()
+        # Set when the body is read to the end, only a complete body is committed
+        self.complete = False
+        os.makedirs(landing.objects_dir, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=landing.objects_dir, delete=False, suffix=".tmp")
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=landing.compress_level)
+
+    def iter_content(self, chunk_size: int = STREAM_CHUNK_SIZE_BYTES):
+        for chunk in self._response.iter_content(chunk_size=chunk_size):
+            self._digest.update(chunk)
+            self._gzip.write(chunk)
+            yield chunk
+        self.complete = True
+
+    def commit(self) -> str:
+        # Returns the content hash of the body, a body already in the landing zone is stored once
+        self._gzip.close()
+        self._file.close()
+        content_hash = self._digest.hexdigest()
+        path = self._landing.object_path(content_hash)
+        if os.path.exists(path):
+            os.remove(self._file.name)
+        else:
+            os.replace(self._file.name, path)
+        return content_hash
+
+    def discard(self):
+        self._gzip.close()
+        self._file.close()
+        os.remove(self._file.name)
+
+
+class ReplayResponse:
+    # Stand-in for requests.Response streaming a landed body with decompression, see SpooledResponse
+    def __init__(self, path: str, encoding: str = None, url: str = None):
+        self.status_code = 200
+        self.encoding = encoding
+        self.url = url
+        self._file = gzip.open(path, "rb")
+
+    def iter_content(self, chunk_size: int = STREAM_CHUNK_SIZE_BYTES):
+        while chunk := self._file.read(chunk_size):
+            yield chunk
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LandingZone:
+    """
+    Raw landing zone of fetched sources: bodies are stored gzip compressed under their SHA-256
+    ('objects/<hash>.gz', the content hash of FetchCache), so a body unchanged between runs is stored once.
+    A manifest per run ('manifests/<run id>.json') lists the sources loaded by the run and their bodies,
+    a run is replayed from it without network.
+    """
+    def __init__(self,
+                 landing_dir: str = LANDING_DIR,
+                 compress_level: int = LANDING_COMPRESS_LEVEL,
+                 logger: logging.Logger = get_logger()):
+        self.objects_dir = os.path.join(landing_dir, "objects")
+        self.manifests_dir = os.path.join(landing_dir, "manifests")
+        self.compress_level = compress_level
+        self.logger = logger
+        self._sources = []
+        self._lock = threading.Lock()
+
+    def object_path(self, content_hash: str) -> str:
+        return os.path.join(self.objects_dir, f"{content_hash}.gz")
+
+    def manifest_path(self, run_id: str) -> str:
+        return os.path.join(self.manifests_dir, f"{run_id}.json")
+
+    def tee(self, response: requests.Response) -> LandingResponse:
+        return LandingResponse(response, self)
+
+    def add_source(self, table_name: str, url: str, source_format: str, content_hash: str, encoding: str = None):
+        # Sources of the run manifest, a source without a landed body (e.g. not modified since a run before
+        # the landing zone was enabled) can't be replayed
+        if not content_hash or not os.path.exists(self.object_path(content_hash)):
+            self.logger.warning(f"Body of '{url}' is not in the landing zone, the source can't be replayed")
+            return
+        with self._lock:
+            self._sources.append({
+                "table_name": table_name,
+                "url": url,
+                "source_format": source_format,
+                "content_hash": content_hash,
+                "encoding": encoding,
+            })
+
+    def write_manifest(self, run_id: str = ETL_RUN_ID):
+        manifest = {"etl_timestamp": ETL_TIMESTAMP.isoformat(), "sources": self._sources}
+        # Write to a temp file and rename, so an interrupted run never leaves a broken manifest behind
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=self.manifests_dir, delete=False, suffix=".tmp") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(file.name, self.manifest_path(run_id))
+        self.logger.info(f"Landing manifest of {len(self._sources)} sources is written for run '{run_id}'")
+
+    def read_manifest(self, run_id: str) -> list:
+        try:
+            with open(self.manifest_path(run_id), 'r') as file:
+                return json.load(file)["sources"]
+        except FileNotFoundError:
+            runs = sorted(name[:-len(".json")] for name in os.listdir(self.manifests_dir)) \
+                if os.path.isdir(self.manifests_dir) else []
+            raise ValueError(f"No landing manifest of run '{run_id}', landed runs: {', '.join(runs) or 'none'}")
+
+    def open(self, source: dict) -> ReplayResponse:
+        return ReplayResponse(self.object_path(source["content_hash"]), encoding=source["encoding"], url=source["url"])
@@ -1,5 +1,8 @@
 from dataclasses import dataclass, fields, field
 
+# Row validators generated once per model class, see BaseObject.get_row_validator
+_ROW_VALIDATORS = {}
+
 
 @dataclass
 class BaseObject:
@@ -23,6 +26,16 @@ class BaseObject:
             for fld in fields(cls)
         }
 
+    @classmethod
+    def get_merge_key(cls) -> list:
+        # Natural key of a row within a run: all model fields, derived columns (hash keys, is_removed) are updated
+        return cls.get_renamed_field()
+
+    @classmethod
+    def get_hash_key_fields(cls) -> list:
+        # (index of the field in a row, hash key column) of fields declared with field(metadata={"hash_key": ...})
+        return [(i, fld.metadata['hash_key']) for i, fld in enumerate(fields(cls)) if fld.metadata.get('hash_key')]
+
     @classmethod
     def validate_row(cls, obj: dict):
         try:
@@ -34,6 +47,56 @@ class BaseObject:
             print(f'Mismatching: Error("{e}") while parsing "{cls.__name__}"')
             raise e
 
+    @classmethod
+    def get_row_validator(cls):
+        """
+        Returns a validator of a plain row tuple (in field order), generated and compiled once per model.
+        It applies the same checks as __post_init__ (arity and types) without creating a dataclass object
+        and returns the row as is: its values are already in the order of get_renamed_field().
+        """
+        validator = _ROW_VALIDATORS.get(cls)
+        if validator is not None:
+            return validator
+
+        model_fields = fields(cls)
+        namespace = {f"_type_{i}": fld.type for i, fld in enumerate(model_fields)}
+        row_vars = [f"_v{i}" for i in range(len(model_fields))]
+        lines = [
+            "def validate(row):",
+            f"    if len(row) != {len(model_fields)}:",
+            f"        raise TypeError(f\"'{cls.__name__}' expects {len(model_fields)} fields "
+            f"({', '.join(cls.get_field())}) but has gotten {{len(row)}}\")",
+            f"    {', '.join(row_vars)}, = row",
+        ]
+        for i, fld in enumerate(model_fields):
+            lines += [
+                f"    if _v{i} is not None and not isinstance(_v{i}, _type_{i}):",
+                f"        raise TypeError(f\"Invalid data type for '{fld.name}': \"",
+                f"                        f\"Must be '{fld.type.__name__}' type \"",
+                f"                        f\"but has gotten '{{type(_v{i})}}' type.\")",
+            ]
+        lines.append("    return row")
+
+        exec("\n".join(lines), namespace)
+        validator = _ROW_VALIDATORS[cls] = namespace["validate"]
+        return validator
+
+    @classmethod
+    def validate_rows(cls, rows: list) -> tuple:
+        """
+        Validates a whole chunk of row tuples in one call.
+        Returns valid rows and rejected (row, error) pairs instead of raising on the first bad row.
+        """
+        validator = cls.get_row_validator()
+        valid_rows = []
+        rejected_rows = []
+        for row in rows:
+            try:
+                valid_rows.append(validator(row))
+            except TypeError as e:
+                rejected_rows.append((row, str(e)))
+        return valid_rows, rejected_rows
+
     def __post_init__(self):
         # __post_init__ will be run where cls(**obj) will be called
         for fld in fields(self):
@@ -52,10 +115,11 @@ class BaseObject:
 class AdsAndTrackers(BaseObject):
     # For renaming fields use field(metadata={"renamed": "new_name"})
     # like in example below:
-    ip: str = field(metadata={"renamed": "ip"})
-    url: str
+    # DWH hash key of a field is stored in the datalake column given by field(metadata={"hash_key": "column"})
+    ip: str = field(metadata={"renamed": "ip", "hash_key": "hash_key_ip"})
+    url: str = field(metadata={"hash_key": "hash_key_url"})
 
 
 @dataclass
 class Malware(BaseObject):
-    url: str
+    url: str = field(metadata={"hash_key": "hash_key_url"})
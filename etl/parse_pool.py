@@ -0,0 +1,142 @@
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from parsers import PARSERS
+from instrumentation import recorder
+from constants import SCHEMA_MAPPING, PARSE_WORKERS, PARSE_SEGMENT_SIZE_BYTES
+
+# Result of a segment: valid rows (plain tuples in field order), rejected (index of the parsed row in the segment,
+# row, error) and the parser counters of the segment
+ParsedSegment = namedtuple("ParsedSegment", ["rows", "rejected", "rows_parsed", "lines_read", "parse_time_sec"])
+
+
+def row_padding(table_name: str, arity: int) -> tuple | None:
+    # Parsed rows with fewer values than the model fields (e.g. hosts lines without IP) are padded in front
+    model_fields = SCHEMA_MAPPING[table_name].get_field()
+    return ('',) * (len(model_fields) - arity) if arity < len(model_fields) else None
+
+
+def parse_segment(source_format: str, table_name: str, segment: str) -> ParsedSegment:
+    # Runs in a worker process: parses a segment of complete lines and validates its rows by the model validator
+    parser = PARSERS[source_format]()
+    rows = parser.parse(segment)
+    padding = row_padding(table_name, parser.arity)
+    if padding:
+        rows = [padding + row for row in rows]
+
+    validator = SCHEMA_MAPPING[table_name].get_row_validator()
+    valid_rows = []
+    rejected = []
+    for index, row in enumerate(rows):
+        try:
+            valid_rows.append(validator(row))
+        except TypeError as e:
+            rejected.append((index, row, str(e)))
+    return ParsedSegment(valid_rows, rejected, parser.rows_parsed, parser.lines_read, parser.parse_time_sec)
+
+
+def iter_validated_chunks(segments, chunk_size):
+    """
+    Regroups parsed segments into chunks of chunk_size parsed rows, the same chunks as populate_datalake
+    builds in serial mode. chunk_size is an int or a callable returning the size of the next chunk
+    (see AdaptiveChunkSize). Yields (valid rows, rejected (row, error) pairs) of every chunk.
+    """
+    next_size = chunk_size if callable(chunk_size) else lambda: chunk_size
+    valid_rows, rejected_rows, size = [], [], 0
+    target = next_size()
+    for segment in segments:
+        position = valid_index = rejected_index = 0
+        while position < segment.rows_parsed:
+            end = position + min(target - size, segment.rows_parsed - position)
+            rejected_end = rejected_index
+            while rejected_end < len(segment.rejected) and segment.rejected[rejected_end][0] < end:
+                rejected_end += 1
+            valid_end = valid_index + (end - position) - (rejected_end - rejected_index)
+
+            valid_rows.extend(segment.rows[valid_index:valid_end])
+            rejected_rows.extend((row, error) for _, row, error in segment.rejected[rejected_index:rejected_end])
+            size += end - position
+            position, valid_index, rejected_index = end, valid_end, rejected_end
+            if size == target:
+                yield valid_rows, rejected_rows
+                valid_rows, rejected_rows, size = [], [], 0
+                target = next_size()
+    if size:
+        yield valid_rows, rejected_rows
+
+
+class ParsePool:
+    """
+    Process pool parsing and validating large sources. The body is split on line boundaries into segments
+    of about segment_size, which are parsed by the workers while the next ones are read. Results are consumed
+    in order of the segments by the single loader of the source, so the loaded rows match the serial mode.
+    The pool is shared by the fetch threads, every source keeps up to two segments per worker in flight.
+    """
+    def __init__(self, max_workers: int = PARSE_WORKERS, segment_size: int = PARSE_SEGMENT_SIZE_BYTES):
+        self.segment_size = segment_size
+        self.max_in_flight = 2 * max_workers
+        # Workers are spawned instead of forked from the process running the fetch threads
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def iter_segments(self, blocks):
+        # Joins blocks of complete lines (see iter_response_blocks) into segments of at least segment_size
+        segment, size = [], 0
+        for block in blocks:
+            segment.append(block)
+            size += len(block)
+            if size >= self.segment_size:
+                yield "".join(segment)
+                segment, size = [], 0
+        if segment:
+            yield "".join(segment)
+
+    def iter_parsed(self, blocks, parser, table_name: str):
+        """
+        Yields ParsedSegment of every segment in order and adds their counters to parser.
+        A body which fits in one segment is parsed in the calling thread.
+        """
+        phases = recorder()
+        pending = deque()
+        segments = self.iter_segments(blocks)
+        first = next(segments, None)
+        if first is None:
+            return
+        second = next(segments, None)
+        if second is None:
+            with phases.span("parse"):
+                parsed = parse_segment(parser.format, table_name, first)
+            self._add_counters(parser, parsed)
+            yield parsed
+            return
+
+        try:
+            for segment in (first, second):
+                pending.append(self.executor.submit(parse_segment, parser.format, table_name, segment))
+            for segment in segments:
+                if len(pending) >= self.max_in_flight:
+                    yield self._next_result(pending, parser)
+                pending.append(self.executor.submit(parse_segment, parser.format, table_name, segment))
+            while pending:
+                yield self._next_result(pending, parser)
+        finally:
+            # A failed load stops consuming, segments not started yet are not parsed
+            for future in pending:
+                future.cancel()
+
+    @staticmethod
+    def _next_result(pending: deque, parser) -> ParsedSegment:
+        # Time of the loader waiting for the workers is the 'parse' phase of the source
+        with recorder().span("parse"):
+            parsed = pending.popleft().result()
+        ParsePool._add_counters(parser, parsed)
+        return parsed
+
+    @staticmethod
+    def _add_counters(parser, parsed: ParsedSegment):
+        parser.rows_parsed += parsed.rows_parsed
+        parser.lines_read += parsed.lines_read
+        parser.parse_time_sec += parsed.parse_time_sec
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,71 @@
+import re
+from time import perf_counter
+
+from utils import matcher
+
+
+class SourceParser:
+    """
+    Base class of source-format parsers.
+    A parser works over a whole text block of complete lines with one compiled regex scan
+    and keeps the counters of the source it was created for.
+    """
+    format = None
+    # Number of values in a parsed row
+    arity = 1
+    pattern = None
+
+    def __init__(self):
+        self.lines_read = 0
+        self.rows_parsed = 0
+        self.parse_time_sec = 0.0
+
+    def _parse(self, block: str) -> list:
+        return [(value,) for value in self.pattern.findall(block)]
+
+    def parse(self, block: str) -> list:
+        start_time = perf_counter()
+        rows = self._parse(block)
+        self.parse_time_sec += perf_counter() - start_time
+        self.lines_read += block.count("\n") + (not block.endswith("\n"))
+        self.rows_parsed += len(rows)
+        return rows
+
+    @property
+    def lines_per_sec(self) -> float:
+        return round(self.lines_read / self.parse_time_sec, 1) if self.parse_time_sec else 0.0
+
+
+class HostsParser(SourceParser):
+    # "<ip> <host>" lines, comments and empty lines are skipped. A line with a single value is read as a host.
+    format = "hosts"
+    arity = 2
+    pattern = re.compile(r"^[^\S\n]*([^#\s]\S*)(?:[^\S\n]+(\S+))?", re.MULTILINE)
+
+    def _parse(self, block: str) -> list:
+        return [(ip, url) if url else ('', ip) for ip, url in self.pattern.findall(block)]
+
+
+class AdblockParser(SourceParser):
+    # Value between '||' and '^' (the first one of a line), e.g. "||example.com^"
+    format = "adblock"
+    pattern = re.compile(r"^[^\n]*?\|\|([^|^\n]+)\^", re.MULTILINE)
+
+
+class DomainListParser(SourceParser):
+    # One domain per line, comments ('#' or '!') and empty lines are skipped
+    format = "domains"
+    pattern = re.compile(r"^[^\S\n]*([^#!\s]\S*)", re.MULTILINE)
+
+
+PARSERS = {parser.format: parser for parser in (HostsParser, AdblockParser, DomainListParser)}
+
+
+def get_parser(source_format: str = None, url: str = None) -> SourceParser:
+    # Format is declared per source in etl_conf.json, sources without it fall back to a guess by URL
+    if not source_format:
+        source_format = AdblockParser.format if matcher(url=url or '') else HostsParser.format
+    try:
+        return PARSERS[source_format]()
+    except KeyError:
+        raise ValueError(f"Unknown source format '{source_format}', expected one of: {', '.join(PARSERS)}")
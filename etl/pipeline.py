@@ -0,0 +1,135 @@
+import queue
+import threading
+
+from instrumentation import recorder, attached
+from constants import DATALAKE_PIPELINE_QUEUE_SIZE
+
+_DONE = object()
+# Blocked put/get re-check whether the other side of the queue has stopped at this interval
+_POLL_INTERVAL_SEC = 0.1
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class BoundedQueue:
+    """
+    Queue between two stages of a unit of work. A full queue blocks the producer (back-pressure), an empty one
+    the consumer. Every put and get is recorded as a '<name>_put' / '<name>_get' phase of the unit, so the phase
+    time is the time the stage stalled on the queue, and the depth seen by put is stored as the max queue depth.
+    """
+    def __init__(self, name: str, maxsize: int = DATALAKE_PIPELINE_QUEUE_SIZE, phases=None):
+        self.name = name
+        self.phases = phases or recorder()
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def put(self, item):
+        with self.phases.span(f"{self.name}_put"):
+            while True:
+                if self._stopped.is_set():
+                    raise PipelineStopped(f"Consumer of '{self.name}' queue has stopped")
+                try:
+                    self._queue.put(item, timeout=_POLL_INTERVAL_SEC)
+                    break
+                except queue.Full:
+                    continue
+        self.phases.depth(f"{self.name}_put", self._queue.qsize())
+
+    def get(self):
+        with self.phases.span(f"{self.name}_get"):
+            while True:
+                if self._stopped.is_set():
+                    raise PipelineStopped(f"Producer of '{self.name}' queue has stopped")
+                try:
+                    return self._queue.get(timeout=_POLL_INTERVAL_SEC)
+                except queue.Empty:
+                    continue
+
+
+def iter_in_thread(iterable, name: str, maxsize: int = DATALAKE_PIPELINE_QUEUE_SIZE):
+    """
+    Iterates iterable in a producer thread and yields its items through a bounded queue,
+    e.g. the download of a source runs while its previous blocks are parsed.
+    Errors of the producer are raised in the consumer, a consumer which stops early stops the producer.
+    """
+    items = BoundedQueue(name, maxsize)
+    error = []
+
+    def produce():
+        with attached(items.phases):
+            try:
+                for item in iterable:
+                    items.put(item)
+            except PipelineStopped:
+                return
+            except BaseException as e:
+                error.append(e)
+            try:
+                items.put(_DONE)
+            except PipelineStopped:
+                pass
+
+    producer = threading.Thread(target=produce, name=f"{threading.current_thread().name}-{name}", daemon=True)
+    producer.start()
+    try:
+        while (item := items.get()) is not _DONE:
+            yield item
+        if error:
+            raise error[0]
+    finally:
+        items.stop()
+        producer.join()
+
+
+class QueueWorker:
+    """
+    Consumer thread calling func with every item put into its bounded queue, in order, e.g. the DB writer
+    of the chunks of a source. An error of func is raised by the next put or by close, the items queued after
+    it are dropped. Used as a context manager, the worker is closed on exit (and only stopped on an error).
+    """
+    def __init__(self, func, name: str, maxsize: int = DATALAKE_PIPELINE_QUEUE_SIZE):
+        self.func = func
+        self.items = BoundedQueue(name, maxsize)
+        self.error = None
+        self.consumer = threading.Thread(target=self._consume,
+                                         name=f"{threading.current_thread().name}-{name}",
+                                         daemon=True)
+        self.consumer.start()
+
+    def _consume(self):
+        with attached(self.items.phases):
+            try:
+                while (item := self.items.get()) is not _DONE:
+                    if self.error is None:
+                        try:
+                            self.func(item)
+                        except BaseException as e:
+                            self.error = e
+            except PipelineStopped:
+                pass
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.items.put(item)
+
+    def close(self):
+        self.items.put(_DONE)
+        self.consumer.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.items.stop()
+            self.consumer.join()
@@ -0,0 +1,96 @@
+import os
+import re
+import time
+import pstats
+import cProfile
+import logging
+import tracemalloc
+from contextlib import contextmanager
+
+from utils import get_logger
+from constants import ETL_RUN_ID, PROFILE_DIR, PROFILE_TOP_ENTRIES, PROFILE_TRACEMALLOC_FRAMES
+
+
+class StageProfiler:
+    """
+    Profiles units of work of the ETL stages (schema build, a datalake source, a DWH table) with cProfile
+    and tracemalloc. Every unit gets '<stage>__<name>.pstats' and a '<stage>__<name>.txt' report with the top
+    functions and the top allocations in the directory of the run.
+
+    cProfile only follows the thread which enabled it, so concurrent units are profiled separately.
+    tracemalloc traces the whole process: allocations of a unit are the difference of the snapshots taken
+    around it and include allocations of units running at the same time.
+    """
+    def __init__(self,
+                 profile_dir: str = PROFILE_DIR,
+                 top: int = PROFILE_TOP_ENTRIES,
+                 logger: logging.Logger = get_logger()):
+        self.profile_dir = os.path.join(profile_dir, ETL_RUN_ID)
+        self.top = top
+        self.logger = logger
+        os.makedirs(self.profile_dir, exist_ok=True)
+        # Tracing started by someone else (e.g. python -X tracemalloc) is left running on close
+        self._started_tracemalloc = not tracemalloc.is_tracing()
+        if self._started_tracemalloc:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+
+    def report_path(self, stage: str, name: str) -> str:
+        return os.path.join(self.profile_dir, f"{stage}__{re.sub(r'[^A-Za-z0-9_.-]+', '_', name)[:100]}")
+
+    @contextmanager
+    def profile(self, stage: str, name: str):
+        """
+        Profiles the body of the with statement, yields the summary dict which is filled in on exit:
+        calls, wall_time_sec, cpu_time_sec, allocated_bytes, top_function and report_path.
+        """
+        summary = {}
+        profiler = cProfile.Profile()
+        start_snapshot = self._snapshot()
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12+ allows only one active profiler per process, the unit is then traced by tracemalloc only
+            self.logger.warning(f"cProfile is not available for {stage} '{name}': {e}")
+            profiler = None
+        try:
+            yield summary
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            summary["wall_time_sec"] = round(time.perf_counter() - start_wall, 6)
+            summary["cpu_time_sec"] = round(time.thread_time() - start_cpu, 6)
+            self._write_reports(summary, self.report_path(stage, name), profiler, start_snapshot)
+            self.logger.info(f"Profile of {stage} '{name}' is written to '{summary['report_path']}.*'")
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def _write_reports(self, summary: dict, path: str, profiler: cProfile.Profile | None, start_snapshot):
+        allocations = self._snapshot().compare_to(start_snapshot, "lineno")
+        summary["allocated_bytes"] = sum(stat.size_diff for stat in allocations)
+        summary["calls"] = None
+        summary["top_function"] = None
+        summary["report_path"] = path
+
+        with open(f"{path}.txt", "w") as report:
+            if profiler is not None:
+                profiler.dump_stats(f"{path}.pstats")
+                stats = pstats.Stats(profiler, stream=report)
+                summary["calls"] = stats.total_calls
+                if stats.stats:
+                    # Function with the largest own time (without its callees)
+                    (file_name, line, function), _ = max(stats.stats.items(), key=lambda item: item[1][2])
+                    summary["top_function"] = f"{function} ({os.path.basename(file_name)}:{line})"[:255]
+                report.write(f"Top {self.top} functions by cumulative time\n")
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+
+            report.write(f"Top {self.top} allocations, net allocated: {summary['allocated_bytes']} bytes\n")
+            for stat in allocations[:self.top]:
+                report.write(f"{stat}\n")
+
+    def close(self):
+        if self._started_tracemalloc:
+            tracemalloc.stop()
@@ -0,0 +1,73 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import get_logger
+
+TASK_DONE = "done"
+TASK_FAILED = "failed"
+TASK_SKIPPED = "skipped"
+
+
+def validate_dag(dependencies: dict):
+    # Every dependency must be declared as a task and the graph must not have cycles
+    for task, depends_on in dependencies.items():
+        unknown = [dependency for dependency in depends_on if dependency not in dependencies]
+        if unknown:
+            raise ValueError(f"Task '{task}' depends on undeclared tasks: {', '.join(unknown)}")
+
+    checked = set()
+
+    def visit(task: str, path: tuple):
+        if task in checked:
+            return
+        if task in path:
+            raise ValueError(f"Dependency cycle: {' -> '.join(path + (task,))}")
+        for dependency in dependencies[task]:
+            visit(dependency, path + (task,))
+        checked.add(task)
+
+    for task in dependencies:
+        visit(task, ())
+
+
+def run_dag(dependencies: dict, run, max_workers: int, logger: logging.Logger = get_logger()) -> dict:
+    """
+    Runs run(task) for every task of dependencies ({task: [tasks it depends on]}) in a thread pool.
+    A task starts as soon as all its dependencies are done. When a task fails, its dependents
+    (direct and transitive) are skipped, independent tasks keep running.
+    Returns {task: status} and raises the first error once all runnable tasks are finished.
+    """
+    validate_dag(dependencies)
+    statuses = {}
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dwh") as executor:
+        running = {}
+        while len(statuses) < len(dependencies):
+            for task, depends_on in dependencies.items():
+                if task in statuses or task in running.values():
+                    continue
+                if any(statuses.get(dependency) in (TASK_FAILED, TASK_SKIPPED) for dependency in depends_on):
+                    statuses[task] = TASK_SKIPPED
+                    logger.warning(f"Task '{task}' is skipped, as its dependencies are not built")
+                elif all(statuses.get(dependency) == TASK_DONE for dependency in depends_on):
+                    running[executor.submit(run, task)] = task
+
+            if not running:
+                # only skipped tasks were left on this pass, re-check the rest
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    future.result()
+                    statuses[task] = TASK_DONE
+                except Exception as e:
+                    logger.error(f"Task '{task}' failed: {e}")
+                    statuses[task] = TASK_FAILED
+                    errors.append(e)
+
+    if errors:
+        raise errors[0]
+    return statuses
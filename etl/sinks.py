@@ -0,0 +1,278 @@
+import os
+import csv
+import sqlite3
+import logging
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from contextlib import contextmanager, closing
+
+from utils import get_logger, render_sql_from_file, split_sql_statements
+from constants import (
+    ETL_TIMESTAMP,
+    ETL_RUN_ID,
+    DATALAKE_SCHEMA,
+    DWH_SCHEMA,
+    SQL_FOLDER_PATH,
+    SQLITE_DIR,
+    SQLITE_SQL_FOLDER_PATHS,
+    EXPORT_DIR,
+    STAGING_SQL_FILENAME,
+    UPSERT_SQL_FILENAME,
+    EXPORT_ROWS_SQL_FILENAME,
+    EXPORT_BATCH_ROWS,
+    MergeCounts,
+)
+
+
+class Sink(ABC):
+    """
+    Target of the loads of RunETl: the scripts of sql/ (schema, merges, DWH builds, checkpoints, run status)
+    are run by run_sql, datalake chunks and statistics rows are loaded by load_rows / append_rows.
+    ConnectorDB (Postgres) is the default sink, see ETL_SINK.
+    """
+    @abstractmethod
+    def run_sql(self,
+                sql_file_name: str,
+                sql_params: dict = None,
+                sql_folder_path: str = SQL_FOLDER_PATH,
+                return_row: bool = False,
+                checkpoint: dict = None):
+        # Returns the first value of the result row of the script, or the whole row with return_row
+        ...
+
+    @abstractmethod
+    def load_rows(self,
+                  sql_file_name: str,
+                  values: set,
+                  sql_params: dict,
+                  fields: list,
+                  checkpoint: dict = None) -> MergeCounts:
+        # Stages values and merges them by sql_file_name, checkpoint is committed in the same transaction
+        ...
+
+    @abstractmethod
+    def append_rows(self, values: set, sql_params: dict, fields: list, checkpoint: dict = None):
+        # Appends values to the staging table of a source (sql_params['staging_table']) which is merged later
+        ...
+
+    @abstractmethod
+    def iter_rows(self, sql_file_name: str, sql_params: dict, sql_folder_path: str = SQL_FOLDER_PATH):
+        # Yields the column names of the query and then its rows
+        ...
+
+    def export_run(self, tables: list):
+        # Only CsvExportSink exports the rows of a run
+        pass
+
+    @staticmethod
+    def execute_checkpoint(cur, checkpoint: dict = None):
+        # Checkpoint (upsert.sql params) is written first, so the result row is still the one of the script
+        if checkpoint:
+            cur.execute(render_sql_from_file(file_name=UPSERT_SQL_FILENAME, params_dict=checkpoint))
+
+    def pool_metrics(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+class SqliteSink(Sink):
+    """
+    Embedded sink for local runs and profiling without the Postgres service. The datalake and dwh schemas are
+    SQLite databases ('<sqlite_dir>/datalake.db', 'dwh.db') attached to one connection, so '<schema>.<table>'
+    names of the scripts resolve as in Postgres. Scripts are rendered from sql/sqlite/ and from sql/ when they
+    have no SQLite version (the portable ones, e.g. upsert.sql). Calls are serialized, each one is a transaction.
+    """
+    def __init__(self, sqlite_dir: str = SQLITE_DIR, logger: logging.Logger = get_logger()):
+        self.logger = logger
+        self.sqlite_dir = sqlite_dir
+        os.makedirs(sqlite_dir, exist_ok=True)
+        # Transactions are started explicitly, the connection is shared by the fetch threads under the lock.
+        # In WAL mode the read connections of iter_rows and the loads don't block each other
+        self.conn = self.connect()
+        for schema in (DATALAKE_SCHEMA, DWH_SCHEMA):
+            self.conn.execute(f"PRAGMA {schema}.journal_mode = WAL")
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+        for schema in (DATALAKE_SCHEMA, DWH_SCHEMA):
+            conn.execute(f"ATTACH DATABASE ? AS {schema}", (os.path.join(self.sqlite_dir, f"{schema}.db"),))
+        return conn
+
+    @staticmethod
+    def render(sql_file_name: str, sql_params: dict = None, sql_folder_path: str = SQL_FOLDER_PATH) -> str:
+        sqlite_folder_path = SQLITE_SQL_FOLDER_PATHS.get(sql_folder_path, sql_folder_path)
+        if os.path.exists(sqlite_folder_path.format(file_name=sql_file_name)):
+            sql_folder_path = sqlite_folder_path
+        # Timestamps are stored as ISO text (as build_values renders them), so they compare as text across tables
+        if sql_params:
+            sql_params = {key: val.isoformat() if isinstance(val, datetime) else val for key, val in sql_params.items()}
+        return render_sql_from_file(file_name=sql_file_name, params_dict=sql_params, sql_folder_path=sql_folder_path)
+
+    @staticmethod
+    def execute_script(cur, sql: str) -> tuple | None:
+        # Returns the result row of the last statement of the script which returns rows
+        res_row = None
+        for statement in split_sql_statements(sql):
+            cur.execute(statement)
+            if cur.description is not None:
+                res_row = cur.fetchone()
+        return res_row
+
+    @staticmethod
+    def insert_rows(cur, table: str, fields: list, values: set):
+        # Timestamps are stored as ISO text, see render
+        cur.executemany(
+            f"INSERT INTO {table} ({', '.join(fields)}) VALUES ({', '.join('?' * len(fields))})",
+            (tuple(val.isoformat() if isinstance(val, datetime) else val for val in value_tuple)
+             for value_tuple in values)
+        )
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                yield cur
+            except Exception:
+                if self.conn.in_transaction:
+                    cur.execute("ROLLBACK")
+                raise
+            else:
+                cur.execute("COMMIT")
+            finally:
+                cur.close()
+
+    def run_sql(self,
+                sql_file_name: str,
+                sql_params: dict = None,
+                sql_folder_path: str = SQL_FOLDER_PATH,
+                return_row: bool = False,
+                checkpoint: dict = None):
+        # Returns the first value of the result row, or the whole row with return_row
+        sql = self.render(sql_file_name, sql_params, sql_folder_path)
+        with self.transaction() as cur:
+            self.execute_checkpoint(cur, checkpoint)
+            res_row = self.execute_script(cur, sql)
+        self.logger.info(f"Result Row Count of '{sql_file_name}' script: {res_row}")
+        if return_row or res_row is None:
+            return res_row
+        return res_row[0]
+
+    def load_rows(self,
+                  sql_file_name: str,
+                  values: set,
+                  sql_params: dict,
+                  fields: list,
+                  checkpoint: dict = None) -> MergeCounts:
+        # Rows are inserted into the temp staging table and merged by sql_file_name, as COPY does for Postgres
+        with self.transaction() as cur:
+            self.execute_checkpoint(cur, checkpoint)
+            self.execute_script(cur, self.render(STAGING_SQL_FILENAME, sql_params))
+            self.insert_rows(cur, sql_params["staging_table"], fields, values)
+            res_row = self.execute_script(cur, self.render(sql_file_name, sql_params))
+        self.logger.info(f"Result Row Count of '{sql_file_name}' script: {res_row}")
+        return MergeCounts(*res_row)
+
+    def append_rows(self, values: set, sql_params: dict, fields: list, checkpoint: dict = None):
+        # Appends values to the staging table of a source (sql_params['staging_table']) which is merged later
+        with self.transaction() as cur:
+            self.execute_checkpoint(cur, checkpoint)
+            self.insert_rows(cur, sql_params["staging_table"], fields, values)
+
+    def iter_rows(self, sql_file_name: str, sql_params: dict, sql_folder_path: str = SQL_FOLDER_PATH):
+        # Rows are read in batches on a connection of their own, so a consumer which stops early or fails
+        # never holds the lock of the loads
+        sql = self.render(sql_file_name, sql_params, sql_folder_path)
+        with closing(self.connect()) as conn:
+            cur = conn.execute(sql)
+            yield tuple(column[0] for column in cur.description)
+            while rows := cur.fetchmany(EXPORT_BATCH_ROWS):
+                yield from rows
+
+    def close(self):
+        self.conn.close()
+
+
+class CsvExportSink(Sink):
+    """
+    Post-run export of another sink as CSV files partitioned by run, for downstream analytics without
+    a DB connection: '<export_dir>/<schema>/<table_name>/etl_timestamp=<run id>/part-00000.csv'.
+    Loads and scripts go to the wrapped sink. At the end of the flow export_run() queries it again for the rows
+    of the run of every table (rows with the etl_timestamp of the run) and writes each partition in full,
+    so a run exported again (e.g. resumed) replaces its partitions.
+    """
+    def __init__(self, sink: Sink, export_dir: str = EXPORT_DIR, logger: logging.Logger = get_logger()):
+        self.sink = sink
+        self.export_dir = export_dir
+        self.logger = logger
+
+    def run_sql(self,
+                sql_file_name: str,
+                sql_params: dict = None,
+                sql_folder_path: str = SQL_FOLDER_PATH,
+                return_row: bool = False,
+                checkpoint: dict = None):
+        return self.sink.run_sql(sql_file_name=sql_file_name,
+                                 sql_params=sql_params,
+                                 sql_folder_path=sql_folder_path,
+                                 return_row=return_row,
+                                 checkpoint=checkpoint)
+
+    def load_rows(self,
+                  sql_file_name: str,
+                  values: set,
+                  sql_params: dict,
+                  fields: list,
+                  checkpoint: dict = None) -> MergeCounts:
+        return self.sink.load_rows(sql_file_name=sql_file_name,
+                                   values=values,
+                                   sql_params=sql_params,
+                                   fields=fields,
+                                   checkpoint=checkpoint)
+
+    def append_rows(self, values: set, sql_params: dict, fields: list, checkpoint: dict = None):
+        self.sink.append_rows(values=values, sql_params=sql_params, fields=fields, checkpoint=checkpoint)
+
+    def iter_rows(self, sql_file_name: str, sql_params: dict, sql_folder_path: str = SQL_FOLDER_PATH):
+        return self.sink.iter_rows(sql_file_name, sql_params, sql_folder_path)
+
+    def partition_dir(self, schema: str, table_name: str, run_id: str = ETL_RUN_ID) -> str:
+        return os.path.join(self.export_dir, schema, table_name, f"etl_timestamp={run_id}")
+
+    def export_table(self, schema: str, table_name: str) -> int:
+        # Returns the number of exported rows
+        rows = self.sink.iter_rows(sql_file_name=EXPORT_ROWS_SQL_FILENAME,
+                                   sql_params={"schema": schema, "table_name": table_name,
+                                               "etl_timestamp": ETL_TIMESTAMP})
+        partition_dir = self.partition_dir(schema, table_name)
+        os.makedirs(partition_dir, exist_ok=True)
+        row_count = 0
+        # Written to a temp file and renamed, so readers never see a partly written partition
+        # rows is closed when a write fails, so the connection of the half-read query goes back to the pool
+        with closing(rows), \
+                tempfile.NamedTemporaryFile('w', dir=partition_dir, delete=False, suffix=".tmp", newline='') as file:
+            writer = csv.writer(file, lineterminator="\n")
+            writer.writerow(next(rows))
+            for row in rows:
+                writer.writerow(row)
+                row_count += 1
+        os.replace(file.name, os.path.join(partition_dir, "part-00000.csv"))
+        return row_count
+
+    def export_run(self, tables: list):
+        for schema, table_name in tables:
+            row_count = self.export_table(schema, table_name)
+            self.logger.info(f"Exported {row_count} rows of {schema}.{table_name} to "
+                             f"'{self.partition_dir(schema, table_name)}'")
+
+    def pool_metrics(self) -> dict:
+        return self.sink.pool_metrics()
+
+    def close(self):
+        self.sink.close()
@@ -0,0 +1,179 @@
+import os
+import re
+import glob
+import heapq
+import hashlib
+import tempfile
+import threading
+
+from constants import SNAPSHOT_DIR, DIFF_SORT_BUFFER_ROWS
+
+NULL_VALUE = "\\N"
+SNAPSHOT_SUFFIX = ".rows"
+NEW_SNAPSHOT_SUFFIX = ".rows.new"
+
+
+# Backslash, tab and line breaks of values are escaped (as in COPY text format), so a row is one tab separated line
+ESCAPES = {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"}
+UNESCAPES = {escaped[1]: char for char, escaped in ESCAPES.items()}
+ESCAPE_PATTERN = re.compile(r"[\\\t\n\r]")
+UNESCAPE_PATTERN = re.compile(r"\\(.)")
+
+
+def encode_row(row: tuple) -> str:
+    return "\t".join(
+        NULL_VALUE if val is None else ESCAPE_PATTERN.sub(lambda match: ESCAPES[match.group()], val) for val in row
+    )
+
+
+def decode_row(line: str) -> tuple:
+    return tuple(
+        None if val == NULL_VALUE else UNESCAPE_PATTERN.sub(lambda match: UNESCAPES[match.group(1)], val)
+        for val in line.split("\t")
+    )
+
+
+def read_lines(path: str):
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            yield line.rstrip("\n")
+
+
+def unique_sorted(lines):
+    # Drops repeated lines of a sorted stream
+    previous = None
+    for line in lines:
+        if line != previous:
+            yield line
+            previous = line
+
+
+def diff_sorted(previous_lines, current_lines):
+    """
+    Streaming merge of two sorted unique streams of lines.
+    Yields (line, is_removed): is_removed is False for added lines and True for removed ones.
+    """
+    previous_lines = iter(previous_lines)
+    current_lines = iter(current_lines)
+    previous = next(previous_lines, None)
+    current = next(current_lines, None)
+    while previous is not None or current is not None:
+        if previous is None or (current is not None and current < previous):
+            yield current, False
+            current = next(current_lines, None)
+        elif current is None or previous < current:
+            yield previous, True
+            previous = next(previous_lines, None)
+        else:
+            previous = next(previous_lines, None)
+            current = next(current_lines, None)
+
+
+class SnapshotWriter:
+    """
+    Writes the rows of one source as a new sorted unique snapshot file with an external sort:
+    rows are buffered up to buffer_rows, sorted into temporary runs and merged on finish.
+    """
+    def __init__(self, path: str, buffer_rows: int = DIFF_SORT_BUFFER_ROWS):
+        self.path = path
+        self.buffer_rows = buffer_rows
+        self.added_row_count = 0
+        self.row_count = 0
+        self._buffer = []
+        self._runs = []
+
+    @property
+    def duplicate_row_count(self) -> int:
+        return self.added_row_count - self.row_count
+
+    def add(self, rows: list):
+        self._buffer.extend(encode_row(row) for row in rows)
+        self.added_row_count += len(rows)
+        if len(self._buffer) >= self.buffer_rows:
+            self._flush_run()
+
+    def _flush_run(self):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(self.path), suffix=".run", delete=False) as file:
+            file.writelines(f"{line}\n" for line in sorted(self._buffer))
+        self._runs.append(file.name)
+        self._buffer = []
+
+    def finish(self):
+        sorted_lines = heapq.merge(sorted(self._buffer), *(read_lines(run) for run in self._runs))
+        with open(self.path + NEW_SNAPSHOT_SUFFIX, 'w', encoding='utf-8') as file:
+            for line in unique_sorted(sorted_lines):
+                file.write(f"{line}\n")
+                self.row_count += 1
+        self.discard()
+
+    def discard(self):
+        self._buffer = []
+        for run in self._runs:
+            os.remove(run)
+        self._runs = []
+
+
+class SnapshotStore:
+    """
+    Snapshots of datalake sources kept between runs: one sorted file of unique rows per source,
+    placed in a folder per table. New snapshots of a run are written next to the current ones
+    and replace them on commit, after the delta of the table is loaded.
+    """
+    def __init__(self, snapshot_dir: str = SNAPSHOT_DIR):
+        self.snapshot_dir = snapshot_dir
+        self._lock = threading.Lock()
+        # Sources with a new snapshot written in this run
+        self._written = set()
+
+    def _base_path(self, table_name: str, url: str) -> str:
+        return os.path.join(self.snapshot_dir, table_name, hashlib.sha256(url.encode()).hexdigest())
+
+    def has_snapshot(self, table_name: str, url: str) -> bool:
+        return os.path.exists(self._base_path(table_name, url) + SNAPSHOT_SUFFIX)
+
+    def writer(self, table_name: str, url: str) -> SnapshotWriter:
+        path = self._base_path(table_name, url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return SnapshotWriter(path)
+
+    def mark_written(self, table_name: str, url: str):
+        with self._lock:
+            self._written.add((table_name, url))
+
+    def _current_paths(self, table_name: str, urls: list) -> list:
+        # Sources without a new snapshot (unchanged, failed) keep their previous one
+        paths = []
+        for url in urls:
+            path = self._base_path(table_name, url)
+            if (table_name, url) in self._written:
+                paths.append(path + NEW_SNAPSHOT_SUFFIX)
+            elif os.path.exists(path + SNAPSHOT_SUFFIX):
+                paths.append(path + SNAPSHOT_SUFFIX)
+        return paths
+
+    def _previous_paths(self, table_name: str) -> list:
+        # All previous snapshots of the table, so rows of sources removed from the configs are removed too
+        return glob.glob(os.path.join(self.snapshot_dir, table_name, f"*{SNAPSHOT_SUFFIX}"))
+
+    def diff(self, table_name: str, urls: list):
+        """
+        Yields (row, is_removed) for rows added to or removed from the union of all sources of the table.
+        """
+        previous_lines = unique_sorted(heapq.merge(*(read_lines(p) for p in self._previous_paths(table_name))))
+        current_lines = unique_sorted(heapq.merge(*(read_lines(p) for p in self._current_paths(table_name, urls))))
+        for line, is_removed in diff_sorted(previous_lines, current_lines):
+            yield decode_row(line), is_removed
+
+    def commit(self, table_name: str, urls: list):
+        current_paths = set()
+        for url in urls:
+            path = self._base_path(table_name, url)
+            if (table_name, url) in self._written:
+                os.replace(path + NEW_SNAPSHOT_SUFFIX, path + SNAPSHOT_SUFFIX)
+                with self._lock:
+                    self._written.discard((table_name, url))
+            current_paths.add(path + SNAPSHOT_SUFFIX)
+
+        for path in self._previous_paths(table_name):
+            if path not in current_paths:
+                os.remove(path)
@@ -0,0 +1,5 @@
+INSERT INTO {{ staging_table }} (
+    {{ fields }}
+)
+VALUES {{ values }}
+;
@@ -0,0 +1,8 @@
+SELECT datalake.create_time_partition(
+    '{{ schema }}.{{ table_name }}'::REGCLASS,
+    '{{ etl_timestamp }}'::TIMESTAMPTZ,
+    '{{ partition_interval }}'::INTERVAL
+);
+
+-- Return Result Row Count:
+SELECT COUNT(*) FROM pg_inherits WHERE inhparent = '{{ schema }}.{{ table_name }}'::REGCLASS;
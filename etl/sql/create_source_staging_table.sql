@@ -0,0 +1,8 @@
+-- Staging table of a source in "source" staging mode: chunks are appended to it in their own transactions
+-- and it is merged into the target once. A resumed source keeps the rows staged by the interrupted run,
+-- the table is unlogged when there are no checkpoints to keep it consistent with.
+{% if not resumed %}
+DROP TABLE IF EXISTS {{ staging_table }};
+{% endif %}
+
+CREATE {% if unlogged %}UNLOGGED {% endif %}TABLE IF NOT EXISTS {{ staging_table }} (LIKE {{ schema }}.{{ table_name }});
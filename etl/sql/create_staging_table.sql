@@ -0,0 +1,3 @@
+DROP TABLE IF EXISTS {{ staging_table }};
+
+CREATE TEMP TABLE {{ staging_table }} (LIKE {{ schema }}.{{ table_name }}) ON COMMIT DROP;
@@ -9,25 +9,240 @@ CREATE TABLE IF NOT EXISTS datalake.build_datalake_statistics (
     source VARCHAR(255),
     inserting_row_count BIGINT,
     res_row_count BIGINT,
+    status VARCHAR(20),
+    parse_lines_per_sec FLOAT,
+    duplicate_row_count BIGINT,
+    removed_row_count BIGINT,
+    inserted_row_count BIGINT,
+    updated_row_count BIGINT,
+    unchanged_row_count BIGINT,
     execution_time_min FLOAT,
     load_timestamp TIMESTAMPTZ,
     PRIMARY KEY (etl_timestamp, stage, schema, table_name, source)
 );
 
+-- status of a source in the run: loaded / unchanged (skipped by fetch cache) / failed
+ALTER TABLE datalake.build_datalake_statistics ADD COLUMN IF NOT EXISTS status VARCHAR(20);
+-- parsing throughput of a source (lines of the body per second of parsing)
+ALTER TABLE datalake.build_datalake_statistics ADD COLUMN IF NOT EXISTS parse_lines_per_sec FLOAT;
+-- rows of a source dropped as duplicates of rows already loaded in the run (by this or another source)
+ALTER TABLE datalake.build_datalake_statistics ADD COLUMN IF NOT EXISTS duplicate_row_count BIGINT;
+-- removal markers loaded by the diff load mode (source 'delta')
+ALTER TABLE datalake.build_datalake_statistics ADD COLUMN IF NOT EXISTS removed_row_count BIGINT;
+-- rows of the merge: inserted (new key), updated (existing key with changed fields), unchanged (same row)
+ALTER TABLE datalake.build_datalake_statistics ADD COLUMN IF NOT EXISTS inserted_row_count BIGINT;
+ALTER TABLE datalake.build_datalake_statistics ADD COLUMN IF NOT EXISTS updated_row_count BIGINT;
+ALTER TABLE datalake.build_datalake_statistics ADD COLUMN IF NOT EXISTS unchanged_row_count BIGINT;
+
+-- Per-phase timings of a source (download/parse/validate/dedup/hash_keys/load spans); the 'total' phase row
+-- has the time of the whole source and its counters
+-- DROP TABLE IF EXISTS datalake.build_datalake_phase_statistics;
+CREATE TABLE IF NOT EXISTS datalake.build_datalake_phase_statistics (
+    etl_timestamp TIMESTAMPTZ,
+    stage VARCHAR(20),
+    schema VARCHAR(10),
+    table_name VARCHAR(20),
+    source VARCHAR(255),
+    phase VARCHAR(20),
+    calls BIGINT,
+    wall_time_sec FLOAT,
+    cpu_time_sec FLOAT,
+    p50_time_ms FLOAT,
+    p95_time_ms FLOAT,
+    max_queue_depth BIGINT,
+    bytes_downloaded BIGINT,
+    lines_read BIGINT,
+    rows_rejected BIGINT,
+    chunk_count BIGINT,
+    load_timestamp TIMESTAMPTZ,
+    allocated_bytes BIGINT,
+    top_function VARCHAR(255),
+    report_path VARCHAR(255),
+    PRIMARY KEY (etl_timestamp, stage, schema, table_name, source, phase)
+);
+
+-- Columns of queue phases and of the 'profile' phase rows, added to tables created before them
+ALTER TABLE datalake.build_datalake_phase_statistics ADD COLUMN IF NOT EXISTS allocated_bytes BIGINT;
+ALTER TABLE datalake.build_datalake_phase_statistics ADD COLUMN IF NOT EXISTS top_function VARCHAR(255);
+ALTER TABLE datalake.build_datalake_phase_statistics ADD COLUMN IF NOT EXISTS report_path VARCHAR(255);
+ALTER TABLE datalake.build_datalake_phase_statistics ADD COLUMN IF NOT EXISTS max_queue_depth BIGINT;
+
 --------------------------
 
+-- Status of every run: 'partial' from its start until it finishes as 'completed'
+-- DROP TABLE IF EXISTS datalake.etl_runs;
+CREATE TABLE IF NOT EXISTS datalake.etl_runs (
+    etl_timestamp TIMESTAMPTZ PRIMARY KEY,
+    run_id VARCHAR(20),
+    status VARCHAR(20),
+    started_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ
+);
+
+-- Last committed chunk of every datalake source of a run, written in the transaction of the chunk.
+-- row_offset is the number of parsed rows of the source up to the end of the chunk
+-- DROP TABLE IF EXISTS datalake.load_checkpoints;
+CREATE TABLE IF NOT EXISTS datalake.load_checkpoints (
+    etl_timestamp TIMESTAMPTZ,
+    table_name VARCHAR(20),
+    source VARCHAR(255),
+    chunk_number BIGINT,
+    row_offset BIGINT,
+    content_hash VARCHAR(64),
+    status VARCHAR(20),
+    updated_at TIMESTAMPTZ,
+    PRIMARY KEY (etl_timestamp, table_name, source)
+);
+
+--------------------------
+
+-- Creates the range partition of a datalake table (partitioned by etl_timestamp) holding ts.
+-- Bounds are aligned to step from the Unix epoch, so '1 day' gives UTC days. step has to be a fixed length
+-- interval (days/hours/...). When the range overlaps a partition created with another step the existing one is kept.
+CREATE OR REPLACE FUNCTION datalake.create_time_partition(parent REGCLASS, ts TIMESTAMPTZ, step INTERVAL DEFAULT '1 day')
+RETURNS VOID AS $$
+
+DECLARE
+    step_sec DOUBLE PRECISION := EXTRACT(EPOCH FROM step);
+    lower_bound_sec DOUBLE PRECISION := FLOOR(EXTRACT(EPOCH FROM ts) / step_sec) * step_sec;
+    parent_schema TEXT;
+    parent_name TEXT;
+BEGIN
+    SELECT n.nspname, c.relname
+    INTO parent_schema, parent_name
+    FROM pg_class AS c
+    JOIN pg_namespace AS n ON n.oid = c.relnamespace
+    WHERE c.oid = parent;
+
+    EXECUTE FORMAT(
+        'CREATE TABLE IF NOT EXISTS %I.%I PARTITION OF %I.%I FOR VALUES FROM (%L) TO (%L)',
+        parent_schema,
+        parent_name || '_p' || TO_CHAR(TO_TIMESTAMP(lower_bound_sec) AT TIME ZONE 'UTC', 'YYYYMMDD"_"HH24MISS'),
+        parent_schema,
+        parent_name,
+        TO_TIMESTAMP(lower_bound_sec),
+        TO_TIMESTAMP(lower_bound_sec + step_sec)
+    );
+EXCEPTION
+    -- "partition would overlap partition": the step was changed since the overlapping partition was created
+    WHEN invalid_object_definition THEN
+        RAISE NOTICE 'Partition of % for % overlaps an existing one: %', parent, ts, SQLERRM;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Drops the range partitions of a datalake table holding only rows older than keep_from (upper bound not after it),
+-- returns the number of dropped partitions. Nothing is dropped when keep_from is NULL.
+CREATE OR REPLACE FUNCTION datalake.drop_time_partitions(parent REGCLASS, keep_from TIMESTAMPTZ)
+RETURNS INTEGER AS $$
+
+DECLARE
+    part REGCLASS;
+    dropped INTEGER := 0;
+BEGIN
+    FOR part IN
+        SELECT c.oid::REGCLASS
+        FROM pg_inherits AS i
+        JOIN pg_class AS c ON c.oid = i.inhrelid
+        WHERE i.inhparent = parent
+          -- bound is "FOR VALUES FROM ('<lower>') TO ('<upper>')"
+          AND (REGEXP_MATCH(PG_GET_EXPR(c.relpartbound, c.oid), 'TO \(''([^'']+)''\)'))[1]::TIMESTAMPTZ <= keep_from
+    LOOP
+        EXECUTE FORMAT('DROP TABLE %s', part);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Estimated rows of a table (of all its partitions for a partitioned one) from pg_class.reltuples, as of the last
+-- VACUUM/ANALYZE of its tables. Merges report it instead of a COUNT(*) full scan, which grows with the table.
+CREATE OR REPLACE FUNCTION datalake.estimated_row_count(relation REGCLASS)
+RETURNS BIGINT AS $$
+    SELECT COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)::BIGINT
+    FROM pg_class AS c
+    WHERE c.oid = relation
+        OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = relation)
+$$ LANGUAGE sql STABLE;
+
+-- Tables created before partitioning are heap tables: they are renamed here and their rows are moved
+-- to the partitioned tables below.
+DO $$
+
+DECLARE
+    datalake_table TEXT;
+BEGIN
+    FOREACH datalake_table IN ARRAY ARRAY['malware', 'ads_and_trackers'] LOOP
+        IF EXISTS (
+            SELECT 1
+            FROM pg_class AS c
+            JOIN pg_namespace AS n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'datalake' AND c.relname = datalake_table AND c.relkind = 'r'
+        ) THEN
+            EXECUTE FORMAT('ALTER TABLE datalake.%I RENAME TO %I', datalake_table, datalake_table || '_unpartitioned');
+            -- removal markers of the diff load mode may be missing in the heap table
+            EXECUTE FORMAT(
+                'ALTER TABLE datalake.%I ADD COLUMN IF NOT EXISTS is_removed BOOLEAN DEFAULT FALSE',
+                datalake_table || '_unpartitioned'
+            );
+        END IF;
+    END LOOP;
+END;
+$$;
+
 -- DROP TABLE IF EXISTS datalake.malware;
 CREATE TABLE IF NOT EXISTS datalake.malware (
     url VARCHAR(255),
-    etl_timestamp TIMESTAMPTZ
-);
+    etl_timestamp TIMESTAMPTZ,
+    is_removed BOOLEAN DEFAULT FALSE,
+    hash_key_url UUID
+) PARTITION BY RANGE (etl_timestamp);
 
 -- DROP TABLE IF EXISTS datalake.ads_and_trackers;
 CREATE TABLE IF NOT EXISTS datalake.ads_and_trackers (
     ip VARCHAR(20),
     url VARCHAR(255),
-    etl_timestamp TIMESTAMPTZ
-);
+    etl_timestamp TIMESTAMPTZ,
+    is_removed BOOLEAN DEFAULT FALSE,
+    hash_key_ip UUID,
+    hash_key_url UUID
+) PARTITION BY RANGE (etl_timestamp);
+
+-- DWH hash keys (MD5(COALESCE(x, ''))::UUID) computed by the loaders, NULL in rows loaded before them
+ALTER TABLE datalake.malware ADD COLUMN IF NOT EXISTS hash_key_url UUID;
+ALTER TABLE datalake.ads_and_trackers ADD COLUMN IF NOT EXISTS hash_key_ip UUID;
+ALTER TABLE datalake.ads_and_trackers ADD COLUMN IF NOT EXISTS hash_key_url UUID;
+
+-- Natural keys of the merge (INSERT ... ON CONFLICT) of datalake rows within the partition of a run,
+-- created on every partition. Unique indexes of a partitioned table have to include the partition key.
+DROP INDEX IF EXISTS datalake.malware_url_idx;
+DROP INDEX IF EXISTS datalake.ads_and_trackers_url_ip_idx;
+CREATE UNIQUE INDEX IF NOT EXISTS malware_merge_key_idx ON datalake.malware (url, etl_timestamp);
+CREATE UNIQUE INDEX IF NOT EXISTS ads_and_trackers_merge_key_idx ON datalake.ads_and_trackers (ip, url, etl_timestamp);
+
+DO $$
+
+DECLARE
+    datalake_table TEXT;
+BEGIN
+    FOREACH datalake_table IN ARRAY ARRAY['malware', 'ads_and_trackers'] LOOP
+        IF to_regclass(FORMAT('datalake.%I', datalake_table || '_unpartitioned')) IS NOT NULL THEN
+            EXECUTE FORMAT(
+                'SELECT datalake.create_time_partition(%L::REGCLASS, t.etl_timestamp)
+                FROM (SELECT DISTINCT etl_timestamp FROM datalake.%I WHERE etl_timestamp IS NOT NULL) AS t',
+                'datalake.' || datalake_table,
+                datalake_table || '_unpartitioned'
+            );
+            -- rows without etl_timestamp can't be routed to a range partition (the loaders always set it)
+            EXECUTE FORMAT(
+                'INSERT INTO datalake.%I SELECT * FROM datalake.%I WHERE etl_timestamp IS NOT NULL',
+                datalake_table,
+                datalake_table || '_unpartitioned'
+            );
+            EXECUTE FORMAT('DROP TABLE datalake.%I', datalake_table || '_unpartitioned');
+        END IF;
+    END LOOP;
+END;
+$$;
 
 
 -------------------------------------------------------------------------------
@@ -41,11 +256,72 @@ CREATE TABLE IF NOT EXISTS dwh.build_dwh_statistics (
     schema VARCHAR(10),
     table_name VARCHAR(20),
     res_row_count BIGINT,
+    inserted_row_count BIGINT,
+    updated_row_count BIGINT,
+    unchanged_row_count BIGINT,
     execution_time_min FLOAT,
     load_timestamp TIMESTAMPTZ,
     PRIMARY KEY (etl_timestamp, stage, schema, table_name)
 );
 
+ALTER TABLE dwh.build_dwh_statistics ADD COLUMN IF NOT EXISTS inserted_row_count BIGINT;
+ALTER TABLE dwh.build_dwh_statistics ADD COLUMN IF NOT EXISTS updated_row_count BIGINT;
+ALTER TABLE dwh.build_dwh_statistics ADD COLUMN IF NOT EXISTS unchanged_row_count BIGINT;
+-- rows deleted by the build (removed from the sources in diff load mode)
+ALTER TABLE dwh.build_dwh_statistics ADD COLUMN IF NOT EXISTS deleted_row_count BIGINT;
+
+-- Per-phase timings of a DWH table build, see datalake.build_datalake_phase_statistics
+-- DROP TABLE IF EXISTS dwh.build_dwh_phase_statistics;
+CREATE TABLE IF NOT EXISTS dwh.build_dwh_phase_statistics (
+    etl_timestamp TIMESTAMPTZ,
+    stage VARCHAR(20),
+    schema VARCHAR(10),
+    table_name VARCHAR(20),
+    phase VARCHAR(20),
+    calls BIGINT,
+    wall_time_sec FLOAT,
+    cpu_time_sec FLOAT,
+    p50_time_ms FLOAT,
+    p95_time_ms FLOAT,
+    max_queue_depth BIGINT,
+    bytes_downloaded BIGINT,
+    lines_read BIGINT,
+    rows_rejected BIGINT,
+    chunk_count BIGINT,
+    load_timestamp TIMESTAMPTZ,
+    allocated_bytes BIGINT,
+    top_function VARCHAR(255),
+    report_path VARCHAR(255),
+    PRIMARY KEY (etl_timestamp, stage, schema, table_name, phase)
+);
+
+-- Columns of queue phases and of the 'profile' phase rows, added to tables created before them
+ALTER TABLE dwh.build_dwh_phase_statistics ADD COLUMN IF NOT EXISTS allocated_bytes BIGINT;
+ALTER TABLE dwh.build_dwh_phase_statistics ADD COLUMN IF NOT EXISTS top_function VARCHAR(255);
+ALTER TABLE dwh.build_dwh_phase_statistics ADD COLUMN IF NOT EXISTS report_path VARCHAR(255);
+ALTER TABLE dwh.build_dwh_phase_statistics ADD COLUMN IF NOT EXISTS max_queue_depth BIGINT;
+
+--------------------------
+
+-- Delta of the datalake tables for the current DWH run, rebuilt by dwh/build_delta.sql and read by all DWH scripts.
+-- UNLOGGED: the content is derived from the datalake and rebuilt every run.
+CREATE UNLOGGED TABLE IF NOT EXISTS dwh.ads_and_trackers_delta (
+    ip VARCHAR(20),
+    url VARCHAR(255),
+    is_removed BOOLEAN,
+    hash_key_ip UUID,
+    hash_key_url UUID
+);
+CREATE INDEX IF NOT EXISTS ads_and_trackers_delta_hash_keys_idx ON dwh.ads_and_trackers_delta (hash_key_ip, hash_key_url);
+CREATE INDEX IF NOT EXISTS ads_and_trackers_delta_hash_key_url_idx ON dwh.ads_and_trackers_delta (hash_key_url);
+
+CREATE UNLOGGED TABLE IF NOT EXISTS dwh.malware_delta (
+    url VARCHAR(255),
+    is_removed BOOLEAN,
+    hash_key_url UUID
+);
+CREATE INDEX IF NOT EXISTS malware_delta_hash_key_url_idx ON dwh.malware_delta (hash_key_url);
+
 --------------------------
 
 -- DROP TABLE IF EXISTS dwh.hash_key_url_mapping CASCADE;
@@ -0,0 +1,30 @@
+-- Partitions older than the last {{ retention_runs }} completed runs. A run is completed when the DWH is built,
+-- the DWH delta of the next run starts from it, so rows of the runs before it are not read anymore.
+-- A source skipped as unchanged (or failed) loads nothing into newer partitions, so the partition of the last load
+-- of every source of the run is kept as well: it holds the only copy of the rows of the source
+-- Return Result Row Count:
+WITH retention AS (
+    SELECT etl_timestamp AS keep_from
+    FROM {{ schema }}.etl_runs
+    WHERE status = '{{ status }}'
+    ORDER BY etl_timestamp DESC
+    OFFSET {{ retention_runs - 1 }}
+    LIMIT 1
+),
+last_loads AS (
+    SELECT MAX(s.etl_timestamp) FILTER (WHERE s.status = '{{ loaded_status }}') AS loaded_at
+    FROM {{ schema }}.build_datalake_statistics AS s
+    WHERE s.table_name = '{{ table_name }}'
+      AND s.source IN (
+          SELECT r.source
+          FROM {{ schema }}.build_datalake_statistics AS r
+          WHERE r.table_name = '{{ table_name }}'
+            AND r.etl_timestamp = '{{ etl_timestamp }}'::TIMESTAMPTZ
+      )
+    GROUP BY s.source
+)
+SELECT datalake.drop_time_partitions(
+    '{{ schema }}.{{ table_name }}'::REGCLASS,
+    -- NULL (nothing is dropped) until there are {{ retention_runs }} completed runs
+    (SELECT LEAST(keep_from, (SELECT MIN(loaded_at) FROM last_loads)) FROM retention)
+);
@@ -0,0 +1 @@
+DROP TABLE IF EXISTS {{ staging_table }};
@@ -1,40 +1,44 @@
 --TRUNCATE dwh.ads_and_trackers;
 
-DROP TABLE IF EXISTS ads_and_trackers_temp;
-
-DO $$
-
-DECLARE
-    dwh_etl_timestamp timestamp;
-BEGIN
-    dwh_etl_timestamp := (SELECT MAX(etl_timestamp) FROM dwh.ads_and_trackers);
-
-
-    CREATE TEMP TABLE ads_and_trackers_temp AS
-        SELECT DISTINCT
-            a.ip,
-            a.url
-        FROM datalake.ads_and_trackers AS a
-        WHERE a.etl_timestamp >= COALESCE(dwh_etl_timestamp, a.etl_timestamp)
-        ;
-
+WITH source AS (
+    SELECT DISTINCT
+        hash_key_ip,
+        hash_key_url
+    FROM dwh.ads_and_trackers_delta
+    -- removal markers (diff load mode) only delete the rows, see removed
+    WHERE NOT is_removed
+),
+-- Rows removed from the sources (diff load mode), the delta has one state per row, so they are not in source
+removed AS (
+    DELETE FROM dwh.ads_and_trackers AS t
+    USING dwh.ads_and_trackers_delta AS d
+    WHERE t.hash_key_url = d.hash_key_url
+        AND t.hash_key_ip = d.hash_key_ip
+        AND d.is_removed
+    RETURNING 1
+),
+merged AS (
     INSERT INTO dwh.ads_and_trackers (
         hash_key_ip,
         hash_key_url,
         etl_timestamp
     )
     SELECT
-        MD5(COALESCE(ip, ''))::UUID AS hash_key_ip,
-        MD5(COALESCE(url, ''))::UUID AS hash_key_url,
+        hash_key_ip,
+        hash_key_url,
 --         '2023-12-12 14:36:18.302419 +00:00'::TIMESTAMPTZ
         '{{ etl_timestamp }}'::TIMESTAMPTZ AS etl_timestamp
-    FROM ads_and_trackers_temp
-    ;
-
-END;
-$$;
-
-DROP TABLE IF EXISTS ads_and_trackers_temp;
-
--- Return Result Row Count:
-SELECT COUNT(*) FROM dwh.ads_and_trackers;
+    FROM source
+    -- the row is the key, existing rows are unchanged
+    ON CONFLICT (hash_key_ip, hash_key_url) DO NOTHING
+    RETURNING (xmax = 0) AS inserted
+)
+-- Return Result Row Count (rows of the table are estimated, see datalake.estimated_row_count):
+SELECT
+    COUNT(*) FILTER (WHERE inserted) AS inserted_row_count,
+    COUNT(*) FILTER (WHERE NOT inserted) AS updated_row_count,
+    (SELECT COUNT(*) FROM source) - COUNT(*) AS unchanged_row_count,
+    datalake.estimated_row_count('dwh.ads_and_trackers') + COUNT(*) FILTER (WHERE inserted)
+        - (SELECT COUNT(*) FROM removed) AS res_row_count,
+    (SELECT COUNT(*) FROM removed) AS deleted_row_count
+FROM merged;
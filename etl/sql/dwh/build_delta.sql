@@ -0,0 +1,79 @@
+DO $$
+
+DECLARE
+    ads_and_trackers_dwh_etl_timestamp timestamptz;
+    malware_dwh_etl_timestamp timestamptz;
+BEGIN
+    -- The delta of a datalake table starts from the oldest of the last successful builds (build_dwh_statistics) of
+    -- the DWH tables built from it ('-infinity', i.e. full load, when any of them has never been built), so a table
+    -- failed in a previous run gets its rows again. etl_timestamp of DWH rows is only set when they change (upserts).
+    -- The plain comparison with the watermark lets the planner prune the older datalake partitions.
+    SELECT CASE WHEN COUNT(*) = 3 THEN MIN(w.etl_timestamp) ELSE '-infinity' END
+    INTO ads_and_trackers_dwh_etl_timestamp
+    FROM (
+        SELECT MAX(etl_timestamp) AS etl_timestamp
+        FROM dwh.build_dwh_statistics
+        WHERE table_name IN ('ads_and_trackers', 'hash_key_ip_mapping', 'hash_key_url_mapping')
+        GROUP BY table_name
+    ) AS w;
+
+    SELECT CASE WHEN COUNT(*) = 2 THEN MIN(w.etl_timestamp) ELSE '-infinity' END
+    INTO malware_dwh_etl_timestamp
+    FROM (
+        SELECT MAX(etl_timestamp) AS etl_timestamp
+        FROM dwh.build_dwh_statistics
+        WHERE table_name IN ('malware', 'hash_key_url_mapping')
+        GROUP BY table_name
+    ) AS w;
+
+
+    -----------------------------------------------------------------------------
+    -- Latest state of every row loaded to the datalake since the watermark with the hash keys computed by the loaders
+    -- (computed here only for rows loaded before the loaders stored them)
+    TRUNCATE dwh.ads_and_trackers_delta;
+
+    INSERT INTO dwh.ads_and_trackers_delta (
+        ip,
+        url,
+        is_removed,
+        hash_key_ip,
+        hash_key_url
+    )
+    SELECT DISTINCT ON (a.ip, a.url)
+        a.ip,
+        a.url,
+        COALESCE(a.is_removed, FALSE) AS is_removed,
+        COALESCE(a.hash_key_ip, MD5(COALESCE(a.ip, ''))::UUID) AS hash_key_ip,
+        COALESCE(a.hash_key_url, MD5(COALESCE(a.url, ''))::UUID) AS hash_key_url
+    FROM datalake.ads_and_trackers AS a
+    WHERE a.etl_timestamp >= ads_and_trackers_dwh_etl_timestamp
+    ORDER BY a.ip, a.url, a.etl_timestamp DESC
+    ;
+    -----------------------------------------------------------------------------
+
+    -----------------------------------------------------------------------------
+    TRUNCATE dwh.malware_delta;
+
+    INSERT INTO dwh.malware_delta (
+        url,
+        is_removed,
+        hash_key_url
+    )
+    SELECT DISTINCT ON (a.url)
+        a.url,
+        COALESCE(a.is_removed, FALSE) AS is_removed,
+        COALESCE(a.hash_key_url, MD5(COALESCE(a.url, ''))::UUID) AS hash_key_url
+    FROM datalake.malware AS a
+    WHERE a.etl_timestamp >= malware_dwh_etl_timestamp
+    ORDER BY a.url, a.etl_timestamp DESC
+    ;
+    -----------------------------------------------------------------------------
+
+END;
+$$;
+
+ANALYZE dwh.ads_and_trackers_delta;
+ANALYZE dwh.malware_delta;
+
+-- Return Result Row Count:
+SELECT (SELECT COUNT(*) FROM dwh.ads_and_trackers_delta) + (SELECT COUNT(*) FROM dwh.malware_delta);
@@ -1,38 +1,40 @@
 --TRUNCATE dwh.malware;
 
-DROP TABLE IF EXISTS malware_temp;
-
-DO $$
-
-DECLARE
-    dwh_etl_timestamp timestamp;
-BEGIN
-    dwh_etl_timestamp := (SELECT MAX(etl_timestamp) FROM dwh.malware);
-
-
-    CREATE TEMP TABLE malware_temp AS
-        SELECT DISTINCT
-            a.url
-        FROM datalake.malware AS a
-        WHERE a.etl_timestamp >= COALESCE(dwh_etl_timestamp, a.etl_timestamp)
-        ;
-
-
+WITH source AS (
+    SELECT DISTINCT
+        hash_key_url
+    FROM dwh.malware_delta
+    -- removal markers (diff load mode) only delete the rows, see removed
+    WHERE NOT is_removed
+),
+-- Rows removed from the sources (diff load mode), the delta has one state per row, so they are not in source
+removed AS (
+    DELETE FROM dwh.malware AS t
+    USING dwh.malware_delta AS d
+    WHERE t.hash_key_url = d.hash_key_url
+        AND d.is_removed
+    RETURNING 1
+),
+merged AS (
     INSERT INTO dwh.malware (
         hash_key_url,
         etl_timestamp
     )
     SELECT
-        MD5(COALESCE(url, ''))::UUID AS hash_key_url,
+        hash_key_url,
 --         '2023-12-12 14:36:18.302419 +00:00'::TIMESTAMPTZ
         '{{ etl_timestamp }}'::TIMESTAMPTZ AS etl_timestamp
-    FROM malware_temp
-    ;
-
-END;
-$$;
-
-DROP TABLE IF EXISTS malware_temp;
-
--- Return Result Row Count:
-SELECT COUNT(*) FROM dwh.malware;
+    FROM source
+    -- the row is the key, existing rows are unchanged
+    ON CONFLICT (hash_key_url) DO NOTHING
+    RETURNING (xmax = 0) AS inserted
+)
+-- Return Result Row Count (rows of the table are estimated, see datalake.estimated_row_count):
+SELECT
+    COUNT(*) FILTER (WHERE inserted) AS inserted_row_count,
+    COUNT(*) FILTER (WHERE NOT inserted) AS updated_row_count,
+    (SELECT COUNT(*) FROM source) - COUNT(*) AS unchanged_row_count,
+    datalake.estimated_row_count('dwh.malware') + COUNT(*) FILTER (WHERE inserted)
+        - (SELECT COUNT(*) FROM removed) AS res_row_count,
+    (SELECT COUNT(*) FROM removed) AS deleted_row_count
+FROM merged;
@@ -0,0 +1,5 @@
+-- Rows of a table written by the run (export of CsvExportSink), portable to the SQLite sink
+SELECT *
+FROM {{ schema }}.{{ table_name }}
+WHERE etl_timestamp = '{{ etl_timestamp }}'
+;
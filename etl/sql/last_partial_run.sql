@@ -0,0 +1,7 @@
+-- Id of the latest run which didn't finish
+SELECT run_id
+FROM datalake.etl_runs
+WHERE status = '{{ status }}'
+ORDER BY etl_timestamp DESC
+LIMIT 1
+;
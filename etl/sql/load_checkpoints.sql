@@ -0,0 +1,5 @@
+-- Chunk checkpoints of the sources of a run as one JSON array
+SELECT COALESCE(JSON_AGG(c), '[]'::JSON)
+FROM {{ schema }}.{{ table_name }} AS c
+WHERE etl_timestamp = '{{ etl_timestamp }}'::TIMESTAMPTZ
+;
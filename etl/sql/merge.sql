@@ -0,0 +1,48 @@
+-- Staging table is already filled by COPY (create_staging_table.sql) or by the chunks of a source
+-- (create_source_staging_table.sql) when values are not rendered, the temp one is dropped with the commit of the merge
+{% if values %}
+DROP TABLE IF EXISTS {{ staging_table }};
+
+CREATE TEMP TABLE {{ staging_table }} (LIKE {{ schema }}.{{ table_name }}) ON COMMIT DROP;
+
+INSERT INTO {{ staging_table }} (
+    {{ fields }}
+)
+VALUES {{ values }}
+;
+{% endif %}
+
+-- Rows are upserted on the natural key of the target: new keys are inserted, existing keys are updated only when
+-- their other fields differ. Rows of the target are estimated (see datalake.estimated_row_count) plus the inserted ones.
+WITH source AS (
+    SELECT DISTINCT ON ({{ key_fields | join(', ') }})
+        *
+    FROM (
+        SELECT
+            {{ fields }}{% if load_etl_timestamp %},
+            '{{ etl_timestamp }}'::TIMESTAMPTZ AS etl_timestamp{% endif %}
+        FROM {{ staging_table }}
+    ) AS s
+),
+merged AS (
+    INSERT INTO {{ schema }}.{{ table_name }} AS t (
+        {{ fields }}{% if load_etl_timestamp %},
+        etl_timestamp{% endif %}
+    )
+    SELECT * FROM source
+    ON CONFLICT ({{ key_fields | join(', ') }}) DO
+    {%- if update_fields %} UPDATE SET
+        {% for f in update_fields %}{{ f }} = EXCLUDED.{{ f }}{% if not loop.last %}, {% endif %}{% endfor %}
+    WHERE ({% for f in update_fields %}t.{{ f }}{% if not loop.last %}, {% endif %}{% endfor %})
+        IS DISTINCT FROM ({% for f in update_fields %}EXCLUDED.{{ f }}{% if not loop.last %}, {% endif %}{% endfor %})
+    {%- else %} NOTHING{% endif %}
+    RETURNING (xmax = 0) AS inserted
+)
+-- Return Result Row Count:
+SELECT
+    COUNT(*) FILTER (WHERE inserted) AS inserted_row_count,
+    COUNT(*) FILTER (WHERE NOT inserted) AS updated_row_count,
+    (SELECT COUNT(*) FROM source) - COUNT(*) AS unchanged_row_count,
+    datalake.estimated_row_count('{{ schema }}.{{ table_name }}') + COUNT(*) FILTER (WHERE inserted) AS res_row_count
+FROM merged
+;
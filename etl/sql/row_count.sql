@@ -0,0 +1,2 @@
+-- Exact rows of a table, a sampled check of the estimated res_row_count of merges (ROW_COUNT_EXACT_SAMPLE_RATE)
+SELECT COUNT(*) FROM {{ schema }}.{{ table_name }};
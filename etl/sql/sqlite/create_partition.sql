@@ -0,0 +1,4 @@
+-- Tables of the SQLite sink are not partitioned
+
+-- Return Result Row Count:
+SELECT 0;
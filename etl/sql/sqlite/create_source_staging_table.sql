@@ -0,0 +1,7 @@
+-- Staging table of a source in "source" staging mode (see sql/create_source_staging_table.sql),
+-- a resumed source keeps the rows staged by the interrupted run
+{% if not resumed %}
+DROP TABLE IF EXISTS {{ staging_table }};
+{% endif %}
+
+CREATE TABLE IF NOT EXISTS {{ staging_table }} AS SELECT * FROM {{ schema }}.{{ table_name }} WHERE FALSE;
@@ -0,0 +1,3 @@
+DROP TABLE IF EXISTS temp.{{ staging_table }};
+
+CREATE TEMP TABLE {{ staging_table }} AS SELECT * FROM {{ schema }}.{{ table_name }} WHERE FALSE;
@@ -0,0 +1,168 @@
+-- Schema of the SQLite sink (see sql/db_schema.sql): 'datalake' and 'dwh' are attached databases.
+-- Tables are not partitioned, timestamps are stored as text and foreign keys are not declared.
+CREATE TABLE IF NOT EXISTS datalake.build_datalake_statistics (
+    etl_timestamp TEXT,
+    stage TEXT,
+    schema TEXT,
+    table_name TEXT,
+    source TEXT,
+    inserting_row_count BIGINT,
+    res_row_count BIGINT,
+    status TEXT,
+    parse_lines_per_sec FLOAT,
+    duplicate_row_count BIGINT,
+    removed_row_count BIGINT,
+    inserted_row_count BIGINT,
+    updated_row_count BIGINT,
+    unchanged_row_count BIGINT,
+    execution_time_min FLOAT,
+    load_timestamp TEXT,
+    PRIMARY KEY (etl_timestamp, stage, schema, table_name, source)
+);
+
+CREATE TABLE IF NOT EXISTS datalake.build_datalake_phase_statistics (
+    etl_timestamp TEXT,
+    stage TEXT,
+    schema TEXT,
+    table_name TEXT,
+    source TEXT,
+    phase TEXT,
+    calls BIGINT,
+    wall_time_sec FLOAT,
+    cpu_time_sec FLOAT,
+    p50_time_ms FLOAT,
+    p95_time_ms FLOAT,
+    max_queue_depth BIGINT,
+    bytes_downloaded BIGINT,
+    lines_read BIGINT,
+    rows_rejected BIGINT,
+    chunk_count BIGINT,
+    load_timestamp TEXT,
+    allocated_bytes BIGINT,
+    top_function TEXT,
+    report_path TEXT,
+    PRIMARY KEY (etl_timestamp, stage, schema, table_name, source, phase)
+);
+
+CREATE TABLE IF NOT EXISTS datalake.etl_runs (
+    etl_timestamp TEXT PRIMARY KEY,
+    run_id TEXT,
+    status TEXT,
+    started_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS datalake.load_checkpoints (
+    etl_timestamp TEXT,
+    table_name TEXT,
+    source TEXT,
+    chunk_number BIGINT,
+    row_offset BIGINT,
+    content_hash TEXT,
+    status TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (etl_timestamp, table_name, source)
+);
+
+CREATE TABLE IF NOT EXISTS datalake.malware (
+    url TEXT,
+    etl_timestamp TEXT,
+    is_removed BOOLEAN DEFAULT FALSE,
+    hash_key_url TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS datalake.malware_merge_key_idx ON malware (url, etl_timestamp);
+
+CREATE TABLE IF NOT EXISTS datalake.ads_and_trackers (
+    ip TEXT,
+    url TEXT,
+    etl_timestamp TEXT,
+    is_removed BOOLEAN DEFAULT FALSE,
+    hash_key_ip TEXT,
+    hash_key_url TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS datalake.ads_and_trackers_merge_key_idx ON ads_and_trackers (ip, url, etl_timestamp);
+
+--------------------------
+
+CREATE TABLE IF NOT EXISTS dwh.build_dwh_statistics (
+    etl_timestamp TEXT,
+    stage TEXT,
+    schema TEXT,
+    table_name TEXT,
+    res_row_count BIGINT,
+    inserted_row_count BIGINT,
+    updated_row_count BIGINT,
+    unchanged_row_count BIGINT,
+    deleted_row_count BIGINT,
+    execution_time_min FLOAT,
+    load_timestamp TEXT,
+    PRIMARY KEY (etl_timestamp, stage, schema, table_name)
+);
+
+CREATE TABLE IF NOT EXISTS dwh.build_dwh_phase_statistics (
+    etl_timestamp TEXT,
+    stage TEXT,
+    schema TEXT,
+    table_name TEXT,
+    phase TEXT,
+    calls BIGINT,
+    wall_time_sec FLOAT,
+    cpu_time_sec FLOAT,
+    p50_time_ms FLOAT,
+    p95_time_ms FLOAT,
+    max_queue_depth BIGINT,
+    bytes_downloaded BIGINT,
+    lines_read BIGINT,
+    rows_rejected BIGINT,
+    chunk_count BIGINT,
+    load_timestamp TEXT,
+    allocated_bytes BIGINT,
+    top_function TEXT,
+    report_path TEXT,
+    PRIMARY KEY (etl_timestamp, stage, schema, table_name, phase)
+);
+
+--------------------------
+
+CREATE TABLE IF NOT EXISTS dwh.ads_and_trackers_delta (
+    ip TEXT,
+    url TEXT,
+    is_removed BOOLEAN,
+    hash_key_ip TEXT,
+    hash_key_url TEXT
+);
+CREATE INDEX IF NOT EXISTS dwh.ads_and_trackers_delta_hash_keys_idx ON ads_and_trackers_delta (hash_key_ip, hash_key_url);
+CREATE INDEX IF NOT EXISTS dwh.ads_and_trackers_delta_hash_key_url_idx ON ads_and_trackers_delta (hash_key_url);
+
+CREATE TABLE IF NOT EXISTS dwh.malware_delta (
+    url TEXT,
+    is_removed BOOLEAN,
+    hash_key_url TEXT
+);
+CREATE INDEX IF NOT EXISTS dwh.malware_delta_hash_key_url_idx ON malware_delta (hash_key_url);
+
+--------------------------
+
+CREATE TABLE IF NOT EXISTS dwh.hash_key_url_mapping (
+    hash_key TEXT PRIMARY KEY,
+    url TEXT,
+    etl_timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS dwh.hash_key_ip_mapping (
+    hash_key TEXT PRIMARY KEY,
+    ip TEXT,
+    etl_timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS dwh.malware (
+    hash_key_url TEXT PRIMARY KEY,
+    etl_timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS dwh.ads_and_trackers (
+    hash_key_ip TEXT,
+    hash_key_url TEXT,
+    etl_timestamp TEXT,
+    PRIMARY KEY (hash_key_ip, hash_key_url)
+);
@@ -0,0 +1,30 @@
+-- Tables of the SQLite sink are not partitioned, rows older than the last {{ retention_runs }} completed runs
+-- are deleted instead. Rows of the last load of every source of the run are kept, as in drop_partitions.sql
+WITH retention AS (
+    SELECT etl_timestamp AS keep_from
+    FROM {{ schema }}.etl_runs
+    WHERE status = '{{ status }}'
+    ORDER BY etl_timestamp DESC
+    LIMIT 1 OFFSET {{ retention_runs - 1 }}
+),
+last_loads AS (
+    SELECT MAX(CASE WHEN s.status = '{{ loaded_status }}' THEN s.etl_timestamp END) AS loaded_at
+    FROM {{ schema }}.build_datalake_statistics AS s
+    WHERE s.table_name = '{{ table_name }}'
+      AND s.source IN (
+          SELECT r.source
+          FROM {{ schema }}.build_datalake_statistics AS r
+          WHERE r.table_name = '{{ table_name }}'
+            AND r.etl_timestamp = '{{ etl_timestamp }}'
+      )
+    GROUP BY s.source
+)
+DELETE FROM {{ schema }}.{{ table_name }}
+WHERE etl_timestamp < (
+    -- Scalar MIN() of SQLite is NULL when one of its arguments is, unlike LEAST() of Postgres
+    SELECT MIN(keep_from, COALESCE((SELECT MIN(loaded_at) FROM last_loads), keep_from))
+    FROM retention
+);
+
+-- Return Result Row Count:
+SELECT changes();
@@ -0,0 +1,70 @@
+-- See sql/dwh/ads_and_trackers.sql, the rows are counted against the target before the delete and the insert
+DROP TABLE IF EXISTS temp.ads_and_trackers_source;
+
+CREATE TEMP TABLE ads_and_trackers_source AS
+SELECT DISTINCT
+    hash_key_ip,
+    hash_key_url
+FROM dwh.ads_and_trackers_delta
+-- removal markers (diff load mode) only delete the rows
+WHERE NOT is_removed;
+
+DROP TABLE IF EXISTS temp.ads_and_trackers_counts;
+
+CREATE TEMP TABLE ads_and_trackers_counts AS
+SELECT
+    (
+        SELECT COUNT(*)
+        FROM ads_and_trackers_source AS s
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM dwh.ads_and_trackers AS t
+            WHERE t.hash_key_ip = s.hash_key_ip
+                AND t.hash_key_url = s.hash_key_url
+        )
+    ) AS inserted_row_count,
+    (SELECT COUNT(*) FROM ads_and_trackers_source) AS source_row_count,
+    (
+        SELECT COUNT(*)
+        FROM dwh.ads_and_trackers AS t
+        WHERE EXISTS (
+            SELECT 1
+            FROM dwh.ads_and_trackers_delta AS d
+            WHERE t.hash_key_ip = d.hash_key_ip
+                AND t.hash_key_url = d.hash_key_url
+                AND d.is_removed
+        )
+    ) AS deleted_row_count;
+
+-- Rows removed from the sources (diff load mode)
+DELETE FROM dwh.ads_and_trackers
+WHERE EXISTS (
+    SELECT 1
+    FROM dwh.ads_and_trackers_delta AS d
+    WHERE ads_and_trackers.hash_key_ip = d.hash_key_ip
+        AND ads_and_trackers.hash_key_url = d.hash_key_url
+        AND d.is_removed
+);
+
+INSERT INTO dwh.ads_and_trackers (
+    hash_key_ip,
+    hash_key_url,
+    etl_timestamp
+)
+SELECT
+    hash_key_ip,
+    hash_key_url,
+    '{{ etl_timestamp }}' AS etl_timestamp
+FROM ads_and_trackers_source
+WHERE TRUE
+-- the row is the key, existing rows are unchanged
+ON CONFLICT (hash_key_ip, hash_key_url) DO NOTHING;
+
+-- Return Result Row Count:
+SELECT
+    inserted_row_count,
+    0 AS updated_row_count,
+    source_row_count - inserted_row_count AS unchanged_row_count,
+    (SELECT COUNT(*) FROM dwh.ads_and_trackers) AS res_row_count,
+    deleted_row_count
+FROM ads_and_trackers_counts;
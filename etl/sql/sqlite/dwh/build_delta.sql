@@ -0,0 +1,81 @@
+-- Delta of the datalake tables for the DWH run (see sql/dwh/build_delta.sql): latest state of every row loaded since
+-- the oldest of the last builds of the DWH tables built from it, '' (before any timestamp) is the full load
+DROP TABLE IF EXISTS temp.dwh_watermarks;
+
+CREATE TEMP TABLE dwh_watermarks AS
+SELECT
+    (
+        SELECT CASE WHEN COUNT(*) = 3 THEN MIN(w.etl_timestamp) ELSE '' END
+        FROM (
+            SELECT MAX(etl_timestamp) AS etl_timestamp
+            FROM dwh.build_dwh_statistics
+            WHERE table_name IN ('ads_and_trackers', 'hash_key_ip_mapping', 'hash_key_url_mapping')
+            GROUP BY table_name
+        ) AS w
+    ) AS ads_and_trackers,
+    (
+        SELECT CASE WHEN COUNT(*) = 2 THEN MIN(w.etl_timestamp) ELSE '' END
+        FROM (
+            SELECT MAX(etl_timestamp) AS etl_timestamp
+            FROM dwh.build_dwh_statistics
+            WHERE table_name IN ('malware', 'hash_key_url_mapping')
+            GROUP BY table_name
+        ) AS w
+    ) AS malware;
+
+-----------------------------------------------------------------------------
+DELETE FROM dwh.ads_and_trackers_delta;
+
+INSERT INTO dwh.ads_and_trackers_delta (
+    ip,
+    url,
+    is_removed,
+    hash_key_ip,
+    hash_key_url
+)
+SELECT
+    ip,
+    url,
+    is_removed,
+    hash_key_ip,
+    hash_key_url
+FROM (
+    SELECT
+        a.ip,
+        a.url,
+        COALESCE(a.is_removed, FALSE) AS is_removed,
+        a.hash_key_ip,
+        a.hash_key_url,
+        ROW_NUMBER() OVER (PARTITION BY a.ip, a.url ORDER BY a.etl_timestamp DESC) AS version
+    FROM datalake.ads_and_trackers AS a
+    WHERE a.etl_timestamp >= (SELECT ads_and_trackers FROM dwh_watermarks)
+) AS a
+WHERE version = 1;
+-----------------------------------------------------------------------------
+
+-----------------------------------------------------------------------------
+DELETE FROM dwh.malware_delta;
+
+INSERT INTO dwh.malware_delta (
+    url,
+    is_removed,
+    hash_key_url
+)
+SELECT
+    url,
+    is_removed,
+    hash_key_url
+FROM (
+    SELECT
+        a.url,
+        COALESCE(a.is_removed, FALSE) AS is_removed,
+        a.hash_key_url,
+        ROW_NUMBER() OVER (PARTITION BY a.url ORDER BY a.etl_timestamp DESC) AS version
+    FROM datalake.malware AS a
+    WHERE a.etl_timestamp >= (SELECT malware FROM dwh_watermarks)
+) AS a
+WHERE version = 1;
+-----------------------------------------------------------------------------
+
+-- Return Result Row Count:
+SELECT (SELECT COUNT(*) FROM dwh.ads_and_trackers_delta) + (SELECT COUNT(*) FROM dwh.malware_delta);
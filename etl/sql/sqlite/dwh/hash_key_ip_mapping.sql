@@ -0,0 +1,43 @@
+-- See sql/dwh/hash_key_ip_mapping.sql, the rows are counted against the target before the upsert
+DROP TABLE IF EXISTS temp.hash_key_ip_source;
+
+CREATE TEMP TABLE hash_key_ip_source AS
+SELECT DISTINCT
+    hash_key_ip AS hash_key,
+    NULLIF(ip, '') AS ip
+FROM dwh.ads_and_trackers_delta;
+
+DROP TABLE IF EXISTS temp.hash_key_ip_counts;
+
+CREATE TEMP TABLE hash_key_ip_counts AS
+SELECT
+    COALESCE(SUM(t.hash_key IS NULL), 0) AS inserted_row_count,
+    COALESCE(SUM(t.hash_key IS NOT NULL AND t.ip IS NOT s.ip), 0) AS updated_row_count,
+    COALESCE(SUM(t.hash_key IS NOT NULL AND t.ip IS s.ip), 0) AS unchanged_row_count
+FROM hash_key_ip_source AS s
+LEFT JOIN dwh.hash_key_ip_mapping AS t
+    ON t.hash_key = s.hash_key;
+
+INSERT INTO dwh.hash_key_ip_mapping (
+    hash_key,
+    ip,
+    etl_timestamp
+)
+SELECT
+    hash_key,
+    ip,
+    '{{ etl_timestamp }}' AS etl_timestamp
+FROM hash_key_ip_source
+WHERE TRUE
+ON CONFLICT (hash_key) DO UPDATE SET
+    ip = excluded.ip,
+    etl_timestamp = excluded.etl_timestamp
+WHERE hash_key_ip_mapping.ip IS NOT excluded.ip;
+
+-- Return Result Row Count:
+SELECT
+    inserted_row_count,
+    updated_row_count,
+    unchanged_row_count,
+    (SELECT COUNT(*) FROM dwh.hash_key_ip_mapping) AS res_row_count
+FROM hash_key_ip_counts;
@@ -0,0 +1,48 @@
+-- See sql/dwh/hash_key_url_mapping.sql, the rows are counted against the target before the upsert
+DROP TABLE IF EXISTS temp.hash_key_url_source;
+
+CREATE TEMP TABLE hash_key_url_source AS
+SELECT
+    hash_key_url AS hash_key,
+    NULLIF(url, '') AS url
+FROM dwh.ads_and_trackers_delta
+UNION
+SELECT
+    hash_key_url AS hash_key,
+    NULLIF(url, '') AS url
+FROM dwh.malware_delta;
+
+DROP TABLE IF EXISTS temp.hash_key_url_counts;
+
+CREATE TEMP TABLE hash_key_url_counts AS
+SELECT
+    COALESCE(SUM(t.hash_key IS NULL), 0) AS inserted_row_count,
+    COALESCE(SUM(t.hash_key IS NOT NULL AND t.url IS NOT s.url), 0) AS updated_row_count,
+    COALESCE(SUM(t.hash_key IS NOT NULL AND t.url IS s.url), 0) AS unchanged_row_count
+FROM hash_key_url_source AS s
+LEFT JOIN dwh.hash_key_url_mapping AS t
+    ON t.hash_key = s.hash_key;
+
+INSERT INTO dwh.hash_key_url_mapping (
+    hash_key,
+    url,
+    etl_timestamp
+)
+SELECT
+    hash_key,
+    url,
+    '{{ etl_timestamp }}' AS etl_timestamp
+FROM hash_key_url_source
+WHERE TRUE
+ON CONFLICT (hash_key) DO UPDATE SET
+    url = excluded.url,
+    etl_timestamp = excluded.etl_timestamp
+WHERE hash_key_url_mapping.url IS NOT excluded.url;
+
+-- Return Result Row Count:
+SELECT
+    inserted_row_count,
+    updated_row_count,
+    unchanged_row_count,
+    (SELECT COUNT(*) FROM dwh.hash_key_url_mapping) AS res_row_count
+FROM hash_key_url_counts;
@@ -0,0 +1,50 @@
+-- See sql/dwh/malware.sql, the rows are counted against the target before the delete and the insert
+DROP TABLE IF EXISTS temp.malware_source;
+
+CREATE TEMP TABLE malware_source AS
+SELECT DISTINCT
+    hash_key_url
+FROM dwh.malware_delta
+-- removal markers (diff load mode) only delete the rows
+WHERE NOT is_removed;
+
+DROP TABLE IF EXISTS temp.malware_counts;
+
+CREATE TEMP TABLE malware_counts AS
+SELECT
+    (
+        SELECT COUNT(*)
+        FROM malware_source AS s
+        WHERE NOT EXISTS (SELECT 1 FROM dwh.malware AS t WHERE t.hash_key_url = s.hash_key_url)
+    ) AS inserted_row_count,
+    (SELECT COUNT(*) FROM malware_source) AS source_row_count,
+    (
+        SELECT COUNT(*)
+        FROM dwh.malware AS t
+        WHERE EXISTS (SELECT 1 FROM dwh.malware_delta AS d WHERE t.hash_key_url = d.hash_key_url AND d.is_removed)
+    ) AS deleted_row_count;
+
+-- Rows removed from the sources (diff load mode)
+DELETE FROM dwh.malware
+WHERE EXISTS (SELECT 1 FROM dwh.malware_delta AS d WHERE malware.hash_key_url = d.hash_key_url AND d.is_removed);
+
+INSERT INTO dwh.malware (
+    hash_key_url,
+    etl_timestamp
+)
+SELECT
+    hash_key_url,
+    '{{ etl_timestamp }}' AS etl_timestamp
+FROM malware_source
+WHERE TRUE
+-- the row is the key, existing rows are unchanged
+ON CONFLICT (hash_key_url) DO NOTHING;
+
+-- Return Result Row Count:
+SELECT
+    inserted_row_count,
+    0 AS updated_row_count,
+    source_row_count - inserted_row_count AS unchanged_row_count,
+    (SELECT COUNT(*) FROM dwh.malware) AS res_row_count,
+    deleted_row_count
+FROM malware_counts;
@@ -0,0 +1,14 @@
+-- Chunk checkpoints of the sources of a run as one JSON array (text)
+SELECT json_group_array(json_object(
+    'etl_timestamp', etl_timestamp,
+    'table_name', table_name,
+    'source', source,
+    'chunk_number', chunk_number,
+    'row_offset', row_offset,
+    'content_hash', content_hash,
+    'status', status,
+    'updated_at', updated_at
+))
+FROM {{ schema }}.{{ table_name }}
+WHERE etl_timestamp = '{{ etl_timestamp }}'
+;
@@ -0,0 +1,48 @@
+-- Upsert of the staging table into the target on its natural key (see sql/merge.sql). SQLite can't return
+-- the rows of an upsert, so the rows are counted against the target before it.
+DROP TABLE IF EXISTS temp.merge_source;
+
+CREATE TEMP TABLE merge_source AS
+SELECT *
+FROM (
+    SELECT
+        {{ fields }}{% if load_etl_timestamp %},
+        '{{ etl_timestamp }}' AS etl_timestamp{% endif %}
+    FROM {{ staging_table }}
+) AS s
+GROUP BY {{ key_fields | join(', ') }};
+
+DROP TABLE IF EXISTS temp.merge_counts;
+
+CREATE TEMP TABLE merge_counts AS
+SELECT
+    COALESCE(SUM(matched IS NULL), 0) AS inserted_row_count,
+    COALESCE(SUM(matched IS NOT NULL AND changed), 0) AS updated_row_count,
+    COALESCE(SUM(matched IS NOT NULL AND NOT changed), 0) AS unchanged_row_count
+FROM (
+    SELECT
+        t.rowid AS matched,
+        {% if update_fields %}{% for f in update_fields %}t.{{ f }} IS NOT s.{{ f }}{% if not loop.last %} OR {% endif %}{% endfor %}{% else %}FALSE{% endif %} AS changed
+    FROM merge_source AS s
+    LEFT JOIN {{ schema }}.{{ table_name }} AS t
+        ON {% for f in key_fields %}t.{{ f }} = s.{{ f }}{% if not loop.last %} AND {% endif %}{% endfor %}
+) AS m;
+
+INSERT INTO {{ schema }}.{{ table_name }} (
+    {{ fields }}{% if load_etl_timestamp %},
+    etl_timestamp{% endif %}
+)
+SELECT * FROM merge_source WHERE TRUE
+ON CONFLICT ({{ key_fields | join(', ') }}) DO
+{%- if update_fields %} UPDATE SET
+    {% for f in update_fields %}{{ f }} = excluded.{{ f }}{% if not loop.last %}, {% endif %}{% endfor %}
+WHERE {% for f in update_fields %}{{ table_name }}.{{ f }} IS NOT excluded.{{ f }}{% if not loop.last %} OR {% endif %}{% endfor %}
+{%- else %} NOTHING{% endif %};
+
+-- Return Result Row Count (rows of the table are counted, the SQLite sink is local):
+SELECT
+    inserted_row_count,
+    updated_row_count,
+    unchanged_row_count,
+    (SELECT COUNT(*) FROM {{ schema }}.{{ table_name }}) AS res_row_count
+FROM merge_counts;
@@ -0,0 +1,12 @@
+-- Staging tables of sources of runs which are not partial (see sql/stale_staging_tables.sql)
+SELECT t.name AS table_name
+FROM {{ schema }}.sqlite_master AS t
+WHERE t.type = 'table'
+  AND t.name GLOB '*_staging_[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]t[0-9][0-9][0-9][0-9][0-9][0-9]_*'
+  AND SUBSTR(t.name, INSTR(t.name, '_staging_') + 9, 15) NOT IN (
+      SELECT LOWER(r.run_id)
+      FROM {{ schema }}.etl_runs AS r
+      WHERE r.status = '{{ status }}'
+        AND r.run_id IS NOT NULL
+  )
+;
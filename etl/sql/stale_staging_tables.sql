@@ -0,0 +1,13 @@
+-- Staging tables of sources in "source" staging mode ('<table>_staging_<run id>_<source key>') of runs which are
+-- not partial, the rows staged by a partial run are kept until it is resumed
+SELECT t.tablename AS table_name
+FROM pg_tables AS t
+WHERE t.schemaname = '{{ schema }}'
+  AND t.tablename ~ '_staging_[0-9]{8}t[0-9]{6}_[0-9a-f]{8}$'
+  AND SUBSTRING(t.tablename FROM '_staging_([0-9]{8}t[0-9]{6})_[0-9a-f]{8}$') NOT IN (
+      SELECT LOWER(r.run_id)
+      FROM {{ schema }}.etl_runs AS r
+      WHERE r.status = '{{ status }}'
+        AND r.run_id IS NOT NULL
+  )
+;
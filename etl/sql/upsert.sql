@@ -0,0 +1,8 @@
+-- Upsert of rendered rows of a small bookkeeping table (checkpoints, run status) on its key
+INSERT INTO {{ schema }}.{{ table_name }} (
+    {{ fields }}
+)
+VALUES {{ values }}
+ON CONFLICT ({{ key_fields | join(', ') }}) DO UPDATE SET
+    {% for f in update_fields %}{{ f }} = EXCLUDED.{{ f }}{% if not loop.last %}, {% endif %}{% endfor %}
+;
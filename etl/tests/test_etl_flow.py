@@ -1,5 +1,12 @@
+import os
+import json
+import sqlite3
 import pytest
+import uuid
+import hashlib
+import tracemalloc
 import logging
+import threading
 from unittest.mock import mock_open, patch, Mock, MagicMock
 from datetime import datetime, timezone
 import psycopg2
@@ -16,17 +23,63 @@ from utils import (
     DATALAKE_SCHEMA, ETL_TIMESTAMP,
     matcher,
     build_statistics,
+    build_http_session,
+    build_copy_buffer,
+    split_sql_statements,
+    SqlTemplateRegistry,
+    iter_response_blocks,
+    parse_source_conf,
+    parse_dwh_table_conf,
+    hash_key,
+    add_hash_keys,
 )
 
 from etl_flow import (
     RunETl,
     DB_SCHEMA_SQL_FILENAME,
-    CLEAR_DWH_SQL_FILE,
+    DWH_DELTA_SQL_FILE,
+    PARTITION_SQL_FILENAME,
+    DATALAKE_PARTITION_INTERVAL,
     DWH_SQL_FOLDER_PATH,
 )
 
 from db_connector import (
-    ConnectorDB
+    ConnectorDB,
+    ConnectionPool,
+)
+
+from fetch_cache import FetchCache
+
+from models import AdsAndTrackers, Malware
+
+from parsers import get_parser, HostsParser, AdblockParser, DomainListParser
+
+from dedup import RowDeduplicator, DIGEST_MEMORY_COST
+
+from snapshot import SnapshotStore, SnapshotWriter, diff_sorted, encode_row, decode_row
+
+from scheduler import run_dag, validate_dag, TASK_DONE
+
+from benchmark import iter_corpus_lines, run_pipeline
+
+from instrumentation import Recorder, NULL_RECORDER, recorder, recording, percentile
+
+from profiling import StageProfiler
+
+from parse_pool import ParsePool, ParsedSegment, parse_segment, iter_validated_chunks
+
+from pipeline import BoundedQueue, iter_in_thread, QueueWorker
+
+from chunking import AdaptiveChunkSize, payload_bytes
+
+from landing import LandingZone
+
+from sinks import Sink, SqliteSink, CsvExportSink
+
+from constants import (
+    ETL_RUN_ID, SOURCE_STATUS_LOADED, SOURCE_STATUS_UNCHANGED, SOURCE_STATUS_FAILED, MergeCounts,
+    RUN_STATUS_TABLE, RUN_STATUS_PARTIAL, RUN_STATUS_COMPLETED, CHECKPOINT_TABLE, CHECKPOINT_FIELDS,
+    MERGE_KEY_CHECKPOINT_FIELDS, RUN_STATUS_FIELDS, DROP_PARTITIONS_SQL_FILENAME,
 )
 
 
@@ -107,6 +160,26 @@ def test_render_sql_from_file_with_formatted_path():
             mock_file.assert_called_once_with(expected_file_path, 'r')
 
 
+def test_sql_template_registry_reloads_modified_file(tmp_path):
+    registry = SqlTemplateRegistry()
+    sql_file = tmp_path / "query.sql"
+    sql_file.write_text("SELECT {{ a }};")
+    assert registry.get(str(sql_file))[1].render(a=1) == "SELECT 1;"
+
+    with patch("builtins.open", side_effect=AssertionError("must be cached")):
+        assert registry.get(str(sql_file))[0] == "SELECT {{ a }};"
+
+    sql_file.write_text("SELECT {{ a }} + 1;")
+    os.utime(sql_file, ns=(0, 10 ** 9))
+    assert registry.get(str(sql_file))[1].render(a=1) == "SELECT 1 + 1;"
+
+
+def test_split_sql_statements():
+    sql = "-- comment\nBEGIN;\nINSERT INTO t VALUES ('a;b', 'it''s -- x'); -- tail\nSELECT 1"
+    assert split_sql_statements(sql) == ["BEGIN", "INSERT INTO t VALUES ('a;b', 'it''s -- x')", "SELECT 1"]
+    assert split_sql_statements("DO $$ BEGIN END; $$;") is None
+
+
 def test_build_values_with_empty_set():
     assert build_values(set()) == ""
 
@@ -133,13 +206,23 @@ def test_build_values_with_mixed_types():
     assert build_values(values) == f"(1, 'test', '{dt.isoformat()}')"
 
 
+def test_build_values_renders_none_as_null():
+    assert build_values([(None, 'a', 1)]) == "(NULL, 'a', 1)"
+
+
+def test_build_copy_buffer_keeps_empty_strings_and_nulls():
+    dt = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    buffer = build_copy_buffer([('', 'a.com'), (None, 'b,"c".com'), ('0.0.0.0', dt)])
+    assert buffer.read() == ',a.com\n\\N,"b,""c"".com"\n0.0.0.0,2023-01-01T00:00:00+00:00\n'
+
+
 # Mock for build_values if needed
 @patch('utils.build_values', return_value="mocked values")
 def test_build_params_with_all_fields(mock_build_values):
     table_name = "test_table"
     values = {(1, 'data')}
     fields = ['field1', 'field2']
-    delete_where_fields = ['field1']
+    key_fields = ['field1']
     schema = "test_schema"
     etl_timestamp = datetime.now()
 
@@ -147,12 +230,15 @@ def test_build_params_with_all_fields(mock_build_values):
         "table_name": table_name,
         "schema": schema,
         "fields": "field1, field2",
-        "delete_where": "test_table.field1 = test_schema_test_table_temp.field1",
+        "key_fields": ['field1'],
+        "update_fields": ['field2'],
+        "load_etl_timestamp": False,
         "values": "mocked values",
-        "etl_timestamp": etl_timestamp
+        "etl_timestamp": etl_timestamp,
+        "staging_table": "test_schema_test_table_temp",
     }
 
-    result = build_params(table_name, values, fields, delete_where_fields, schema, etl_timestamp)
+    result = build_params(table_name, values, fields, key_fields, schema, etl_timestamp)
     assert result == expected_result
     mock_build_values.assert_called_once_with(values)
 
@@ -167,15 +253,49 @@ def test_build_params_with_no_values():
         "table_name": table_name,
         "schema": schema,
         "fields": "field1, field2",
-        "delete_where": "test_table.field1 = test_schema_test_table_temp.field1 AND test_table.field2 = test_schema_test_table_temp.field2",
+        "key_fields": ['field1', 'field2'],
+        "update_fields": [],
+        "load_etl_timestamp": False,
         "values": None,
-        "etl_timestamp": etl_timestamp
+        "etl_timestamp": etl_timestamp,
+        "staging_table": "test_schema_test_table_temp",
     }
 
     result = build_params(table_name, schema=schema, fields=fields)
     assert result == expected_result
 
 
+def test_build_params_loads_etl_timestamp():
+    result = build_params("test_table", fields=['url', 'is_removed'], key_fields=['url', 'etl_timestamp'],
+                          load_etl_timestamp=True)
+    assert result["update_fields"] == ['is_removed']
+    assert result["load_etl_timestamp"] is True
+
+
+def test_merge_sql_upserts_on_key_fields(monkeypatch):
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), '..'))
+    sql = render_sql_from_file(file_name="merge", params_dict=build_params(
+        "malware", fields=['url', 'is_removed'], key_fields=['url', 'etl_timestamp'], load_etl_timestamp=True
+    ))
+    assert "ON CONFLICT (url, etl_timestamp) DO UPDATE SET" in sql
+    assert "is_removed = EXCLUDED.is_removed" in sql
+    assert "'::TIMESTAMPTZ AS etl_timestamp" in sql
+    # Merge is split into single statements for the SQLite sink
+    assert split_sql_statements(sql)[-1].startswith("WITH source AS")
+
+    sql = render_sql_from_file(file_name="merge", params_dict=build_params("dwh_table", fields=['a', 'b']))
+    assert "ON CONFLICT (a, b) DO NOTHING" in sql
+    assert "AS etl_timestamp" not in sql
+    assert "FROM datalake_dwh_table_temp" in sql
+
+    # Rows staged by all chunks of a source are merged from its staging table
+    sql = render_sql_from_file(file_name="merge", params_dict=build_params(
+        "malware", fields=['url'], staging_table="datalake.malware_staging_run_source"
+    ))
+    assert "FROM datalake.malware_staging_run_source" in sql
+    assert "CREATE TEMP TABLE" not in sql
+
+
 def test_build_params_with_defaults():
     table_name = "test_table"
 
@@ -183,9 +303,12 @@ def test_build_params_with_defaults():
         "table_name": table_name,
         "schema": DATALAKE_SCHEMA,
         "fields": None,
-        "delete_where": "",
+        "key_fields": [],
+        "update_fields": [],
+        "load_etl_timestamp": False,
         "values": None,
-        "etl_timestamp": ETL_TIMESTAMP
+        "etl_timestamp": ETL_TIMESTAMP,
+        "staging_table": "datalake_test_table_temp",
     }
 
     result = build_params(table_name)
@@ -203,6 +326,66 @@ def test_matcher_with_other_extension():
     assert matcher(url) is None
 
 
+def test_iter_response_blocks_across_chunks():
+    mock_response = Mock()
+    mock_response.encoding = 'utf-8'
+    mock_response.iter_content.return_value = [b'0.0.0.0 a.com\n0.0.0.0 b', b'.com\n# comment\n', b'0.0.0.0 c.com']
+    assert list(iter_response_blocks(mock_response, chunk_size=16)) == [
+        '0.0.0.0 a.com\n', '0.0.0.0 b.com\n# comment\n', '0.0.0.0 c.com'
+    ]
+    mock_response.iter_content.assert_called_once_with(chunk_size=16)
+
+
+def test_iter_response_blocks_end_on_line_boundary():
+    mock_response = Mock()
+    mock_response.encoding = 'utf-8'
+    mock_response.iter_content.return_value = [b'a.com\nb', b'.com', b'\nc.com']
+    assert list(iter_response_blocks(mock_response)) == ['a.com\n', 'b.com\n', 'c.com']
+
+
+def test_parse_source_conf():
+    assert parse_source_conf("https://example.com/hosts") == ("https://example.com/hosts", None)
+    assert parse_source_conf({"url": "https://example.com/a.txt", "format": "adblock"}) == (
+        "https://example.com/a.txt", "adblock"
+    )
+
+
+def test_parse_dwh_table_conf():
+    assert parse_dwh_table_conf("malware", ["a", "b"]) == ("malware", ["a", "b"])
+    assert parse_dwh_table_conf({"table": "malware", "depends_on": ["a"]}, ["a", "b"]) == ("malware", ["a"])
+    assert parse_dwh_table_conf({"table": "malware"}, ["a"]) == ("malware", [])
+
+
+def test_iter_response_blocks_split_multibyte_char():
+    mock_response = Mock()
+    mock_response.encoding = None
+    encoded = 'ex\u00e4mple.com\n'.encode('utf-8')
+    mock_response.iter_content.return_value = [encoded[:3], encoded[3:]]
+    assert list(iter_response_blocks(mock_response)) == ['ex\u00e4mple.com\n']
+
+
+def test_build_http_session_pool_sizes():
+    session = build_http_session(max_workers=3, max_per_host=2)
+    adapter = session.get_adapter("https://example.com")
+    assert adapter._pool_connections == 3
+    assert adapter._pool_maxsize == 2
+    assert adapter._pool_block is True
+
+
+def test_hash_key_matches_postgres_md5_uuid():
+    # SELECT MD5('')::UUID, MD5('a.com')::UUID
+    assert hash_key(None) == hash_key('') == 'd41d8cd9-8f00-b204-e980-0998ecf8427e'
+    assert hash_key('a.com') == str(uuid.UUID(hashlib.md5(b'a.com').hexdigest()))
+    assert hash_key('bücher.de') == str(uuid.UUID(hashlib.md5('bücher.de'.encode('utf-8')).hexdigest()))
+
+
+def test_add_hash_keys():
+    rows = add_hash_keys([('0.0.0.0', 'a.com')], key_indexes=[0, 1])
+    assert rows == [('0.0.0.0', 'a.com', hash_key('0.0.0.0'), hash_key('a.com'))]
+    assert Malware.get_hash_key_fields() == [(0, 'hash_key_url')]
+    assert AdsAndTrackers.get_hash_key_fields() == [(0, 'hash_key_ip'), (1, 'hash_key_url')]
+
+
 def mock_function(*args, **kwargs):
     # Simulate some operation
     return "result"
@@ -228,6 +411,21 @@ def test_build_statistics_decorator(mock_time):
 
 ############ Testing etl_flow.py ############
 
+@pytest.fixture(autouse=True)
+def landing_disabled():
+    # Fetched bodies are not landed in the state directory by tests, landing tests use a temporary one
+    with patch('etl_flow.LANDING_ENABLED', False):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def chunk_staging():
+    # Tests check the rows of every chunk: chunks are merged one by one and keep the size set by the test,
+    # "source" staging and adaptive chunk size are tested by themselves
+    with patch('etl_flow.DATALAKE_STAGING_MODE', 'chunk'), patch('etl_flow.DATALAKE_CHUNK_ADAPTIVE', False):
+        yield
+
+
 @pytest.fixture
 def mock_db_connector():
     with patch('etl_flow.ConnectorDB') as mock:
@@ -260,7 +458,8 @@ def test_etl_1_build_schema(mock_db_connector, mock_logger):
 def test_populate_datalake_success(mock_db_connector, mock_requests_get, mock_logger):
     mock_response = Mock()
     mock_response.status_code = 200
-    mock_response.text = 'sample data\n'
+    mock_response.encoding = 'utf-8'
+    mock_response.iter_content.return_value = [b'sample data\n']
     mock_requests_get.return_value = mock_response
 
     etl = RunETl()
@@ -273,31 +472,229 @@ def test_populate_datalake_failure(mock_db_connector, mock_requests_get, mock_lo
     mock_requests_get.return_value = mock_response
 
     etl = RunETl()
-    etl.populate_datalake(mock_response, 'ads_and_trackers', 'source')
+    result = etl.populate_datalake(mock_response, 'ads_and_trackers', 'source')
+    assert result.status == SOURCE_STATUS_FAILED
+
+
+def test_populate_datalake_unchanged(mock_db_connector, mock_logger):
+    mock_response = Mock()
+    mock_response.status_code = 304
+
+    etl = RunETl()
+    result = etl.populate_datalake(mock_response, 'ads_and_trackers', 'source', unchanged=True)
+
+    assert result == ('ads_and_trackers', 'source', 0, 0, SOURCE_STATUS_UNCHANGED, 0.0, 0, 0, 0, 0, 0)
+    mock_response.iter_content.assert_not_called()
+    # Only the statistics rows are written
+    assert [c.kwargs['sql_params']['table_name'] for c in mock_db_connector.load_rows.call_args_list] == [
+        'build_datalake_statistics', 'build_datalake_phase_statistics'
+    ]
+
+
+def _cached_fetch_etl(tmp_path, body: bytes, headers: dict = None):
+    etl = RunETl()
+    etl.fetch_cache = FetchCache(cache_dir=str(tmp_path))
+    response = MagicMock()
+    response.status_code = 200
+    response.encoding = 'utf-8'
+    response.headers = headers or {}
+    response.iter_content.return_value = [body]
+    etl.http_session = MagicMock()
+    etl.http_session.get.return_value.__enter__.return_value = response
+    return etl
+
+
+@patch('etl_flow.FETCH_CACHE_SPOOL', True)
+def test_fetch_and_populate_datalake_skips_identical_content(tmp_path, mock_db_connector, mock_logger):
+    body = b'0.0.0.0 a.com\n'
+    etl = _cached_fetch_etl(tmp_path, body, headers={"ETag": '"v1"'})
+
+    first = etl.fetch_and_populate_datalake('ads_and_trackers', 'https://a.example.com/hosts', threading.Semaphore())
+    second = etl.fetch_and_populate_datalake('ads_and_trackers', 'https://a.example.com/hosts', threading.Semaphore())
+
+    assert first.status == SOURCE_STATUS_LOADED
+    assert second.status == SOURCE_STATUS_UNCHANGED
+    assert etl.http_session.get.call_args.kwargs['headers'] == {"If-None-Match": '"v1"'}
+
 
+def test_fetch_and_populate_datalake_hashes_streamed_body(tmp_path, mock_db_connector, mock_logger):
+    body = b'0.0.0.0 a.com\n'
+    etl = _cached_fetch_etl(tmp_path, body, headers={"ETag": '"v1"'})
 
-def test_clear_dwh(mock_db_connector, mock_logger):
+    first = etl.fetch_and_populate_datalake('ads_and_trackers', 'https://a.example.com/hosts', threading.Semaphore())
+    second = etl.fetch_and_populate_datalake('ads_and_trackers', 'https://a.example.com/hosts', threading.Semaphore())
+
+    # Without spooling only a 304 response skips the source, the hash of the streamed body is still cached
+    assert first.status == second.status == SOURCE_STATUS_LOADED
+    assert etl.fetch_cache.is_unchanged('https://a.example.com/hosts', hashlib.sha256(body).hexdigest())
+    assert etl.http_session.get.call_args.kwargs['headers'] == {"If-None-Match": '"v1"'}
+
+
+def test_fetch_and_populate_datalake_not_modified(tmp_path, mock_db_connector, mock_logger):
+    etl = _cached_fetch_etl(tmp_path, b'')
+    etl.http_session.get.return_value.__enter__.return_value.status_code = 304
+
+    result = etl.fetch_and_populate_datalake('malware', 'https://a.example.com/m.txt', threading.Semaphore())
+    assert result.status == SOURCE_STATUS_UNCHANGED
+
+
+@patch('etl_flow.RunETl.populate_datalake')
+def test_etl_2_build_datalake_fetches_all_sources(mock_populate, mock_db_connector, mock_logger):
     etl = RunETl()
-    etl.clear_dwh()
-    mock_db_connector.run_sql.assert_called_with(sql_file_name=CLEAR_DWH_SQL_FILE, sql_folder_path=DWH_SQL_FOLDER_PATH)
+    etl.datalake_configs = [
+        ('ads_and_trackers', 'https://a.example.com/hosts'),
+        ('ads_and_trackers', {'url': 'https://b.example.com/adblock.txt', 'format': 'adblock'}),
+        ('malware', {'url': 'https://a.example.com/malware.txt', 'format': 'domains'}),
+    ]
+    etl.http_session = MagicMock()
+    etl.etl_2_build_datalake()
+
+    assert etl.http_session.get.call_count == 3
+    assert sorted((c.kwargs['source'], c.kwargs['source_format']) for c in mock_populate.call_args_list) == [
+        ('https://a.example.com/hosts', None),
+        ('https://a.example.com/malware.txt', 'domains'),
+        ('https://b.example.com/adblock.txt', 'adblock'),
+    ]
+    partitions = [c.kwargs['sql_params'] for c in mock_db_connector.run_sql.call_args_list
+                  if c.kwargs['sql_file_name'] == PARTITION_SQL_FILENAME]
+    assert [p['table_name'] for p in partitions] == ['ads_and_trackers', 'malware']
+    assert all(p['partition_interval'] == DATALAKE_PARTITION_INTERVAL for p in partitions)
+
+
+@patch('etl_flow.RunETl.populate_datalake')
+def test_etl_2_build_datalake_raises_after_all_sources(mock_populate, mock_db_connector, mock_logger):
+    etl = RunETl()
+    etl.datalake_configs = [('ads_and_trackers', 'https://a.example.com/hosts'), ('malware', 'https://b.example.com/m')]
+    etl.http_session = MagicMock()
+    etl.http_session.get.side_effect = [Exception("timeout"), MagicMock()]
+
+    with pytest.raises(Exception):
+        etl.etl_2_build_datalake()
+    assert etl.http_session.get.call_count == 2
+
+
+def test_etl_3_build_dwh_builds_delta(mock_db_connector, mock_logger):
+    etl = RunETl()
+    etl.dwh_configs = []
+    etl.etl_3_build_dwh()
+
+    sql_files = [c.kwargs['sql_file_name'] for c in mock_db_connector.run_sql.call_args_list]
+    assert sql_files == [DWH_DELTA_SQL_FILE]
 
 
 def test_populate_dwh(mock_db_connector):
+    mock_db_connector.run_sql.return_value = (3, 2, 1, 5, 4)
     etl = RunETl()
-    etl.populate_dwh('table', 'schema')
+    result = etl.populate_dwh('table', 'schema')
+
+    # table, res_row_count, inserted_row_count, updated_row_count, unchanged_row_count, deleted_row_count
+    assert result == ('table', 5, 3, 2, 1, 4)
+    assert mock_db_connector.run_sql.call_args.kwargs['return_row'] is True
+    # Rows of the table are estimated by the script, no exact count by default
+    assert mock_db_connector.run_sql.call_count == 1
+
+
+@patch('etl_flow.ROW_COUNT_EXACT_SAMPLE_RATE', 1.0)
+def test_populate_dwh_checks_exact_row_count(mock_db_connector, mock_logger):
+    mock_db_connector.run_sql.side_effect = [(3, 2, 1, 5), 7]
+    etl = RunETl()
+    result = etl.populate_dwh('table', 'schema')
+
+    assert result == ('table', 7, 3, 2, 1, 0)
+    row_count = mock_db_connector.run_sql.call_args.kwargs
+    assert row_count['sql_file_name'] == 'row_count'
+    assert (row_count['sql_params']['schema'], row_count['sql_params']['table_name']) == ('schema', 'table')
+
+
+def test_dwh_scripts_report_estimated_row_count(monkeypatch):
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), '..'))
+    for table in ('ads_and_trackers', 'malware', 'hash_key_ip_mapping', 'hash_key_url_mapping'):
+        sql = render_sql_from_file(file_name=table, params_dict=build_params(table, schema='dwh'),
+                                   sql_folder_path=DWH_SQL_FOLDER_PATH)
+        assert f"datalake.estimated_row_count('dwh.{table}')" in sql
+        assert f"COUNT(*) FROM dwh.{table}" not in sql
+    # Fact tables delete the rows removed from the sources in the same statement as the upsert
+    sql = render_sql_from_file(file_name='malware', sql_folder_path=DWH_SQL_FOLDER_PATH)
+    assert "removed AS (\n    DELETE FROM dwh.malware" in sql
+    assert sql.rstrip().endswith("(SELECT COUNT(*) FROM removed) AS deleted_row_count\nFROM merged;")
+
+
+@patch('etl_flow.RunETl.populate_dwh')
+def test_etl_3_build_dwh_follows_dependencies(mock_populate_dwh, mock_db_connector, mock_logger):
+    etl = RunETl()
+    etl.dwh_configs = [
+        ('dwh', {'table': 'map_a', 'depends_on': []}),
+        ('dwh', {'table': 'map_b', 'depends_on': []}),
+        ('dwh', {'table': 'fact', 'depends_on': ['map_a', 'map_b']}),
+    ]
+    etl.etl_3_build_dwh()
+
+    tables = [c.kwargs['table'] for c in mock_populate_dwh.call_args_list]
+    assert sorted(tables[:2]) == ['map_a', 'map_b']
+    assert tables[2] == 'fact'
+    mock_db_connector.run_sql.assert_called_with(sql_file_name=DWH_DELTA_SQL_FILE, sql_folder_path=DWH_SQL_FOLDER_PATH)
 
 
 # Test Full Data Flow
 @patch('etl_flow.RunETl.etl_1_build_schema')
 @patch('etl_flow.RunETl.etl_2_build_datalake')
 @patch('etl_flow.RunETl.etl_3_build_dwh')
-def test_data_flow(mock_etl_1, mock_etl_2, mock_etl_3, mock_logger):
+def test_data_flow(mock_etl_1, mock_etl_2, mock_etl_3, mock_db_connector, mock_logger):
     etl = RunETl()
     etl.data_flow()
 
     mock_etl_1.assert_called()
     mock_etl_2.assert_called()
     mock_etl_3.assert_called()
+    assert run_statuses(mock_db_connector) == [RUN_STATUS_PARTIAL, RUN_STATUS_COMPLETED]
+    # Partitions of old runs are dropped once the run is completed
+    drops = [c.kwargs['sql_params'] for c in mock_db_connector.run_sql.call_args_list
+             if c.kwargs['sql_file_name'] == DROP_PARTITIONS_SQL_FILENAME]
+    assert [p['table_name'] for p in drops] == ['ads_and_trackers', 'malware']
+    assert all(p['retention_runs'] == 7 and p['status'] == RUN_STATUS_COMPLETED for p in drops)
+
+
+def run_statuses(mock_db_connector):
+    values = [c.kwargs['sql_params']['values'] for c in mock_db_connector.run_sql.call_args_list
+              if c.kwargs['sql_params']['table_name'] == RUN_STATUS_TABLE]
+    return [status for value in values for status in (RUN_STATUS_PARTIAL, RUN_STATUS_COMPLETED)
+            if f"'{status}'" in value]
+
+
+@patch('etl_flow.RunETl.etl_3_build_dwh')
+@patch('etl_flow.RunETl.etl_2_build_datalake', side_effect=RuntimeError("network is down"))
+@patch('etl_flow.RunETl.etl_1_build_schema')
+def test_data_flow_failed_run_stays_partial(mock_etl_1, mock_etl_2, mock_etl_3, mock_db_connector, mock_logger):
+    etl = RunETl()
+    with pytest.raises(RuntimeError):
+        etl.data_flow()
+
+    mock_etl_3.assert_not_called()
+    assert run_statuses(mock_db_connector) == [RUN_STATUS_PARTIAL]
+
+
+def test_etl_1_build_schema_profiled(tmp_path, mock_db_connector, mock_logger):
+    with patch('etl_flow.StageProfiler', side_effect=lambda logger: StageProfiler(profile_dir=str(tmp_path))):
+        etl = RunETl(profile=True)
+    try:
+        etl.etl_1_build_schema()
+    finally:
+        etl.profiler.close()
+
+    mock_db_connector.run_sql.assert_called_with(sql_file_name=DB_SCHEMA_SQL_FILENAME)
+    load_kwargs = mock_db_connector.load_rows.call_args.kwargs
+    row = dict(zip(load_kwargs['fields'], next(iter(load_kwargs['values']))))
+    assert load_kwargs['sql_params']['table_name'] == 'build_datalake_phase_statistics'
+    assert (row['stage'], row['table_name'], row['source'], row['phase']) == \
+           ('etl_1_build_schema', DB_SCHEMA_SQL_FILENAME, '', 'profile')
+    assert os.path.exists(f"{row['report_path']}.txt")
+
+
+def test_populate_dwh_not_profiled_by_default(mock_db_connector, mock_logger):
+    mock_db_connector.run_sql.return_value = (1, 0, 0, 1)
+    etl = RunETl()
+    assert etl.profiler is None
+    assert etl.build_dwh_table('table', 'schema') == ('table', 1, 1, 0, 0, 0)
 
 #####################################################################################################################
 
@@ -352,6 +749,1160 @@ def test_run_sql_with_retries(mock_render_sql, mock_psycopg2_connect, mock_os_ge
     mock_logger.error.assert_called()
 
 
+@patch('db_connector.render_sql_from_file', side_effect=["CREATE TEMP TABLE t ();", "DROP TABLE t; SELECT 1;"])
+def test_run_copy_sql_streams_rows_into_staging(mock_render_sql, mock_psycopg2_connect, mock_os_getenv, mock_logger):
+    db = ConnectorDB(logger=mock_logger)
+    db.run_copy_sql(sql_file_name="populate_datalake",
+                    values={('0.0.0.0', 'a.com')},
+                    sql_params={"schema": "datalake", "table_name": "ads_and_trackers"},
+                    fields=['ip', 'url'])
+
+    cur = mock_psycopg2_connect.return_value.cursor.return_value.__enter__.return_value
+    copy_sql, buffer = cur.copy_expert.call_args.args
+    assert copy_sql == "COPY datalake_ads_and_trackers_temp (ip, url) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    assert buffer.getvalue() == "0.0.0.0,a.com\n"
+    # staging table is created before COPY, merge script runs after it
+    assert [c.args[0] for c in cur.execute.call_args_list] == ["CREATE TEMP TABLE t ();", "DROP TABLE t; SELECT 1;"]
+
+
+@patch('db_connector.BULK_LOAD_METHOD', 'values')
+def test_load_rows_values_fallback(mock_logger):
+    db = ConnectorDB(logger=mock_logger)
+    db.run_sql = Mock(return_value=(1, 0, 0, 1))
+    db.run_copy_sql = Mock()
+
+    counts = db.load_rows(sql_file_name="merge", values={(1, 'a')}, sql_params={"schema": "s"}, fields=['f1', 'f2'])
+
+    assert counts == MergeCounts(inserted_row_count=1, updated_row_count=0, unchanged_row_count=0, res_row_count=1)
+    db.run_copy_sql.assert_not_called()
+    db.run_sql.assert_called_once_with(sql_file_name="merge",
+                                       sql_params={"schema": "s", "values": "(1, 'a')"},
+                                       return_row=True,
+                                       checkpoint=None)
+
+
+def test_append_rows_copies_into_source_staging_table(mock_psycopg2_connect, mock_os_getenv, mock_logger):
+    db = ConnectorDB(logger=mock_logger)
+    db.append_rows(values={('0.0.0.0', 'a.com')},
+                   sql_params=build_params('ads_and_trackers', staging_table='datalake.ads_and_trackers_staging_x'),
+                   fields=['ip', 'url'])
+
+    cur = mock_psycopg2_connect.return_value.cursor.return_value.__enter__.return_value
+    copy_sql, buffer = cur.copy_expert.call_args.args
+    assert copy_sql == "COPY datalake.ads_and_trackers_staging_x (ip, url) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    assert buffer.getvalue() == "0.0.0.0,a.com\n"
+    # Rows are only staged, the merge runs once per source
+    cur.execute.assert_not_called()
+
+
+def test_connection_pool_reuses_connections(mock_logger):
+    connect = Mock(side_effect=lambda: MagicMock(closed=0))
+    pool = ConnectionPool(connect=connect, max_size=2, logger=mock_logger)
+
+    with pool.connection() as first:
+        assert pool.metrics()["in_use"] == 1
+    with pool.connection() as second:
+        pass
+
+    assert first is second
+    assert connect.call_count == 1
+    assert pool.metrics()["leases"] == 2
+    assert pool.metrics()["in_use"] == 0
+
+
+def test_connection_pool_replaces_broken_connections(mock_logger):
+    connect = Mock(side_effect=lambda: MagicMock(closed=0))
+    pool = ConnectionPool(connect=connect, max_size=1, logger=mock_logger)
+
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection():
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+    with pool.connection() as conn:
+        conn.closed = 1
+    with pool.connection():
+        pass
+
+    assert connect.call_count == 3
+    assert pool.metrics()["reconnects"] == 2
+    assert pool.metrics()["in_use"] == 0
+
+
+def test_connection_pool_releases_connection_of_abandoned_generator(mock_logger):
+    connect = Mock(side_effect=lambda: MagicMock(closed=0))
+    pool = ConnectionPool(connect=connect, max_size=1, logger=mock_logger)
+
+    def rows():
+        with pool.connection() as conn:
+            yield conn
+            yield from range(3)
+
+    generator = rows()
+    conn = next(generator)
+    generator.close()
+
+    conn.rollback.assert_called_once()
+    assert pool.metrics()["in_use"] == 0
+    assert pool.metrics()["idle"] == 1
+
+
+@patch('db_connector.render_sql_from_file', return_value="SELECT 1;")
+def test_run_sql_reuses_pooled_connection(mock_render_sql, mock_psycopg2_connect, mock_os_getenv, mock_logger):
+    mock_psycopg2_connect.return_value.closed = 0
+    db = ConnectorDB(logger=mock_logger)
+    db.run_sql(sql_file_name="dummy.sql")
+    db.run_sql(sql_file_name="dummy.sql")
+    assert mock_psycopg2_connect.call_count == 1
+
+
+#####################################################################################################################
+
+############ Testing models.py ############
+
+
+def test_row_validator_is_generated_once():
+    assert AdsAndTrackers.get_row_validator() is AdsAndTrackers.get_row_validator()
+    assert AdsAndTrackers.get_row_validator() is not Malware.get_row_validator()
+    assert AdsAndTrackers.get_row_validator()(('0.0.0.0', 'a.com')) == ('0.0.0.0', 'a.com')
+
+
+def test_row_validator_matches_dataclass_validation():
+    validator = AdsAndTrackers.get_row_validator()
+    with pytest.raises(TypeError):
+        AdsAndTrackers.validate_row({'ip': '0.0.0.0', 'url': 1})
+    with pytest.raises(TypeError):
+        validator(('0.0.0.0', 1))
+    with pytest.raises(TypeError):
+        validator(('0.0.0.0',))
+    assert validator((None, 'a.com')) == (None, 'a.com')
+
+
+def test_validate_rows_reports_rejects():
+    valid_rows, rejected_rows = Malware.validate_rows([('a.com',), ('b.com', 'c.com'), (1,)])
+    assert valid_rows == [('a.com',)]
+    assert [row for row, _ in rejected_rows] == [('b.com', 'c.com'), (1,)]
+
+
+def test_populate_datalake_loads_only_valid_rows(mock_db_connector, mock_logger):
+    mock_response = Mock()
+    mock_response.status_code = 200
+    mock_response.encoding = 'utf-8'
+    mock_response.iter_content.return_value = [b'0.0.0.0 a.com\n# comment\n0.0.0.0 b.com extra\n']
+
+    etl = RunETl()
+    result = etl.populate_datalake(mock_response, 'ads_and_trackers', 'source')
+
+    load_call = mock_db_connector.load_rows.call_args_list[0]
+    assert load_call.kwargs['values'] == {
+        ('0.0.0.0', 'a.com', hash_key('0.0.0.0'), hash_key('a.com')),
+        ('0.0.0.0', 'b.com', hash_key('0.0.0.0'), hash_key('b.com')),
+    }
+    assert load_call.kwargs['fields'] == ['ip', 'url', 'hash_key_ip', 'hash_key_url']
+    assert result.inserting_row_count == 2
+
+
+#####################################################################################################################
+
+############ Testing parsers.py ############
+
+
+def test_hosts_parser():
+    parser = HostsParser()
+    block = "# comment\n0.0.0.0 a.com\n\n  127.0.0.1 localhost # note\nsingle\n0.0.0.0 b.com\r\n"
+    assert parser.parse(block) == [('0.0.0.0', 'a.com'), ('127.0.0.1', 'localhost'), ('', 'single'), ('0.0.0.0', 'b.com')]
+    assert parser.lines_read == 6
+    assert parser.rows_parsed == 4
+
+
+def test_adblock_parser_takes_first_match_of_line():
+    block = "! title\n||a.com^\n||b.com^$third-party\n@@||c.com^ ||d.com^\nno match\n"
+    assert AdblockParser().parse(block) == [('a.com',), ('b.com',), ('c.com',)]
+
+
+def test_domain_list_parser():
+    assert DomainListParser().parse("# c\n! c\na.com\n\n  b.com\n") == [('a.com',), ('b.com',)]
+
+
+def test_get_parser():
+    assert isinstance(get_parser("domains"), DomainListParser)
+    assert isinstance(get_parser(url="https://example.com/list.txt"), AdblockParser)
+    assert isinstance(get_parser(url="https://example.com/hosts"), HostsParser)
+    # every source gets its own counters
+    assert get_parser("hosts") is not get_parser("hosts")
+    with pytest.raises(ValueError):
+        get_parser("unknown")
+
+
+def test_populate_datalake_pads_adblock_rows(mock_db_connector, mock_logger):
+    mock_response = Mock()
+    mock_response.status_code = 200
+    mock_response.encoding = 'utf-8'
+    mock_response.iter_content.return_value = [b'||a.com^\n||b.com^\n']
+
+    etl = RunETl()
+    etl.etl_chunk = 1
+    result = etl.populate_datalake(mock_response, 'ads_and_trackers', 'source', source_format='adblock')
+
+    assert [{row[:2] for row in c.kwargs['values']} for c in mock_db_connector.load_rows.call_args_list[:2]] == [
+        {('', 'a.com')}, {('', 'b.com')}
+    ]
+    assert result.inserting_row_count == 2
+    assert result.parse_lines_per_sec > 0
+
+
+#####################################################################################################################
+
+############ Testing dedup.py ############
+
+
+def test_row_deduplicator_across_chunks(mock_logger):
+    deduplicator = RowDeduplicator(name="test", logger=mock_logger)
+    assert deduplicator.filter([('', 'a.com'), ('', 'b.com'), ('', 'a.com')]) == ([('', 'a.com'), ('', 'b.com')], 1)
+    assert deduplicator.filter([('', 'b.com'), (None, 'b.com')]) == ([(None, 'b.com')], 1)
+
+
+def test_row_deduplicator_spills_and_merges_runs(mock_logger):
+    deduplicator = RowDeduplicator(name="test",
+                                   memory_budget_bytes=2 * DIGEST_MEMORY_COST,
+                                   max_spilled_runs=2,
+                                   logger=mock_logger)
+    rows = [('', f'{i}.com') for i in range(10)]
+    for i in range(0, 10, 2):
+        assert deduplicator.filter(rows[i:i + 2]) == (rows[i:i + 2], 0)
+
+    assert len(deduplicator._runs) <= 2
+    assert sum(run.size for run in deduplicator._runs) == 10
+    assert deduplicator.filter(rows + [('', 'new.com')]) == ([('', 'new.com')], 10)
+
+    spill_dir = deduplicator._spill_dir
+    deduplicator.close()
+    assert not os.path.exists(spill_dir)
+
+
+def test_populate_datalake_drops_duplicates_across_sources(mock_db_connector, mock_logger):
+    etl = RunETl()
+    results = []
+    for body in [b'0.0.0.0 a.com\n0.0.0.0 b.com\n', b'0.0.0.0 b.com\n0.0.0.0 c.com\n0.0.0.0 c.com\n']:
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.encoding = 'utf-8'
+        mock_response.iter_content.return_value = [body]
+        results.append(etl.populate_datalake(mock_response, 'ads_and_trackers', 'source'))
+
+    assert [r.duplicate_row_count for r in results] == [0, 2]
+    assert [r.inserting_row_count for r in results] == [2, 1]
+    loaded = [{row[:2] for row in c.kwargs['values']} for c in mock_db_connector.load_rows.call_args_list
+              if c.kwargs['fields'][:2] == ['ip', 'url']]
+    assert loaded == [{('0.0.0.0', 'a.com'), ('0.0.0.0', 'b.com')}, {('0.0.0.0', 'c.com')}]
+
+
+#####################################################################################################################
+
+############ Testing snapshot.py ############
+
+
+def test_encode_decode_row():
+    for row in [('', 'a.com'), (None, 'a.com'), ('0.0.0.0', 'a.com'), ('a\tb.com',), ('a b\nc\r.com',),
+                ('\\N',), ('a\\tb',)]:
+        assert decode_row(encode_row(row)) == row
+    assert encode_row(('a\tb.com', None)) == 'a\\tb.com\t\\N'
+
+
+def test_diff_sorted():
+    assert list(diff_sorted(['a', 'c', 'd'], ['b', 'c', 'e'])) == [('a', True), ('b', False), ('d', True), ('e', False)]
+    assert list(diff_sorted([], ['a'])) == [('a', False)]
+
+
+def test_snapshot_writer_external_sort(tmp_path):
+    writer = SnapshotWriter(str(tmp_path / "source"), buffer_rows=2)
+    writer.add([('', 'c.com'), ('', 'a.com'), ('', 'b.com')])
+    writer.add([('', 'a.com'), ('', 'd.com')])
+    writer.finish()
+
+    assert (tmp_path / "source.rows.new").read_text() == "\ta.com\n\tb.com\n\tc.com\n\td.com\n"
+    assert writer.duplicate_row_count == 1
+    # temporary runs are removed
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["source.rows.new"]
+
+
+def _write_snapshot(store, table_name, url, rows):
+    writer = store.writer(table_name, url)
+    writer.add(rows)
+    writer.finish()
+    store.mark_written(table_name, url)
+
+
+def test_snapshot_store_diff_of_table_union(tmp_path):
+    store = SnapshotStore(snapshot_dir=str(tmp_path))
+    _write_snapshot(store, 'malware', 'a', [('x.com',), ('y.com',)])
+    _write_snapshot(store, 'malware', 'b', [('y.com',), ('z.com',)])
+    assert sorted(store.diff('malware', ['a', 'b'])) == [(('x.com',), False), (('y.com',), False), (('z.com',), False)]
+    store.commit('malware', ['a', 'b'])
+
+    # 'y.com' is still in source 'b', source 'a' is unchanged (previous snapshot is reused)
+    _write_snapshot(store, 'malware', 'b', [('w.com',)])
+    assert sorted(store.diff('malware', ['a', 'b'])) == [(('w.com',), False), (('z.com',), True)]
+    store.commit('malware', ['a', 'b'])
+
+    # source 'b' is removed from the configs
+    assert sorted(store.diff('malware', ['a'])) == [(('w.com',), True)]
+    store.commit('malware', ['a'])
+    assert store.has_snapshot('malware', 'a') and not store.has_snapshot('malware', 'b')
+
+
+def test_populate_datalake_diff_mode(tmp_path, mock_db_connector, mock_logger):
+    etl = RunETl()
+    etl.snapshots = SnapshotStore(snapshot_dir=str(tmp_path))
+    etl.deduplicators = {}
+
+    def populate(body: bytes):
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.encoding = 'utf-8'
+        mock_response.iter_content.return_value = [body]
+        etl.populate_datalake(mock_response, 'malware', 'source', source_format='domains')
+        return etl.populate_datalake_delta('malware', ['source'])
+
+    first = populate(b'a.com\nb.com\nb.com\n')
+    second = populate(b'b.com\nc.com\n')
+
+    assert (first.inserting_row_count, first.removed_row_count) == (2, 0)
+    assert (second.inserting_row_count, second.removed_row_count) == (1, 1)
+    delta_load = [c.kwargs for c in mock_db_connector.load_rows.call_args_list if 'is_removed' in c.kwargs['fields']][-1]
+    assert delta_load['fields'] == ['url', 'is_removed', 'hash_key_url']
+    assert sorted(delta_load['values']) == [('a.com', True, hash_key('a.com')), ('c.com', False, hash_key('c.com'))]
+
+
+#####################################################################################################################
+
+############ Testing scheduler.py ############
+
+
+def test_run_dag_runs_dependencies_first(mock_logger):
+    finished = []
+    lock = threading.Lock()
+
+    def run(task):
+        with lock:
+            finished.append(task)
+
+    statuses = run_dag({'a': [], 'b': [], 'c': ['a', 'b'], 'd': ['b']}, run=run, max_workers=2, logger=mock_logger)
+
+    assert statuses == {'a': TASK_DONE, 'b': TASK_DONE, 'c': TASK_DONE, 'd': TASK_DONE}
+    assert finished.index('c') > max(finished.index('a'), finished.index('b'))
+    assert finished.index('d') > finished.index('b')
+
+
+def test_run_dag_skips_dependents_of_failed_task(mock_logger):
+    finished = []
+
+    def run(task):
+        if task == 'a':
+            raise RuntimeError("boom")
+        finished.append(task)
+
+    with pytest.raises(RuntimeError):
+        run_dag({'a': [], 'b': [], 'c': ['a'], 'd': ['c'], 'e': ['b']}, run=run, max_workers=2, logger=mock_logger)
+    assert sorted(finished) == ['b', 'e']
+    mock_logger.warning.assert_any_call("Task 'c' is skipped, as its dependencies are not built")
+    mock_logger.warning.assert_any_call("Task 'd' is skipped, as its dependencies are not built")
+
+
+def test_validate_dag():
+    with pytest.raises(ValueError, match="undeclared"):
+        validate_dag({'a': ['x']})
+    with pytest.raises(ValueError, match="cycle"):
+        validate_dag({'a': ['b'], 'b': ['a']})
+
+
+#####################################################################################################################
+
+############ Testing fetch_cache.py ############
+
+
+def test_fetch_cache_conditional_headers(tmp_path):
+    cache = FetchCache(cache_dir=str(tmp_path))
+    assert cache.conditional_headers("https://example.com/hosts") == {}
+
+    response = Mock()
+    response.headers = {"ETag": '"abc"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    cache.update("https://example.com/hosts", response, "hash")
+
+    assert cache.conditional_headers("https://example.com/hosts") == {
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT",
+    }
+    assert cache.is_unchanged("https://example.com/hosts", "hash")
+    assert not cache.is_unchanged("https://example.com/hosts", "other")
+    assert not cache.is_unchanged("https://example.com/other", "hash")
+
+
+def test_fetch_cache_spool_replays_body():
+    response = Mock()
+    response.status_code = 200
+    response.encoding = 'utf-8'
+    response.iter_content.return_value = [b'line 1\n', b'line 2\n']
+
+    spooled_response, content_hash = FetchCache.spool(response, max_memory=4)
+    with spooled_response:
+        assert list(iter_response_blocks(spooled_response, chunk_size=3)) == ['line 1\n', 'line 2\n']
+    assert content_hash == '9060554863a62b9db5f726216876654e561896071d2e6480f2048b70e0fdadb9'
+
+
+#####################################################################################################################
+
+############ Testing instrumentation.py ############
+
+
+def test_recorder_spans_and_counters():
+    phases = Recorder()
+    for _ in range(3):
+        with phases.span("load"):
+            pass
+    phases.count("chunk_count", 3)
+
+    rows = {row[0]: row for row in phases.phase_rows()}
+    assert set(rows) == {"load", "total"}
+    assert rows["load"][1] == 3
+    assert rows["load"][4] <= rows["load"][5]
+    # total row carries the counters: bytes_downloaded, lines_read, rows_rejected, chunk_count
+    assert rows["total"][-4:] == (0, 0, 0, 3)
+
+
+def test_percentile_nearest_rank():
+    assert percentile([], 0.5) == 0.0
+    assert percentile([1, 2, 3, 4], 0.5) == 2
+    assert percentile(list(range(1, 101)), 0.95) == 95
+
+
+def test_recording_nests_and_can_be_disabled():
+    assert recorder() is NULL_RECORDER
+    with recording(enabled=True) as outer:
+        with recording(enabled=True) as inner:
+            assert inner is outer is recorder()
+    assert recorder() is NULL_RECORDER
+
+    with recording(enabled=False) as disabled:
+        assert disabled is NULL_RECORDER
+        with disabled.span("load"):
+            disabled.count("chunk_count")
+        assert disabled.phase_rows() == []
+
+
+def test_populate_datalake_records_phases(mock_db_connector, mock_logger):
+    mock_response = Mock()
+    mock_response.status_code = 200
+    mock_response.encoding = 'utf-8'
+    mock_response.iter_content.return_value = [b'0.0.0.0 a.com\n', b'0.0.0.0 b.com\n0.0.0.0 1\n']
+
+    etl = RunETl()
+    etl.populate_datalake(mock_response, 'ads_and_trackers', 'source')
+
+    phase_load = [c.kwargs for c in mock_db_connector.load_rows.call_args_list
+                  if c.kwargs['sql_params']['table_name'] == 'build_datalake_phase_statistics'][0]
+    rows = {row[5]: dict(zip(phase_load['fields'], row)) for row in phase_load['values']}
+    assert {"download", "parse", "validate", "load", "blocks_put", "chunks_put", "total"} <= set(rows)
+    assert 1 <= rows["chunks_put"]["max_queue_depth"] <= 4
+    assert rows["total"]["bytes_downloaded"] == 38
+    assert rows["total"]["lines_read"] == 3
+    assert rows["total"]["chunk_count"] == 1
+    assert rows["download"]["calls"] == 3
+    assert all(row["source"] == 'source' for row in rows.values())
+
+
+#####################################################################################################################
+
+############ Testing benchmark.py ############
+
+
+def test_corpus_is_deterministic():
+    first = list(iter_corpus_lines("hosts", 2000, seed=1))
+    assert first == list(iter_corpus_lines("hosts", 2000, seed=1))
+    assert first != list(iter_corpus_lines("hosts", 2000, seed=2))
+    assert len(first) == 2000
+    assert any(line.startswith("#") for line in first)
+    # duplicates are drawn from recently generated domains
+    assert len(set(first)) < len(first)
+
+
+def test_run_pipeline_reports_stages(tmp_path):
+    path = tmp_path / "adblock.txt"
+    path.write_text("\n".join(iter_corpus_lines("adblock", 3000, seed=1)) + "\n")
+
+    memory = {}
+    tracemalloc.start()
+    try:
+        stages = run_pipeline(str(path), "adblock", chunk_size=500, memory=memory)
+    finally:
+        tracemalloc.stop()
+
+    assert set(stages) == {"download", "parse", "validate", "dedup", "hash_keys", "load"}
+    assert stages["parse"]["rows"] == 3000
+    assert stages["validate"]["calls"] == stages["dedup"]["calls"]
+    assert stages["hash_keys"]["rows"] < stages["dedup"]["rows"]
+    assert memory["peak"] > 0
+
+
+def test_run_pipeline_loads_into_sqlite(tmp_path):
+    path = tmp_path / "hosts.txt"
+    path.write_text("\n".join(iter_corpus_lines("hosts", 2000, seed=1)) + "\n")
+
+    stages = run_pipeline(str(path), "hosts", chunk_size=500, sink="sqlite")
+    assert stages["load"]["rows"] == stages["hash_keys"]["rows"] > 0
+
+
+#####################################################################################################################
+
+############ Testing profiling.py ############
+
+
+def test_stage_profiler_writes_reports(tmp_path):
+    profiler = StageProfiler(profile_dir=str(tmp_path), top=5)
+    try:
+        with profiler.profile('etl_2_build_datalake', 'malware__https://a.example.com/m.txt') as summary:
+            data = [str(i) * 10 for i in range(10000)]
+    finally:
+        profiler.close()
+
+    assert len(data) == 10000
+    assert os.path.basename(summary['report_path']) == 'etl_2_build_datalake__malware__https_a.example.com_m.txt'
+    assert os.path.exists(f"{summary['report_path']}.pstats")
+    with open(f"{summary['report_path']}.txt") as report:
+        text = report.read()
+    assert 'Top 5 functions by cumulative time' in text
+    assert 'Top 5 allocations' in text
+    assert summary['allocated_bytes'] > 10000 * 10
+    assert summary['calls'] >= 1
+    assert summary['wall_time_sec'] >= 0
+    assert not tracemalloc.is_tracing()
+
+
+def test_stage_profiler_keeps_reports_of_failed_unit(tmp_path):
+    profiler = StageProfiler(profile_dir=str(tmp_path))
+    try:
+        with pytest.raises(ValueError):
+            with profiler.profile('etl_3_build_dwh', 'malware') as summary:
+                raise ValueError("failed")
+    finally:
+        profiler.close()
+
+    assert os.path.exists(f"{summary['report_path']}.txt")
+
+
+#####################################################################################################################
+
+############ Testing parse_pool.py ############
+
+
+def test_parse_segment_pads_and_validates():
+    parsed = parse_segment('adblock', 'ads_and_trackers', "||a.com^\n! comment\n||b.com^\n")
+    assert parsed.rows == [('', 'a.com'), ('', 'b.com')]
+    assert parsed.rejected == []
+    assert (parsed.rows_parsed, parsed.lines_read) == (2, 3)
+
+
+def test_iter_validated_chunks_matches_serial_chunks():
+    segments = [
+        ParsedSegment([('a',), ('c',)], [(1, (1,), 'bad')], 3, 3, 0.0),
+        ParsedSegment([('d',), ('f',)], [(0, (2,), 'bad'), (2, (3,), 'bad')], 4, 4, 0.0),
+    ]
+    # Parsed order: a, 1, c | 2, d, 3, f - chunks of 3 parsed rows
+    assert list(iter_validated_chunks(segments, 3)) == [
+        ([('a',), ('c',)], [((1,), 'bad')]),
+        ([('d',)], [((2,), 'bad'), ((3,), 'bad')]),
+        ([('f',)], []),
+    ]
+
+    # Size of every next chunk is read when the previous one is complete
+    sizes = iter([2, 5, 5])
+    assert [len(valid) + len(rejected) for valid, rejected in iter_validated_chunks(segments, lambda: next(sizes))] \
+           == [2, 5]
+
+
+def test_populate_datalake_parse_pool_matches_serial(mock_db_connector, mock_logger):
+    body = "".join(f"0.0.0.0 host{i % 700}.com\n" if i % 10 else "# comment\n" for i in range(2000)).encode()
+
+    def loaded_chunks(parse_pool):
+        mock_db_connector.load_rows.reset_mock()
+        etl = RunETl()
+        etl.parse_pool = parse_pool
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.encoding = 'utf-8'
+        mock_response.iter_content.return_value = [body[i:i + 1000] for i in range(0, len(body), 1000)]
+        result = etl.populate_datalake(mock_response, 'ads_and_trackers', 'source')
+        chunks = [c.kwargs['values'] for c in mock_db_connector.load_rows.call_args_list
+                  if c.kwargs['sql_params']['table_name'] == 'ads_and_trackers']
+        return chunks, (result.inserting_row_count, result.duplicate_row_count)
+
+    parse_pool = ParsePool(max_workers=2, segment_size=4096)
+    try:
+        serial = loaded_chunks(None)
+        assert loaded_chunks(parse_pool) == serial
+        with patch('etl_flow.DATALAKE_PIPELINE_ENABLED', False):
+            assert loaded_chunks(None) == serial
+    finally:
+        parse_pool.close()
+
+
+#####################################################################################################################
+
+############ Testing pipeline.py ############
+
+
+def test_iter_in_thread_keeps_order_and_raises_producer_error():
+    def produce():
+        yield from range(100)
+        raise ValueError("network")
+
+    with recording(enabled=True) as phases:
+        items = []
+        with pytest.raises(ValueError):
+            for item in iter_in_thread(produce(), name="blocks", maxsize=2):
+                items.append(item)
+        rows = {row[0]: row for row in phases.phase_rows()}
+
+    assert items == list(range(100))
+    # Items and the end marker
+    assert rows["blocks_put"][1] == 101
+    assert rows["blocks_put"][6] <= 2
+
+
+def test_iter_in_thread_stops_producer_when_consumer_stops():
+    produced = []
+
+    def produce():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    items = iter_in_thread(produce(), name="blocks", maxsize=2)
+    assert next(items) == 0
+    items.close()
+    # Producer is blocked by the full queue and stops instead of reading the whole source
+    assert len(produced) < 10
+
+
+def test_queue_worker_applies_back_pressure_and_raises_error():
+    processed = []
+    release = threading.Event()
+
+    def load(item):
+        release.wait()
+        if item == 3:
+            raise ValueError("db")
+        processed.append(item)
+
+    worker = QueueWorker(load, name="chunks", maxsize=1)
+    put_thread = threading.Thread(target=lambda: [worker.put(i) for i in range(3)])
+    put_thread.start()
+    put_thread.join(timeout=0.3)
+    # First item is being loaded, the second one fills the queue, the third one waits
+    assert put_thread.is_alive()
+    release.set()
+    put_thread.join()
+    worker.put(3)
+    worker.put(4)
+
+    with pytest.raises(ValueError):
+        worker.close()
+    assert processed == [0, 1, 2]
+
+
+def test_bounded_queue_stop_unblocks_put():
+    items = BoundedQueue("chunks", maxsize=1)
+    items.put(1)
+    items.stop()
+    with pytest.raises(Exception, match="stopped"):
+        items.put(2)
+
+
+#####################################################################################################################
+
+############ Testing landing.py ############
+
+
+def test_landing_zone_stores_body_once_and_replays_it(tmp_path):
+    landing = LandingZone(landing_dir=str(tmp_path))
+    body = b'0.0.0.0 a.com\n0.0.0.0 b.com\n'
+    hashes = []
+    for _ in range(2):
+        response = MagicMock(status_code=200, encoding='utf-8')
+        response.iter_content.return_value = [body[:10], body[10:]]
+        landed = landing.tee(response)
+        assert b''.join(landed.iter_content()) == body
+        assert landed.complete
+        hashes.append(landed.commit())
+
+    assert hashes[0] == hashes[1] == hashlib.sha256(body).hexdigest()
+    assert os.listdir(landing.objects_dir) == [f"{hashes[0]}.gz"]
+
+    landing.add_source('ads_and_trackers', 'https://a.example.com/hosts', 'hosts', hashes[0], encoding='utf-8')
+    landing.add_source('malware', 'https://a.example.com/m.txt', None, 'missing')
+    landing.write_manifest('run')
+    sources = landing.read_manifest('run')
+    assert [source['url'] for source in sources] == ['https://a.example.com/hosts']
+    with landing.open(sources[0]) as replayed:
+        assert b''.join(replayed.iter_content(chunk_size=4)) == body
+
+    with pytest.raises(ValueError, match="landed runs: run"):
+        landing.read_manifest('other')
+
+
+def test_etl_2_build_datalake_replays_landed_run(tmp_path, mock_db_connector, mock_logger):
+    def loaded_rows():
+        return [c.kwargs['values'] for c in mock_db_connector.load_rows.call_args_list
+                if c.kwargs['sql_params']['table_name'] == 'ads_and_trackers']
+
+    etl = RunETl()
+    etl.fetch_cache = None
+    etl.landing = LandingZone(landing_dir=str(tmp_path))
+    etl.datalake_configs = [('ads_and_trackers', 'https://a.example.com/hosts')]
+    etl.http_session = MagicMock()
+    response = etl.http_session.get.return_value.__enter__.return_value
+    response.status_code = 200
+    response.encoding = 'utf-8'
+    response.headers = {}
+    response.iter_content.return_value = [b'0.0.0.0 a.com\n0.0.0.0 b.com\n']
+    etl.etl_2_build_datalake()
+    fetched = loaded_rows()
+
+    mock_db_connector.load_rows.reset_mock()
+    replay = RunETl(replay_run=ETL_RUN_ID)
+    replay.landing = LandingZone(landing_dir=str(tmp_path))
+    replay.http_session = MagicMock()
+    replay.etl_2_build_datalake()
+
+    replay.http_session.get.assert_not_called()
+    assert fetched and loaded_rows() == fetched
+
+
+#####################################################################################################################
+
+############ Testing checkpoints ############
+
+
+def checkpoint_rows(checkpoint_params, status=None):
+    # Checkpoints of the chunks and of the end of the sources, in order of writing
+    rows = [dict(zip(['table_name', 'source', 'chunk_number', 'row_offset', 'content_hash', 'status'], c.args))
+            for c in checkpoint_params.call_args_list]
+    return [row for row in rows if status is None or row['status'] == status]
+
+
+def loaded_values(mock_db_connector):
+    return [c.kwargs['values'] for c in mock_db_connector.load_rows.call_args_list
+            if c.kwargs['sql_params']['table_name'] == 'ads_and_trackers']
+
+
+def hosts_response(lines: int):
+    mock_response = Mock()
+    mock_response.status_code = 200
+    mock_response.encoding = 'utf-8'
+    mock_response.headers = {}
+    mock_response.iter_content.return_value = [''.join(f'0.0.0.0 h{i}.com\n' for i in range(lines)).encode()]
+    return mock_response
+
+
+def test_populate_datalake_checkpoints_chunks(mock_db_connector, mock_logger):
+    etl = RunETl()
+    etl.etl_chunk = 2
+    with patch.object(etl, 'checkpoint_params', wraps=etl.checkpoint_params) as checkpoint_params:
+        etl.populate_datalake(hosts_response(5), 'ads_and_trackers', 'source', content_hash='abc')
+
+    partial = checkpoint_rows(checkpoint_params, RUN_STATUS_PARTIAL)
+    assert [(row['chunk_number'], row['row_offset']) for row in partial] == [(1, 2), (2, 4), (3, 5)]
+    completed, = checkpoint_rows(checkpoint_params, RUN_STATUS_COMPLETED)
+    assert (completed['source'], completed['chunk_number'], completed['row_offset'], completed['content_hash']) == \
+           ('source', 3, 5, 'abc')
+    # Every chunk is loaded in the same transaction as its checkpoint
+    checkpoints = [c.kwargs['checkpoint'] for c in mock_db_connector.load_rows.call_args_list
+                   if c.kwargs['sql_params']['table_name'] == 'ads_and_trackers']
+    assert len(checkpoints) == 3 and all(c['table_name'] == CHECKPOINT_TABLE for c in checkpoints)
+    completed_call = mock_db_connector.run_sql.call_args_list[-1]
+    assert completed_call.kwargs['sql_params']['key_fields'] == ['etl_timestamp', 'table_name', 'source']
+
+
+def test_populate_datalake_resumes_after_committed_rows(mock_db_connector, mock_logger):
+    etl = RunETl()
+    etl.etl_chunk = 2
+    etl.checkpoints = {('ads_and_trackers', 'source'): {
+        'chunk_number': 2, 'row_offset': 4, 'content_hash': 'abc', 'status': RUN_STATUS_PARTIAL}}
+    with patch.object(etl, 'checkpoint_params', wraps=etl.checkpoint_params) as checkpoint_params:
+        etl.populate_datalake(hosts_response(5), 'ads_and_trackers', 'source', content_hash='abc')
+
+    assert loaded_values(mock_db_connector) == [{('0.0.0.0', 'h4.com', hash_key('0.0.0.0'), hash_key('h4.com'))}]
+    assert [row['chunk_number'] for row in checkpoint_rows(checkpoint_params)] == [3, 3]
+
+    # A source changed since the interrupted run is loaded from the start
+    mock_db_connector.reset_mock()
+    changed = RunETl()
+    changed.etl_chunk = 2
+    changed.checkpoints = etl.checkpoints
+    changed.populate_datalake(hosts_response(5), 'ads_and_trackers', 'source', content_hash='def')
+    assert len(loaded_values(mock_db_connector)) == 3
+
+    # So is a source without a content hash or version key
+    mock_db_connector.reset_mock()
+    unhashed = RunETl()
+    unhashed.etl_chunk = 2
+    unhashed.checkpoints = etl.checkpoints
+    unhashed.populate_datalake(hosts_response(5), 'ads_and_trackers', 'source')
+    assert len(loaded_values(mock_db_connector)) == 3
+
+
+def test_fetch_and_populate_datalake_resumes_streamed_body_by_version(tmp_path, mock_db_connector, mock_logger):
+    url = 'https://a.example.com/hosts'
+    body = ''.join(f'0.0.0.0 h{i}.com\n' for i in range(5)).encode()
+    version_key = FetchCache.version_key(Mock(headers={"ETag": '"v2"', "Content-Length": str(len(body))}))
+
+    def resume(etag: str) -> list:
+        mock_db_connector.reset_mock()
+        etl = _cached_fetch_etl(tmp_path, body, headers={"ETag": etag, "Content-Length": str(len(body))})
+        etl.etl_chunk = 2
+        etl.checkpoints = {('ads_and_trackers', url): {
+            'chunk_number': 2, 'row_offset': 4, 'content_hash': version_key, 'status': RUN_STATUS_PARTIAL}}
+        with patch.object(etl, 'checkpoint_params', wraps=etl.checkpoint_params) as checkpoint_params:
+            etl.fetch_and_populate_datalake('ads_and_trackers', url, threading.Semaphore())
+        assert {row['content_hash'] for row in checkpoint_rows(checkpoint_params)} == {FetchCache.version_key(
+            etl.http_session.get.return_value.__enter__.return_value)}
+        return loaded_values(mock_db_connector)
+
+    # Without FETCH_CACHE_SPOOL the body is hashed only while loading, the version key of its validators is compared
+    assert resume('"v2"') == [{('0.0.0.0', 'h4.com', hash_key('0.0.0.0'), hash_key('h4.com'))}]
+    # A new ETag is a new version and a weak one doesn't identify the bytes, both are loaded from the start
+    assert len(resume('"v3"')) == 3
+    assert len(resume('W/"v2"')) == 3
+
+
+def test_etl_2_build_datalake_resume_skips_completed_sources(mock_db_connector, mock_logger):
+    mock_db_connector.run_sql.return_value = [
+        {'table_name': 'ads_and_trackers', 'source': 'https://a.example.com/hosts', 'chunk_number': 1,
+         'row_offset': 1, 'content_hash': None, 'status': RUN_STATUS_COMPLETED},
+    ]
+    etl = RunETl()
+    etl.fetch_cache = None
+    etl.datalake_configs = [('ads_and_trackers', 'https://a.example.com/hosts'),
+                            ('ads_and_trackers', 'https://b.example.com/hosts')]
+    etl.http_session = MagicMock()
+    etl.http_session.get.return_value.__enter__.return_value = hosts_response(1)
+    with patch('etl_flow.ETL_RESUME_RUN', ETL_RUN_ID):
+        etl.etl_2_build_datalake()
+
+    fetched = [c.args[0] if c.args else c.kwargs['url'] for c in etl.http_session.get.call_args_list]
+    assert fetched == ['https://b.example.com/hosts']
+
+
+def test_checkpointing_is_off_in_diff_mode(tmp_path, mock_db_connector, mock_logger):
+    with patch('etl_flow.DATALAKE_LOAD_MODE', 'diff'), \
+            patch('etl_flow.SnapshotStore', side_effect=lambda: SnapshotStore(str(tmp_path))):
+        etl = RunETl()
+    assert not etl.checkpointing
+    assert etl.checkpoint_params('ads_and_trackers', 'source', 1, 1, None, RUN_STATUS_PARTIAL) is None
+
+
+#####################################################################################################################
+
+############ Testing chunking.py ############
+
+
+def test_adaptive_chunk_size_tunes_by_latency():
+    chunk_size = AdaptiveChunkSize(initial=1000, min_rows=100, max_rows=100_000, target_sec=0.5, max_bytes=10 ** 9)
+    # 1000 rows/sec loads 500 rows in the target time, the size halves at most per chunk
+    assert chunk_size.observe(1000, 1.0, 50_000) == 500
+    # Fast chunks grow it at most twice per chunk until it loads in about the target time
+    sizes = [chunk_size.observe(chunk_size.size, chunk_size.size / 100_000, chunk_size.size * 50) for _ in range(8)]
+    assert sizes[:3] == [1000, 2000, 4000]
+    assert 10_000 <= sizes[-1] <= 50_000
+
+
+def test_adaptive_chunk_size_limits():
+    chunk_size = AdaptiveChunkSize(initial=1000, min_rows=800, max_rows=1500, target_sec=1.0, max_bytes=10 ** 9)
+    assert chunk_size.observe(1000, 10.0, 1000) == 800
+    chunk_size = AdaptiveChunkSize(initial=1000, min_rows=800, max_rows=1500, target_sec=1.0, max_bytes=10 ** 9)
+    assert chunk_size.observe(1000, 0.001, 1000) == 1500
+    # Payload of a chunk stays below max bytes
+    chunk_size = AdaptiveChunkSize(initial=1000, min_rows=10, max_rows=10 ** 6, target_sec=1.0, max_bytes=100_000)
+    assert chunk_size.observe(1000, 0.001, 200_000) == 500
+
+
+def test_adaptive_chunk_size_fixed():
+    chunk_size = AdaptiveChunkSize(initial=7, adaptive=False)
+    assert chunk_size.observe(7, 100.0, 10) == 7
+    assert chunk_size.rows_per_sec is None
+    assert payload_bytes([('0.0.0.0', 'a.com'), ('b.com', None, True)]) == 17
+
+
+def test_populate_datalake_chunks_follow_adaptive_size(mock_db_connector, mock_logger):
+    etl = RunETl()
+    etl.chunk_sizes['ads_and_trackers'] = chunk_size = AdaptiveChunkSize(initial=2, adaptive=False)
+
+    def load_rows(**kwargs):
+        # Next chunks are sized after every loaded one
+        chunk_size.size += 1
+        return MergeCounts(len(kwargs['values']), 0, 0, 0)
+
+    mock_db_connector.load_rows.side_effect = load_rows
+    with patch('etl_flow.DATALAKE_PIPELINE_ENABLED', False):
+        etl.populate_datalake(hosts_response(12), 'ads_and_trackers', 'source')
+
+    assert [len(values) for values in loaded_values(mock_db_connector)] == [2, 3, 4, 3]
+
+
+def test_populate_datalake_source_staging(mock_db_connector, mock_logger):
+    mock_db_connector.run_sql.return_value = (5, 0, 0, 5)
+    with patch('etl_flow.DATALAKE_STAGING_MODE', 'source'):
+        etl = RunETl()
+    etl.etl_chunk = 2
+    result = etl.populate_datalake(hosts_response(5), 'ads_and_trackers', 'source')
+
+    staging_table = etl.staging_table('ads_and_trackers', 'source')
+    appended = mock_db_connector.append_rows.call_args_list
+    assert [len(c.kwargs['values']) for c in appended] == [2, 2, 1]
+    assert {c.kwargs['sql_params']['staging_table'] for c in appended} == {staging_table}
+    assert all(c.kwargs['checkpoint']['table_name'] == CHECKPOINT_TABLE for c in appended)
+    assert not loaded_values(mock_db_connector)
+
+    create, merge, drop = [c.kwargs for c in mock_db_connector.run_sql.call_args_list
+                           if c.kwargs['sql_params'].get('staging_table') == staging_table]
+    assert create['sql_file_name'] == 'create_source_staging_table' and create['sql_params']['resumed'] is False
+    # All chunks are merged once, together with the completed checkpoint of the source
+    assert merge['sql_file_name'] == 'merge' and merge['return_row']
+    assert merge['checkpoint']['table_name'] == CHECKPOINT_TABLE
+    assert drop['sql_file_name'] == 'drop_staging_table'
+    assert (result.inserting_row_count, result.inserted_row_count, result.res_row_count) == (5, 5, 5)
+
+
+def test_populate_datalake_source_staging_failure(mock_db_connector, mock_logger):
+    mock_db_connector.append_rows.side_effect = RuntimeError("disk full")
+    with patch('etl_flow.DATALAKE_STAGING_MODE', 'source'), patch('etl_flow.CHECKPOINT_ENABLED', False):
+        etl = RunETl()
+    with pytest.raises(RuntimeError):
+        etl.populate_datalake(hosts_response(5), 'ads_and_trackers', 'source')
+
+    # Without checkpoints the staged rows can't be resumed, so the staging table is dropped
+    assert mock_db_connector.run_sql.call_args_list[-1].kwargs['sql_file_name'] == 'drop_staging_table'
+    assert mock_db_connector.run_sql.call_args_list[0].kwargs['sql_params']['unlogged'] is True
+
+
+#####################################################################################################################
+
+############ Testing sinks.py ############
+
+
+@pytest.fixture
+def sqlite_sink(tmp_path):
+    sink = SqliteSink(sqlite_dir=str(tmp_path / "sqlite"), logger=MagicMock())
+    sink.run_sql(sql_file_name=DB_SCHEMA_SQL_FILENAME)
+    yield sink
+    sink.close()
+
+
+def test_sqlite_sink_merges_rows(sqlite_sink):
+    sql_params = build_params(table_name='malware',
+                              fields=['url', 'hash_key_url'],
+                              key_fields=['url', 'etl_timestamp'],
+                              load_etl_timestamp=True)
+    rows = {('a.com', hash_key('a.com')), ('b.com', hash_key('b.com'))}
+    load = lambda values: sqlite_sink.load_rows(sql_file_name='merge', values=values, sql_params=sql_params,
+                                                fields=['url', 'hash_key_url'])
+
+    assert load(rows) == MergeCounts(2, 0, 0, 2)
+    assert load(rows) == MergeCounts(0, 0, 2, 2)
+    assert load({('a.com', hash_key('c.com')), ('d.com', hash_key('d.com'))}) == MergeCounts(1, 1, 0, 3)
+
+
+def test_sqlite_sink_checkpoints_and_staging(sqlite_sink):
+    checkpoint = build_params(table_name=CHECKPOINT_TABLE,
+                              values={(ETL_TIMESTAMP, 'malware', 'source', 1, 2, None, RUN_STATUS_PARTIAL,
+                                       datetime.now(timezone.utc))},
+                              fields=CHECKPOINT_FIELDS,
+                              key_fields=MERGE_KEY_CHECKPOINT_FIELDS)
+    sql_params = build_params(table_name='malware', staging_table='datalake.malware_staging_test')
+    sqlite_sink.run_sql(sql_file_name='create_source_staging_table', sql_params={**sql_params, "resumed": False})
+    # Rows of the chunk and its checkpoint are committed together
+    sqlite_sink.append_rows(values={('a.com',), ('b.com',)}, sql_params=sql_params, fields=['url'],
+                            checkpoint=checkpoint)
+
+    checkpoints = sqlite_sink.run_sql(sql_file_name='load_checkpoints',
+                                      sql_params=build_params(table_name=CHECKPOINT_TABLE))
+    assert [(c['source'], c['row_offset']) for c in json.loads(checkpoints)] == [('source', 2)]
+    assert sqlite_sink.run_sql(sql_file_name='row_count',
+                               sql_params={**sql_params, "table_name": 'malware_staging_test'}) == 2
+
+
+def test_sqlite_sink_rolls_back_failed_script(sqlite_sink):
+    with patch.object(SqliteSink, 'insert_rows', side_effect=sqlite3.IntegrityError("constraint failed")):
+        with pytest.raises(sqlite3.IntegrityError):
+            sqlite_sink.load_rows(sql_file_name='merge', values={('a.com',)},
+                                  sql_params=build_params(table_name='malware', fields=['url']), fields=['url'],
+                                  checkpoint=build_params(table_name=CHECKPOINT_TABLE,
+                                                          values={(ETL_TIMESTAMP, 'malware', 'source', 1, 1, None,
+                                                                   RUN_STATUS_PARTIAL, None)},
+                                                          fields=CHECKPOINT_FIELDS,
+                                                          key_fields=MERGE_KEY_CHECKPOINT_FIELDS))
+
+    assert sqlite_sink.run_sql(sql_file_name='row_count', sql_params=build_params(table_name=CHECKPOINT_TABLE)) == 0
+
+
+def test_sqlite_sink_drops_rows_of_old_runs(sqlite_sink):
+    runs = [datetime(2024, 1, day, tzinfo=timezone.utc) for day in (1, 2, 3)]
+    sqlite_sink.run_sql(sql_file_name='upsert', sql_params=build_params(
+        table_name=RUN_STATUS_TABLE,
+        values={(run, run.strftime("%Y%m%dT%H%M%S"), RUN_STATUS_COMPLETED, run) for run in runs},
+        fields=RUN_STATUS_FIELDS,
+        key_fields=RUN_STATUS_FIELDS[:1]
+    ))
+    sqlite_sink.append_rows(values={('a.com', run) for run in runs}, sql_params={"staging_table": "datalake.malware"},
+                            fields=['url', 'etl_timestamp'])
+    # Source 'b' is loaded by the first run only and skipped as unchanged by the later ones
+    statistics = [(run, source, SOURCE_STATUS_LOADED if source == 'a' or run == runs[0] else SOURCE_STATUS_UNCHANGED)
+                  for run in runs for source in ('a', 'b')]
+    sqlite_sink.conn.executemany(
+        "INSERT INTO datalake.build_datalake_statistics (etl_timestamp, table_name, source, status) "
+        "VALUES (?, 'malware', ?, ?)", [(run.isoformat(), source, status) for run, source, status in statistics])
+
+    sql_params = {**build_params(table_name='malware', etl_timestamp=runs[-1]), "retention_runs": 2,
+                  "status": RUN_STATUS_COMPLETED, "loaded_status": SOURCE_STATUS_LOADED}
+    # Rows of the first run are the last load of 'b', they are kept
+    assert sqlite_sink.run_sql(sql_file_name=DROP_PARTITIONS_SQL_FILENAME, sql_params=sql_params) == 0
+
+    sqlite_sink.conn.execute("UPDATE datalake.build_datalake_statistics SET status = ? "
+                             "WHERE source = 'b' AND etl_timestamp = ?", (SOURCE_STATUS_LOADED, runs[-1].isoformat()))
+    assert sqlite_sink.run_sql(sql_file_name=DROP_PARTITIONS_SQL_FILENAME, sql_params=sql_params) == 1
+    assert sqlite_sink.run_sql(sql_file_name=DROP_PARTITIONS_SQL_FILENAME, sql_params=sql_params) == 0
+    assert sqlite_sink.run_sql(sql_file_name='row_count', sql_params=build_params(table_name='malware')) == 2
+
+
+def test_drop_datalake_partitions_is_off_in_diff_mode(tmp_path, mock_db_connector, mock_logger):
+    with patch('etl_flow.DATALAKE_LOAD_MODE', 'diff'), \
+            patch('etl_flow.SnapshotStore', side_effect=lambda: SnapshotStore(str(tmp_path))):
+        etl = RunETl()
+    mock_db_connector.reset_mock()
+    etl.drop_datalake_partitions()
+
+    # Partitions of diff mode hold the churn of their run only, so none of them is dropped
+    mock_db_connector.run_sql.assert_not_called()
+
+
+def test_drop_stale_staging_tables(sqlite_sink, mock_db_connector, mock_logger):
+    sqlite_sink.run_sql(sql_file_name='upsert', sql_params=build_params(
+        table_name=RUN_STATUS_TABLE,
+        values={(datetime(2024, 1, day, tzinfo=timezone.utc), f"202401{day:02d}T000000", status, None)
+                for day, status in ((1, RUN_STATUS_COMPLETED), (2, RUN_STATUS_PARTIAL))},
+        fields=RUN_STATUS_FIELDS,
+        key_fields=RUN_STATUS_FIELDS[:1]
+    ))
+    staging_tables = ['malware_staging_20240101t000000_0123abcd', 'malware_staging_20240102t000000_0123abcd',
+                      'malware_staging_20240103t000000_0123abcd']
+    for staging_table in staging_tables:
+        sqlite_sink.run_sql(sql_file_name='create_source_staging_table', sql_params={
+            **build_params(table_name='malware', staging_table=f"datalake.{staging_table}"), "resumed": False
+        })
+    etl = RunETl()
+    etl.db_conn = sqlite_sink
+    etl.drop_stale_staging_tables()
+
+    # Only the table of the partial run is kept, a run without a status (failed before it) is not resumable
+    tables = sqlite_sink.conn.execute("SELECT name FROM datalake.sqlite_master WHERE name GLOB '*_staging_*'")
+    assert tables.fetchall() == [(staging_tables[1],)]
+
+
+def test_sqlite_sink_iter_rows_does_not_block_loads(sqlite_sink):
+    sql_params = {"staging_table": "datalake.malware"}
+    sqlite_sink.append_rows(values={('a.com',), ('b.com',)}, sql_params=sql_params, fields=['url'])
+    rows = sqlite_sink.iter_rows(sql_file_name='row_count', sql_params=build_params(table_name='malware'))
+    assert next(rows) == ('COUNT(*)',)
+
+    # Consumer stopped after the first row, the loads go on
+    load = threading.Thread(target=sqlite_sink.append_rows,
+                            kwargs=dict(values={('c.com',)}, sql_params=sql_params, fields=['url']), daemon=True)
+    load.start()
+    load.join(timeout=5)
+    assert not load.is_alive()
+    assert sqlite_sink.run_sql(sql_file_name='row_count', sql_params=build_params(table_name='malware')) == 3
+    rows.close()
+
+
+def test_sink_without_load_methods_is_not_created():
+    class RunOnlySink(Sink):
+        def run_sql(self, sql_file_name, sql_params=None, sql_folder_path=None, return_row=False, checkpoint=None):
+            return None
+
+    with pytest.raises(TypeError):
+        RunOnlySink()
+
+
+def test_build_sink():
+    with pytest.raises(ValueError):
+        RunETl.build_sink('duckdb')
+    with patch('etl_flow.ConnectorDB') as connector, patch('etl_flow.EXPORT_DIR', '/exports'):
+        sink = RunETl.build_sink('postgres')
+    assert isinstance(sink, CsvExportSink) and sink.sink is connector.return_value
+
+
+def test_export_table_closes_rows_when_write_fails(tmp_path, mock_logger):
+    sink = MagicMock()
+    closed = []
+
+    def rows(*args, **kwargs):
+        try:
+            yield ('url',)
+            yield from [('a.com',), ('b.com',)]
+        finally:
+            closed.append(True)
+
+    sink.iter_rows.side_effect = rows
+    export_sink = CsvExportSink(sink, str(tmp_path), mock_logger)
+    with patch('sinks.csv.writer') as writer, pytest.raises(OSError):
+        writer.return_value.writerow.side_effect = [None, OSError("No space left on device")]
+        export_sink.export_table('dwh', 'malware')
+
+    assert closed == [True]
+
+
+def sources_response(url, **kwargs):
+    mock_response = hosts_response(3) if 'hosts' in url else Mock()
+    if 'hosts' not in url:
+        mock_response.status_code = 200
+        mock_response.encoding = 'utf-8'
+        mock_response.headers = {}
+        mock_response.iter_content.return_value = [b'||m1.com^\n||m2.com^\n']
+    mock_response.__enter__ = Mock(return_value=mock_response)
+    mock_response.__exit__ = Mock(return_value=None)
+    return mock_response
+
+
+def test_data_flow_on_sqlite_sink_with_file_export(tmp_path, mock_logger):
+    with patch('etl_flow.SqliteSink', side_effect=lambda logger: SqliteSink(str(tmp_path / "sqlite"), logger)), \
+            patch('etl_flow.EXPORT_DIR', str(tmp_path / "export")), \
+            patch('etl_flow.FETCH_CACHE_ENABLED', False):
+        etl = RunETl(sink='sqlite')
+    sqlite_sink = etl.db_conn.sink
+    etl.http_session = Mock()
+    etl.http_session.get.side_effect = sources_response
+    with patch.object(sqlite_sink, 'close'):
+        etl.data_flow()
+
+    dwh_rows = {table: sqlite_sink.run_sql(sql_file_name='row_count',
+                                           sql_params=build_params(table_name=table, schema='dwh'))
+                for table in ('hash_key_ip_mapping', 'hash_key_url_mapping', 'ads_and_trackers', 'malware')}
+    assert dwh_rows == {'hash_key_ip_mapping': 1, 'hash_key_url_mapping': 5, 'ads_and_trackers': 3, 'malware': 2}
+    assert sqlite_sink.run_sql(sql_file_name='last_partial_run', sql_params={"status": RUN_STATUS_COMPLETED}) \
+           == ETL_RUN_ID
+    # Timestamps of the run are stored in one (ISO) format by the merges, upserts and inserted rows
+    for table in ('datalake.etl_runs', 'datalake.load_checkpoints', 'datalake.malware',
+                  'datalake.build_datalake_statistics', 'dwh.malware', 'dwh.build_dwh_statistics'):
+        assert sqlite_sink.conn.execute(f"SELECT DISTINCT etl_timestamp FROM {table}").fetchall() == \
+               [(ETL_TIMESTAMP.isoformat(),)]
+
+    partition = etl.db_conn.partition_dir('dwh', 'ads_and_trackers')
+    with open(os.path.join(partition, 'part-00000.csv')) as file:
+        lines = file.read().splitlines()
+    assert lines[0] == 'hash_key_ip,hash_key_url,etl_timestamp' and len(lines) == 4
+    assert os.path.exists(os.path.join(etl.db_conn.partition_dir('datalake', 'build_datalake_statistics'),
+                                       'part-00000.csv'))
+    sqlite_sink.close()
+
+
 #####################################################################################################################
 
 
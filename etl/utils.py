@@ -1,21 +1,41 @@
+import io
+import os
+import re
 import sys
+import csv
 import json
+import uuid
+import codecs
+import hashlib
 import logging
+from functools import lru_cache
+from glob import glob
 from time import time
 from datetime import datetime, timezone
 
+import requests
+from requests.adapters import HTTPAdapter
 from jinja2 import Template
 
+from instrumentation import recording, recorder
 from constants import (
     CONFIGS_DEFAULT,
     DWH_CONF,
     SQL_FOLDER_PATH,
+    DWH_SQL_FOLDER_PATH,
     DATALAKE_SCHEMA,
     ETL_TIMESTAMP,
     STATISTICS_SQL,
     BUILD_DATALAKE_STATISTICS_TABLE,
     FIELD_STATISTICS_MAPPING,
-    WHERE_DELETE_MAPPING,
+    MERGE_KEY_MAPPING,
+    PHASE_STATISTICS_TABLE_MAPPING,
+    FIELD_PHASE_STATISTICS_MAPPING,
+    MERGE_KEY_PHASE_STATISTICS_MAPPING,
+    STREAM_CHUNK_SIZE_BYTES,
+    FETCH_MAX_WORKERS,
+    FETCH_MAX_PER_HOST,
+    HASH_KEY_CACHE_SIZE,
 )
 
 
@@ -40,6 +60,20 @@ def parse_etl_configs(conf_path: str = CONFIGS_DEFAULT, stage: str = 'datalake')
             yield k, i
 
 
+def parse_source_conf(source_conf) -> tuple:
+    # Datalake source is either a plain URL or an object like {"url": "...", "format": "hosts"}
+    if isinstance(source_conf, dict):
+        return source_conf["url"], source_conf.get("format")
+    return source_conf, None
+
+
+def parse_dwh_table_conf(table_conf, previous_tables: list) -> tuple:
+    # DWH table is either {"table": "...", "depends_on": [...]} or a plain name, which depends on all tables before it
+    if isinstance(table_conf, dict):
+        return table_conf["table"], list(table_conf.get("depends_on", []))
+    return table_conf, list(previous_tables)
+
+
 def get_logger(name: str = "ETL_Flow"):
     logger = logging.getLogger(name)
 
@@ -65,48 +99,165 @@ def get_logger(name: str = "ETL_Flow"):
     return logger
 
 
+class SqlTemplateRegistry:
+    """
+    Cache of SQL templates, each file is read and compiled once.
+    A template is reloaded when the modification time of its file changes.
+    """
+    def __init__(self):
+        self._templates = {}
+
+    def preload(self, sql_folder_paths: tuple = (SQL_FOLDER_PATH, DWH_SQL_FOLDER_PATH)):
+        for sql_folder_path in sql_folder_paths:
+            for path in sorted(glob(sql_folder_path.format(file_name="*"))):
+                self.get(path)
+
+    def get(self, path: str) -> tuple:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        cached = self._templates.get(path)
+        if cached and mtime is not None and cached[0] == mtime:
+            return cached[1], cached[2]
+
+        # Read the SQL file
+        with open(path, 'r') as file:
+            sql_content = file.read()
+        template = Template(sql_content)
+
+        if mtime is not None:
+            self._templates[path] = (mtime, sql_content, template)
+        return sql_content, template
+
+
+SQL_TEMPLATES = SqlTemplateRegistry()
+
+
 def render_sql_from_file(file_name: str, params_dict: dict = None, sql_folder_path: str = SQL_FOLDER_PATH) -> str:
-    # Read the SQL file
-    with open(sql_folder_path.format(file_name=file_name), 'r') as file:
-        sql_content = file.read()
+    sql_content, template = SQL_TEMPLATES.get(sql_folder_path.format(file_name=file_name))
 
     # Render the SQL content
     if params_dict:
-        sql_content = Template(sql_content).render(params_dict)
+        sql_content = template.render(params_dict)
 
     return sql_content
 
 
+SQL_TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|--[^\n]*|;|[^'\";-]+|-")
+
+
+def split_sql_statements(sql: str) -> list | None:
+    # Splits a script into single statements and drops comments.
+    # Scripts with dollar-quoted blocks (DO $$ ... $$) can't be split this way, None is returned for them.
+    if "$$" in sql:
+        return None
+
+    statements = []
+    current = []
+    for token in SQL_TOKEN_PATTERN.findall(sql):
+        if token == ";":
+            statements.append("".join(current).strip())
+            current = []
+        elif not token.startswith("--"):
+            current.append(token)
+    statements.append("".join(current).strip())
+
+    return [statement for statement in statements if statement]
+
+
+def build_http_session(max_workers: int = FETCH_MAX_WORKERS, max_per_host: int = FETCH_MAX_PER_HOST) -> requests.Session:
+    # One pooled session is shared by all fetch workers, so connections to the same host are kept alive and reused
+    session = requests.Session()
+    # Lists are transferred compressed, the body is decompressed while it is streamed
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_per_host, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def iter_response_blocks(response, chunk_size: int = STREAM_CHUNK_SIZE_BYTES):
+    # Decode the body incrementally and yield text blocks which always end on a line boundary,
+    # so only one network chunk (plus an unfinished line) is kept in memory
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    pending = ''
+    phases = recorder()
+    chunks = iter(response.iter_content(chunk_size=chunk_size))
+    while True:
+        # Body is read lazily, so waiting for the network happens here
+        with phases.span("download"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        phases.count("bytes_downloaded", len(chunk))
+        pending += decoder.decode(chunk)
+        cut = pending.rfind("\n") + 1
+        if cut:
+            yield pending[:cut]
+            pending = pending[cut:]
+
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
 def build_values(values: set) -> str:
     return ", ".join(["(" + ", ".join(
-        f"'{val.isoformat()}'" if isinstance(val, datetime) else repr(val) for val in value_tuple
+        f"'{val.isoformat()}'" if isinstance(val, datetime) else "NULL" if val is None else repr(val)
+        for val in value_tuple
     ) + ")" for value_tuple in values])
 
 
+def build_copy_buffer(values: set) -> io.StringIO:
+    # CSV payload for COPY ... FROM STDIN WITH (FORMAT csv, NULL '\N'), so empty strings and NULLs stay distinct
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerows(
+        tuple(
+            val.isoformat() if isinstance(val, datetime) else ('\\N' if val is None else val) for val in value_tuple
+        ) for value_tuple in values
+    )
+    buffer.seek(0)
+    return buffer
+
+
+@lru_cache(maxsize=HASH_KEY_CACHE_SIZE)
+def hash_key(value: str | None) -> str:
+    # Same key as MD5(COALESCE(value, ''))::UUID of the DWH scripts (UTF8 database encoding)
+    return str(uuid.UUID(hashlib.md5((value or '').encode('utf-8')).hexdigest()))
+
+
+def add_hash_keys(rows: list, key_indexes: list) -> list:
+    # Appends the hash keys of the values at key_indexes to every row of a chunk
+    return [row + tuple(hash_key(row[i]) for i in key_indexes) for row in rows]
+
+
 def build_params(table_name: str,
                  values: set = None,
                  fields: list = None,
-                 delete_where_fields: list = None,
+                 key_fields: list = None,
                  schema: str = DATALAKE_SCHEMA,
-                 etl_timestamp: datetime = ETL_TIMESTAMP) -> dict:
-    if delete_where_fields:
-        delete_where = " AND ".join(
-            [f"{table_name}.{f} = {schema}_{table_name}_temp.{f}" for f in delete_where_fields]
-        )
-    elif fields:
-        delete_where = " AND ".join(
-            [f"{table_name}.{f} = {schema}_{table_name}_temp.{f}" for f in fields]
-        )
-    else:
-        delete_where = ''
+                 etl_timestamp: datetime = ETL_TIMESTAMP,
+                 load_etl_timestamp: bool = False,
+                 staging_table: str = None) -> dict:
+    # Merge upserts on key_fields (all fields by default) and updates the other fields,
+    # load_etl_timestamp adds etl_timestamp of the run to the loaded fields.
+    # Rows are merged from staging_table, a temp table of the transaction by default
+    key_fields = key_fields or fields or []
+    loaded_fields = (fields or []) + (["etl_timestamp"] if load_etl_timestamp else [])
 
     return {
         "table_name": table_name,
         "schema": schema,
         "fields": ", ".join(fields) if fields else None,
-        "delete_where": delete_where,
+        "key_fields": key_fields,
+        "update_fields": [f for f in loaded_fields if f not in key_fields],
+        "load_etl_timestamp": load_etl_timestamp,
         "values": build_values(values) if values else None,
-        "etl_timestamp": etl_timestamp
+        "etl_timestamp": etl_timestamp,
+        "staging_table": staging_table or f"{schema}_{table_name}_temp",
     }
 
 
@@ -116,7 +267,9 @@ def build_statistics(
     def decorator(func):
         def wrapper(*args, **kwargs):
             start_time = time()
-            result = func(*args, **kwargs)
+            with recording() as unit_recorder:
+                result = func(*args, **kwargs)
+                phase_rows = unit_recorder.phase_rows()
             end_time = time()
 
             execution_time_min = round((end_time - start_time) / 60, 2)
@@ -132,23 +285,44 @@ def build_statistics(
             source,
             inserting_row_count,
             res_row_count,
+            status,
+            parse_lines_per_sec,
+            duplicate_row_count,
+            removed_row_count,
+            inserted_row_count,
+            updated_row_count,
+            unchanged_row_count,
             execution_time_min,
             load_timestamp,
             """
 
             # Use schema and other data
             if isinstance(result, tuple):
-                args[0].db_conn.run_sql(sql_file_name=STATISTICS_SQL,
-                                        sql_params=build_params(table_name=statistics_sql,
-                                                                schema=schema,
-                                                                fields=FIELD_STATISTICS_MAPPING[schema],
-                                                                delete_where_fields=WHERE_DELETE_MAPPING[schema],
-                                                                values={(etl_timestamp,
-                                                                         function_name,
-                                                                         schema,
-                                                                         *result,
-                                                                         execution_time_min,
-                                                                         datetime.now(timezone.utc))}))
+                args[0].db_conn.load_rows(sql_file_name=STATISTICS_SQL,
+                                          values={(etl_timestamp,
+                                                   function_name,
+                                                   schema,
+                                                   *result,
+                                                   execution_time_min,
+                                                   datetime.now(timezone.utc))},
+                                          sql_params=build_params(table_name=statistics_sql,
+                                                                  schema=schema,
+                                                                  fields=FIELD_STATISTICS_MAPPING[schema],
+                                                                  key_fields=MERGE_KEY_MAPPING[schema]),
+                                          fields=FIELD_STATISTICS_MAPPING[schema])
+                if phase_rows:
+                    # Phase rows share the key of the statistics row: table_name (and source for datalake)
+                    key = result[:len(MERGE_KEY_MAPPING[schema]) - 3]
+                    load_timestamp = datetime.now(timezone.utc)
+                    args[0].db_conn.load_rows(
+                        sql_file_name=STATISTICS_SQL,
+                        values={(etl_timestamp, function_name, schema, *key, *row, load_timestamp) for row in phase_rows},
+                        sql_params=build_params(table_name=PHASE_STATISTICS_TABLE_MAPPING[schema],
+                                                schema=schema,
+                                                fields=FIELD_PHASE_STATISTICS_MAPPING[schema],
+                                                key_fields=MERGE_KEY_PHASE_STATISTICS_MAPPING[schema]),
+                        fields=FIELD_PHASE_STATISTICS_MAPPING[schema]
+                    )
             # else:
             #     args[0].db_conn.run_sql(schema, function_name, execution_time, result)
 